@@ -0,0 +1,324 @@
+"""
+共享的外部服务客户端与熔断器
+
+以前每次翻译都新建一个 googletrans.Translator()（连同新的 HTTP 连接池），
+Google 不可达时每次调用都要等到超时，再经过重试退避才轮到智谱 AI。这里：
+    - 智谱 AI 客户端进程内只创建一个，底层的 httpx 连接池长期复用；
+      googletrans 每个线程复用一个 Translator；
+    - 每个后端有一个熔断器：连续失败 BREAKER_FAILURE_THRESHOLD 次后在
+      BREAKER_COOLDOWN 秒内直接跳过该后端（抛出 BackendUnavailable），
+      冷却结束后放行一次探测请求，成功则恢复；
+    - 智谱 AI 的调用先经过所有 worker 共享的限流器（rate_limiter）；
+    - health() 返回各后端的状态和计数，供 /__stats/ai_clients 导出；
+    - Hedger 用于对延迟敏感的调用：主后端超过近期延迟分位数仍未返回时，
+      同时请求备用后端，取先返回的结果。
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+from dotenv import load_dotenv
+
+from config import Config
+from rate_limiter import RateLimiter
+from retry_policy import timeout_within
+
+load_dotenv()
+
+
+class BackendUnavailable(RuntimeError):
+    """后端处于熔断状态，本次调用被直接跳过"""
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=None, cooldown=None, is_failure=None):
+        """is_failure(异常) 返回 False 的异常（例如请求本身有误）不计入失败"""
+        self.name = name
+        self.failure_threshold = failure_threshold or Config.BREAKER_FAILURE_THRESHOLD
+        self.cooldown = cooldown if cooldown is not None else Config.BREAKER_COOLDOWN
+        self.is_failure = is_failure or (lambda error: True)
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        # 统计
+        self._calls = 0
+        self._failures = 0
+        self._rejected = 0
+        self._opened = 0
+        self._last_error = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def is_open(self):
+        """处于熔断且冷却时间未到（不改变状态，用于排队前快速失败）"""
+        with self._lock:
+            return self._state == self.OPEN and time.monotonic() - self._opened_at < self.cooldown
+
+    def allow(self):
+        """本次调用是否可以发往后端；冷却结束后只放行一个探测请求"""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self._state = self.HALF_OPEN
+                self._probing = False
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._calls += 1
+            self._consecutive_failures = 0
+            self._state = self.CLOSED
+            self._probing = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self._calls += 1
+            self._failures += 1
+            self._consecutive_failures += 1
+            self._last_error = f'{type(error).__name__}: {error}'
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self._opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise BackendUnavailable(f"{self.name} 暂时不可用（熔断中），已跳过")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if self.is_failure(e):
+                self.record_failure(e)
+            else:
+                # 请求本身的错误说明后端是可达的
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        with self._lock:
+            retry_in = 0.0
+            if self._state == self.OPEN:
+                retry_in = max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+            return {
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'calls': self._calls,
+                'failures': self._failures,
+                'rejected': self._rejected,
+                'opened': self._opened,
+                'retry_in_seconds': round(retry_in, 1),
+                'last_error': self._last_error,
+            }
+
+
+def _zhipu_is_failure(error):
+    # 4xx（限流 429 除外）是请求本身的问题，不代表服务不可用
+    status = getattr(error, 'status_code', None)
+    return not (status is not None and 400 <= status < 500 and status != 429)
+
+
+breakers = {
+    'google': CircuitBreaker('google'),
+    'zhipu': CircuitBreaker('zhipu', is_failure=_zhipu_is_failure),
+}
+
+# 所有 worker 共享的智谱 AI 限流（令牌桶 + 并发上限）
+zhipu_limiter = RateLimiter('zhipu', rate=Config.ZHIPU_RATE_PER_SECOND, burst=Config.ZHIPU_BURST,
+                            max_in_flight=Config.ZHIPU_MAX_IN_FLIGHT)
+
+_zhipu_client = None
+_zhipu_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_zhipu_client():
+    """进程内共享的智谱 AI 客户端（复用同一个 httpx 连接池）"""
+    global _zhipu_client
+    with _zhipu_lock:
+        if _zhipu_client is None:
+            from zhipuai import ZhipuAI
+            http_client = httpx.Client(
+                timeout=httpx.Timeout(Config.ZHIPU_TIMEOUT, connect=8.0),
+                limits=httpx.Limits(max_connections=Config.ZHIPU_MAX_CONNECTIONS,
+                                    max_keepalive_connections=Config.ZHIPU_MAX_CONNECTIONS),
+            )
+            # 关闭 SDK 自带的重试（默认 3 次，不考虑截止时间），重试统一由 RetryPolicy 负责
+            _zhipu_client = ZhipuAI(api_key=os.getenv('ZHIPU_API_KEY'), http_client=http_client, max_retries=0)
+        return _zhipu_client
+
+
+def get_translator():
+    """当前线程复用的 googletrans.Translator"""
+    translator = getattr(_local, 'translator', None)
+    if translator is None or _local.pid != os.getpid():
+        from googletrans import Translator
+        translator = Translator(timeout=Config.GOOGLE_TRANSLATE_TIMEOUT)
+        _local.translator = translator
+        _local.pid = os.getpid()
+    return translator
+
+
+def google_translate(text, src, dest):
+    """googletrans 翻译（text 可以是列表），经过 google 熔断器；每次 HTTP 请求的超时不超过请求剩余的时间"""
+    translator = get_translator()
+    # Translator 是线程独享的，可以直接修改其 httpx 客户端的超时
+    translator.client.timeout = timeout_within(Config.GOOGLE_TRANSLATE_TIMEOUT)
+    return breakers['google'].call(lambda: translator.translate(text, src=src, dest=dest))
+
+
+def zhipu_chat(**kwargs):
+    """
+    调用智谱 AI 的 chat.completions.create：先在所有 worker 共享的限流器中排队，
+    再经过 zhipu 熔断器；超时不超过请求剩余的时间
+    """
+    breaker = breakers['zhipu']
+    if breaker.is_open():
+        raise BackendUnavailable(f"{breaker.name} 暂时不可用（熔断中），已跳过")
+    with zhipu_limiter.slot() as waited:
+        if waited > 1:
+            print(f"智谱 AI 调用在限流器中排队 {waited:.2f} 秒")
+        kwargs.setdefault('timeout', timeout_within(Config.ZHIPU_TIMEOUT))
+        return breaker.call(lambda: get_zhipu_client().chat.completions.create(**kwargs))
+
+
+def zhipu_chat_stream(**kwargs):
+    """流式调用智谱 AI，逐段产出新增的文本；整个流式过程占用一个限流槽位，经过 zhipu 熔断器"""
+    breaker = breakers['zhipu']
+    if breaker.is_open():
+        raise BackendUnavailable(f"{breaker.name} 暂时不可用（熔断中），已跳过")
+    with zhipu_limiter.slot() as waited:
+        if waited > 1:
+            print(f"智谱 AI 调用在限流器中排队 {waited:.2f} 秒")
+        kwargs.setdefault('timeout', timeout_within(Config.ZHIPU_TIMEOUT))
+        if not breaker.allow():
+            raise BackendUnavailable(f"{breaker.name} 暂时不可用（熔断中），已跳过")
+        try:
+            for chunk in get_zhipu_client().chat.completions.create(stream=True, **kwargs):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except GeneratorExit:
+            # 调用方提前停止读取（例如客户端断开），后端本身是正常的
+            breaker.record_success()
+            raise
+        except Exception as e:
+            if breaker.is_failure(e):
+                breaker.record_failure(e)
+            else:
+                breaker.record_success()
+            raise
+        breaker.record_success()
+
+
+def health():
+    """各后端熔断器的状态，以及智谱 AI 调用的限流排队统计"""
+    stats = {name: breaker.stats() for name, breaker in breakers.items()}
+    stats['zhipu_rate_limit'] = zhipu_limiter.stats()
+    return stats
+
+
+class Hedger:
+    """
+    对冲请求：先调用主后端，如果在主后端近期延迟的 percentile 分位数内还没有返回，
+    再同时调用备用后端，哪个先成功返回哪个。大多数请求只调用一次主后端，
+    只有慢的尾部请求才会多花一次调用。
+    """
+
+    def __init__(self, name, percentile=95, min_delay_ms=50, default_delay_ms=300, window=200, max_workers=16):
+        self.name = name
+        self.percentile = percentile
+        self.min_delay = min_delay_ms / 1000
+        self.default_delay = default_delay_ms / 1000
+        self._latencies = deque(maxlen=window)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-hedge')
+        self._lock = threading.Lock()
+        # 统计
+        self._calls = 0
+        self._hedged = 0
+        self._wins = {}
+
+    def delay(self):
+        """触发对冲前的等待时间（秒）；样本不足 20 个时使用默认值"""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < 20:
+            return self.default_delay
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(self.min_delay, samples[index])
+
+    def _record_latency(self, start):
+        def callback(future):
+            if not future.cancelled() and future.exception() is None:
+                with self._lock:
+                    self._latencies.append(time.monotonic() - start)
+        return callback
+
+    def _win(self, name, result, *losers):
+        for future in losers:
+            # 已经开始执行的请求无法中断，只是不再等待它的结果
+            future.cancel()
+        with self._lock:
+            self._wins[name] = self._wins.get(name, 0) + 1
+        return result, name
+
+    def call(self, primary, secondary):
+        """primary、secondary 为 (名称, 无参函数)，返回 (结果, 胜出的后端名称)"""
+        (primary_name, primary_fn), (secondary_name, secondary_fn) = primary, secondary
+        with self._lock:
+            self._calls += 1
+        delay = self.delay()
+        start = time.monotonic()
+        # 复制上下文，请求的截止时间随任务传到线程池
+        first = self._executor.submit(contextvars.copy_context().run, primary_fn)
+        first.add_done_callback(self._record_latency(start))
+        wait([first], timeout=delay)
+        if first.done() and first.exception() is None:
+            return self._win(primary_name, first.result())
+
+        if not first.done():
+            with self._lock:
+                self._hedged += 1
+        second = self._executor.submit(contextvars.copy_context().run, secondary_fn)
+        names = {first: primary_name, second: secondary_name}
+        pending, error = {first, second}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return self._win(names[future], future.result(), *pending)
+                error = future.exception()
+        raise error
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'hedged': self._hedged,
+                'hedge_rate': self._hedged / self._calls if self._calls else 0.0,
+                'wins': dict(self._wins),
+                'hedge_delay_ms': round(delay * 1000, 1),
+                'latency_samples': len(self._latencies),
+            }
@@ -1,4 +1,3 @@
-from googletrans import Translator
 from transformers import BertTokenizer, BertModel
 import torch
 import numpy as np
@@ -7,122 +6,419 @@ from config import Config
 from dotenv import load_dotenv
 import os
 from PIL import Image
+import contextvars
+import json
+import threading
 import time
-from zhipuai import ZhipuAI
+from concurrent.futures import ThreadPoolExecutor, wait
 from utils import *
 from dict_io import *
 from word_vector_manager import word_vectors
-from googletrans import Translator
+from poem_corpus import get_poem_corpus
+from poem_store import get_poem_store
+from micro_batcher import MicroBatcher
+from embedding_cache import EmbeddingCache
+from translation_cache import get_translation_cache
+from retry_policy import RetryPolicy, default_policy, is_retryable, remaining, reset_deadline, set_deadline
+from ai_clients import Hedger, google_translate, zhipu_chat, zhipu_chat_stream
+from char_gloss import get_char_gloss
+from single_flight import single_flight
+from glyph_codes import GlyphCodeSpace, decode_char_3dim, encode_char_3dim
 
 # variables --------------------
 load_dotenv()  # 加载 .env 文件中的环境变量
 
-ZHIPU_API_KEY = os.getenv('ZHIPU_API_KEY')
-nvshu_ai = ZhipuAI(api_key=ZHIPU_API_KEY)
-
-# 简单的重试装饰器
-def retry_on_network_error(max_retries=3, backoff_factor=0.5):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            for attempt in range(max_retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    if attempt == max_retries - 1:
-                        raise e
-                    time.sleep(backoff_factor * (2 ** attempt))
-            return None
-        return wrapper
-    return decorator
-
-
 
 # 加载预训练的 BERT 模型和分词器
 tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
 model = BertModel.from_pretrained('bert-base-uncased')
 
-simple_el_dict = load_dict_from_file('knowledge_tmp/simple.pkl')
+# 进程内共享的只读知识库快照，每个请求在其上创建写时复制的覆盖层
+_base_knowledge = None
+_base_stamp = None  # 加载快照时 DICTIONARY_PATH 的 (mtime, size)
+_pca = None
+_knowledge_lock = threading.Lock()
+# 已经发给请求、但还没有被 accept_char 确认的字形编码 -> (字, 发放时间)
+_reserved_codes = {}
+
+
+def _dictionary_stamp():
+    try:
+        stat = os.stat(Config.DICTIONARY_PATH)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_base_knowledge():
+    """
+    只读的知识库快照。EL_vectors.pkl 每个进程只加载一次；
+    DICTIONARY_PATH 被本进程或其他 worker 写入新字后，重新加载 simple_el_dict。
+    """
+    global _base_knowledge, _base_stamp
+    stamp = _dictionary_stamp()
+    with _knowledge_lock:
+        if _base_knowledge is None or stamp != _base_stamp:
+            knowledge = SharedKnowledge()
+            if _base_knowledge is None:
+                knowledge.known_mappings = load_dict_from_file('knowledge_tmp/EL_vectors.pkl')
+            else:
+                knowledge.known_mappings = _base_knowledge.known_mappings
+            knowledge.simple_el_dict = load_dict_from_file(Config.DICTIONARY_PATH)
+            _base_knowledge = knowledge.freeze()
+            _base_stamp = stamp
+        return _base_knowledge
+
+
+def get_pca():
+    global _pca
+    with _knowledge_lock:
+        if _pca is None:
+            with open('knowledge_base/pca.pkl', 'rb') as f:
+                _pca = pickle.load(f)
+        return _pca
+
+
+def promote_knowledge(overlay):
+    """
+    显式地把请求覆盖层中的新映射提升为进程内的新快照。
+    覆盖层基于旧快照创建时，写入会重新应用到最新的快照上；正在使用旧快照的请求不受影响。
+    """
+    global _base_knowledge
+    get_base_knowledge()
+    with _knowledge_lock:
+        _base_knowledge = overlay.promoted(_base_knowledge)
+        return _base_knowledge
+
+
+def reserve_char_3dim(char, char_3dim):
+    """
+    为新生成的字预留字形编码，返回实际发放的编码。
+    覆盖层只知道快照中的编码，先后（或同时）生成的字可能拿到同一个编码；
+    编码已被快照中的其他字或其他未确认的字占用时，改用离它最近的空闲编码。
+    """
+    base = get_base_knowledge()
+    now = time.monotonic()
+    with _knowledge_lock:
+        for code, (_, issued) in list(_reserved_codes.items()):
+            if now - issued > Config.GLYPH_RESERVATION_TTL:
+                del _reserved_codes[code]
+        others = [decode_char_3dim(code) for code, (owner, _) in _reserved_codes.items() if owner != char]
+        char_3dim = GlyphCodeSpace(others, parent=base.simple_el_dict.codes).nearest_free(char_3dim)
+        _reserved_codes[encode_char_3dim(char_3dim)] = (char, now)
+        return char_3dim
+
+
+def accept_char(char, char_3dim, char_translate, creator='default', char_img_path=None, poem=None, poem_eng=None):
+    """
+    用户确认的字写入 DICTIONARY_PATH，并提升为本进程的新快照，之后的请求不会再发放这个编码。
+    编码已被其他字占用（例如预留过期后被重新发放）时抛出 ValueError。
+    """
+    base = get_base_knowledge()
+    if char not in base.simple_el_dict and char_3dim in base.simple_el_dict.codes:
+        raise ValueError(f"字形编码 {list(char_3dim)} 已被其他字使用，请重新生成")
+    add_to_dictionary(char, char_3dim, char_translate, creator, char_img_path, poem, poem_eng)
+    knowledge = base.overlay()
+    knowledge.simple_el_dict[char] = get_char_full_data(char)
+    promote_knowledge(knowledge)
+    with _knowledge_lock:
+        _reserved_codes.pop(encode_char_3dim(char_3dim), None)
 
 # functions --------------------
-@retry_on_network_error(max_retries=3, backoff_factor=0.5)
+def _gloss_translation(text, src_language, target_language):
+    # 单个汉字译成英文时直接查离线释义表
+    if src_language == 'zh-cn' and target_language == 'en' and len(text) == 1:
+        return get_char_gloss(text)
+    return None
+
+
 def translate_text(text, src_language='en', target_language="zh-cn"):
-    # 首先尝试使用增强的 googletrans
+    gloss = _gloss_translation(text, src_language, target_language)
+    if gloss is not None:
+        return gloss
+    # 再查翻译缓存，只缓存由翻译服务得到的结果，不缓存本地的兜底映射
+    cache = get_translation_cache()
+    if cache is not None:
+        entry = cache.get(text, src_language, target_language)
+        if entry is not None:
+            return entry['translation']
+    translation, backend = _translate_uncached(text, src_language, target_language)
+    if cache is not None and backend in ('google', 'zhipu'):
+        cache.put(text, src_language, target_language, translation, backend)
+    return translation
+
+
+# 翻译有两个后端可以互相兜底，每个后端最多只重试一次
+_translate_policy = RetryPolicy(max_attempts=2, name='翻译')
+
+
+@_translate_policy
+def _translate_google(text, src_language, target_language):
+    # googletrans（熔断中时立即抛出 BackendUnavailable）
+    return google_translate(text, src_language, target_language).text
+
+
+@_translate_policy
+def _translate_zhipu(text, src_language, target_language):
+    # 构建翻译提示
+    prompt = f"{_translation_prompt(src_language, target_language)}，只返回翻译结果，不要其他内容：{text}"
+
+    completion = zhipu_chat(
+        model=Config.LLM_MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        max_tokens=100,
+    )
+    return completion.choices[0].message.content.strip()
+
+
+def _translate_uncached(text, src_language='en', target_language="zh-cn"):
+    """返回 (译文, 后端)，后端为 google / zhipu / fallback"""
+    if Config.TRANSLATE_HEDGE:
+        return _translate_hedged(text, src_language, target_language)
+    # 首先尝试使用 googletrans
     try:
-        translator = Translator()
-        if translator:
-            result = translator.translate(text, src=src_language, dest=target_language)
-            return result.text
-        else:
-            raise Exception("Google翻译客户端未初始化")
+        return _translate_google(text, src_language, target_language), 'google'
     except Exception as e:
-        # 如果 googletrans 失败，尝试使用增强的 zhipu_AI
+        # 如果 googletrans 失败，尝试使用 zhipu_AI
         try:
-            if not nvshu_ai:
-                raise Exception("智谱AI客户端未初始化")
-                
-            # 构建翻译提示
-            if target_language == "zh-cn" and src_language == "en":
-                prompt = f"请将以下英文翻译成中文，只返回翻译结果，不要其他内容：{text}"
-            elif target_language == "en" and src_language == "zh-cn":
-                prompt = f"请将以下中文翻译成英文，只返回翻译结果，不要其他内容：{text}"
-            else:
-                # 其他语言组合
-                prompt = f"请将以下{src_language}文本翻译成{target_language}，只返回翻译结果，不要其他内容：{text}"
-            
-            completion = nvshu_ai.chat.completions.create(
-                model=Config.LLM_MODEL,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                max_tokens=100,
-            )
-            
-            translation = completion.choices[0].message.content.strip()
-            return translation
-            
+            return _translate_zhipu(text, src_language, target_language), 'zhipu'
         except Exception as ai_error:
             # 如果两种方法都失败，使用简单的映射
-            
-            # 如果两种方法都失败，使用简单的映射
-            simple_translations = {
-                'book': '书', 'strange': '奇', 'woman': '女', 'character': '字', 'text': '文',
-                'beautiful': '美', 'flower': '花', 'moon': '月', 'love': '爱', 'heart': '心',
-                'spring': '春', 'autumn': '秋', 'winter': '冬', 'summer': '夏', 'night': '夜',
-                'day': '日', 'mountain': '山', 'river': '水', 'wind': '风', 'rain': '雨',
-                'red': '红', 'black': '黑', 'white': '白', 'green': '绿', 'blue': '蓝',
-                'dance': '舞', 'move': '动', 'posture': '姿', 'back': '背', 'scene': '景',
-                'middle': '中', 'scarf': '巾', 'skirt': '裙', 'purple': '紫', 'sunset': '霞'
-            }
-            
-            if target_language == "zh-cn" and src_language == "en":
-                return simple_translations.get(text.lower(), text)
-            elif target_language == "en" and src_language == "zh-cn":
-                # 反向映射
-                reverse_translations = {v: k for k, v in simple_translations.items()}
-                return reverse_translations.get(text, text)
-            
-            # 如果都不行，返回原文
-            return text
+            return _fallback_translate(text, src_language, target_language), 'fallback'
+
+
+_translate_hedger = Hedger('translate', percentile=Config.TRANSLATE_HEDGE_PERCENTILE,
+                           default_delay_ms=Config.TRANSLATE_HEDGE_DELAY_MS)
+
+
+def _translate_hedged(text, src_language, target_language):
+    # googletrans 超过近期延迟分位数仍未返回时同时请求智谱 AI，取先返回的结果
+    try:
+        return _translate_hedger.call(
+            ('google', lambda: _translate_google(text, src_language, target_language)),
+            ('zhipu', lambda: _translate_zhipu(text, src_language, target_language)),
+        )
+    except Exception as e:
+        return _fallback_translate(text, src_language, target_language), 'fallback'
+
+
+def translation_hedge_stats():
+    """对冲翻译的触发次数和各后端胜出次数"""
+    return dict(_translate_hedger.stats(), enabled=Config.TRANSLATE_HEDGE)
+
+
+def _fallback_translate(text, src_language, target_language):
+    # 翻译服务都不可用时使用的简单映射
+    simple_translations = {
+        'book': '书', 'strange': '奇', 'woman': '女', 'character': '字', 'text': '文',
+        'beautiful': '美', 'flower': '花', 'moon': '月', 'love': '爱', 'heart': '心',
+        'spring': '春', 'autumn': '秋', 'winter': '冬', 'summer': '夏', 'night': '夜',
+        'day': '日', 'mountain': '山', 'river': '水', 'wind': '风', 'rain': '雨',
+        'red': '红', 'black': '黑', 'white': '白', 'green': '绿', 'blue': '蓝',
+        'dance': '舞', 'move': '动', 'posture': '姿', 'back': '背', 'scene': '景',
+        'middle': '中', 'scarf': '巾', 'skirt': '裙', 'purple': '紫', 'sunset': '霞'
+    }
+
+    if target_language == "zh-cn" and src_language == "en":
+        return simple_translations.get(text.lower(), text)
+    elif target_language == "en" and src_language == "zh-cn":
+        # 反向映射
+        reverse_translations = {v: k for k, v in simple_translations.items()}
+        return reverse_translations.get(text, text)
+
+    # 如果都不行，返回原文
+    return text
+
+
+def _translation_prompt(src_language, target_language):
+    if target_language == "zh-cn" and src_language == "en":
+        return "请将以下英文翻译成中文"
+    elif target_language == "en" and src_language == "zh-cn":
+        return "请将以下中文翻译成英文"
+    # 其他语言组合
+    return f"请将以下{src_language}文本翻译成{target_language}"
+
+
+@_translate_policy
+def _translate_batch_google(texts, src_language, target_language):
+    # googletrans 支持一次传入列表
+    results = google_translate(list(texts), src_language, target_language)
+    if not isinstance(results, list) or len(results) != len(texts):
+        raise ValueError("googletrans 批量翻译返回的数量不一致")
+    return [result.text for result in results]
+
+
+@_translate_policy
+def _translate_batch_llm(texts, src_language, target_language):
+    # 一次请求翻译整个列表，要求返回等长的 JSON 数组
+    prompt = (f"{_translation_prompt(src_language, target_language)}。输入是一个 JSON 数组，"
+              f"请返回同样长度、同样顺序的 JSON 数组，每个元素是对应的翻译结果，不要其他内容：\n"
+              f"{json.dumps(list(texts), ensure_ascii=False)}")
+    completion = zhipu_chat(
+        model=Config.LLM_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max(100, 60 * len(texts)),
+    )
+    content = completion.choices[0].message.content.strip()
+    # 去掉可能的 ```json 代码块标记
+    content = content[content.find('['):content.rfind(']') + 1]
+    translations = json.loads(content)
+    if not isinstance(translations, list) or len(translations) != len(texts):
+        raise ValueError("大模型批量翻译返回的数量不一致")
+    return [str(t).strip() for t in translations]
+
+
+_translate_executor = ThreadPoolExecutor(max_workers=Config.TRANSLATE_MAX_WORKERS, thread_name_prefix='translate')
+
+
+def translate_many(texts, src_language='en', target_language="zh-cn", deadline=None):
+    """
+    批量翻译，返回与 texts 顺序一致的译文列表。
+    依次尝试：单字释义表和缓存 -> googletrans 批量 -> 大模型一次翻译整个 JSON 数组 ->
+    逐条并发调用 translate_text；在 deadline 秒内没有完成的条目使用本地兜底映射。
+    线程池中的任务带着同一个截止时间，已经开始的调用（包括重试和限流排队）也会在截止时间前后结束，
+    不会在返回之后继续占用线程池；尚未开始的任务直接取消。
+    """
+    texts = list(texts)
+    deadline = Config.TRANSLATE_MANY_DEADLINE if deadline is None else deadline
+    # 不超过当前请求剩余的时间；已经超时时全部使用本地兜底
+    left = remaining()
+    if left is not None:
+        deadline = max(0.0, min(deadline, left))
+    start = time.monotonic()
+    cache = get_translation_cache()
+
+    translations = {}
+    for text in dict.fromkeys(texts):
+        gloss = _gloss_translation(text, src_language, target_language)
+        if gloss is not None:
+            translations[text] = gloss
+            continue
+        entry = cache.get(text, src_language, target_language) if cache is not None else None
+        if entry is not None:
+            translations[text] = entry['translation']
+    missing = [text for text in dict.fromkeys(texts) if text not in translations]
+
+    # 批量请求和逐条翻译都在 deadline 内进行：超时时间和重试都不会超过它
+    token = set_deadline(max(0.0, deadline - (time.monotonic() - start)))
+    try:
+        for backend, batch_fn in (('google', _translate_batch_google), ('zhipu', _translate_batch_llm)):
+            if not missing or time.monotonic() - start >= deadline:
+                break
+            try:
+                results = batch_fn(missing, src_language, target_language)
+            except Exception as e:
+                print(f"批量翻译（{backend}）失败: {e}")
+                continue
+            for text, translation in zip(missing, results):
+                translations[text] = translation
+                if cache is not None:
+                    cache.put(text, src_language, target_language, translation, backend)
+            missing = []
+
+        if missing and time.monotonic() - start < deadline:
+            # 逐条并发翻译，整体不超过 deadline
+            # 复制上下文，请求的截止时间随任务传到线程池
+            futures = {text: _translate_executor.submit(contextvars.copy_context().run, translate_text,
+                                                        text, src_language, target_language)
+                       for text in missing}
+            wait(futures.values(), timeout=max(0.0, deadline - (time.monotonic() - start)))
+            for text, future in futures.items():
+                if future.done() and future.exception() is None:
+                    translations[text] = future.result()
+                else:
+                    future.cancel()
+    finally:
+        reset_deadline(token)
+
+    # 超时或失败的条目使用本地兜底映射
+    for text in missing:
+        if text not in translations:
+            translations[text] = _fallback_translate(text, src_language, target_language)
+
+    return [translations[text] for text in texts]
+
+# 文本向量缓存；键包含模型标识和池化方式，更换模型后旧条目不再命中
+_embedding_cache = EmbeddingCache(
+    f'{model.config._name_or_path}:{model.config.hidden_size}:cls',
+    memory_size=Config.EMBED_CACHE_SIZE,
+    disk_path=Config.EMBED_CACHE_PATH if Config.EMBED_CACHE_DISK else None,
+    disk_max_bytes=Config.EMBED_CACHE_DISK_MAX_MB * 1024 * 1024,
+)
+
 
 # 定义向量化函数
 def vectorize_texts(texts):
-    embeddings = []
-    for text in texts:
+    """
+    每条文本的 [CLS] 向量，返回 (len(texts), 768) 的矩阵。
+    先查缓存，只对未命中的文本做前向计算。
+    """
+    texts = list(texts)
+    if not texts:
+        return np.empty((0, model.config.hidden_size), dtype=np.float32)
+    found = _embedding_cache.get_many(texts)
+    missing = [i for i in range(len(texts)) if i not in found]
+    if missing:
+        found.update(zip(missing, _compute_and_cache([texts[i] for i in missing])))
+    return np.vstack([found[i] for i in range(len(texts))])
+
+
+def _compute_and_cache(texts):
+    # 同一批里重复的文本只计算一次，结果写入缓存
+    unique = list(dict.fromkeys(texts))
+    computed = dict(zip(unique, _vectorize_uncached(unique)))
+    _embedding_cache.put_many(unique, [computed[text] for text in unique])
+    return [computed[text] for text in texts]
+
+
+def _vectorize_uncached(texts):
+    # 按 token 长度分桶：长度相近的文本放在同一批，每批只补齐到该批的最大长度
+    lengths = [len(ids) for ids in tokenizer(texts, truncation=True, max_length=512)['input_ids']]
+    order = np.argsort(lengths, kind='stable')
+    embeddings = [None] * len(texts)
+    for start in range(0, len(texts), Config.EMBED_BATCH_SIZE):
+        batch = [int(i) for i in order[start:start + Config.EMBED_BATCH_SIZE]]
         # 对文本进行分词
-        inputs = tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=512)
+        inputs = tokenizer([texts[i] for i in batch], return_tensors='pt', padding=True, truncation=True, max_length=512)
         # 获取BERT模型输出
         with torch.no_grad():
             outputs = model(**inputs)
         # 提取最后一层的隐藏状态的第一个 token 的向量表示（[CLS] token）
-        cls_embedding = outputs.last_hidden_state[:, 0, :]
-        embeddings.append(cls_embedding.numpy())
+        cls_embedding = outputs.last_hidden_state[:, 0, :].numpy()
+        for i, row in zip(batch, cls_embedding):
+            embeddings[i] = row
     # 将嵌入列表转换为 NumPy 数组
     return np.vstack(embeddings)
 
 
+# 并发请求的单条文本合并成一批计算（Config.EMBED_MICRO_BATCH 开启时使用）
+_text_batcher = MicroBatcher(_compute_and_cache,
+                             max_batch_size=Config.EMBED_BATCH_SIZE,
+                             max_wait_ms=Config.EMBED_MICRO_BATCH_WAIT_MS,
+                             name='text-embedding')
+
+
+def vectorize_text(text):
+    """单条文本的 [CLS] 向量，形状为 (1, 768)；开启微批处理时与其他请求合并计算"""
+    if Config.EMBED_MICRO_BATCH:
+        # 命中缓存时不必进入队列等待
+        cached = _embedding_cache.get_many([text])
+        if cached:
+            return cached[0][None, :]
+        return _text_batcher(text)[None, :]
+    return vectorize_texts([text])
+
+
+def embedding_batcher_stats():
+    """微批处理的队列深度和批大小统计，以及向量缓存的命中统计"""
+    return dict(_text_batcher.stats(), enabled=Config.EMBED_MICRO_BATCH, cache=_embedding_cache.stats())
+
+
 def find_most_similar_texts(input_embedding, text_embeddings, texts, n=5):
     # 计算相似度
     similarity_matrix = cosine_similarity(input_embedding, text_embeddings)
@@ -138,6 +434,21 @@ def find_most_similar_texts(input_embedding, text_embeddings, texts, n=5):
 
 # 最主要的函数 --------------------
 # 视频/图像识别 + 找到最相近的三句诗，返回
+def _media_identity(filename):
+    # 同一个媒体文件：文件名、大小和修改时间都相同
+    if isinstance(filename, tuple):
+        filename = filename[0]
+    media_path = os.path.join(Config.UPLOAD_FOLDER, os.path.basename(filename))
+    try:
+        stat = os.stat(media_path)
+        return os.path.basename(filename), stat.st_size, stat.st_mtime_ns
+    except OSError:
+        return os.path.basename(filename)
+
+
+# 同时进行的相同调用只执行一次（见 single_flight）
+@single_flight('recognize_and_translate', key=lambda filename, media_type, session_id, logger=None: (
+    Config.VISION_MODEL, Config.PROMPT, _media_identity(filename), media_type))
 def recognize_and_translate(filename, media_type, session_id, logger=None):
     try:
         if logger:
@@ -162,15 +473,7 @@ def recognize_and_translate(filename, media_type, session_id, logger=None):
         # 如果返回的是元组（分析结果，关键帧路径），则处理关键帧路径
         if isinstance(result, tuple) and len(result) == 2:
             analysis_result, keyframe_path = result
-            # 将关键帧路径转换为URL
-            if keyframe_path:
-                # 从绝对路径转换为相对URL
-                keyframe_url = keyframe_path.replace(Config.BASE_DIR, '').replace('\\', '/')
-                if not keyframe_url.startswith('/'):
-                    keyframe_url = '/' + keyframe_url
-                return translate_text(analysis_result), analysis_result, keyframe_url
-            else:
-                return translate_text(analysis_result), analysis_result, None
+            return translate_text(analysis_result), analysis_result, _keyframe_url(keyframe_path)
         else:
             # 兼容旧格式（只返回分析结果）
             return translate_text(result), result, None
@@ -180,24 +483,57 @@ def recognize_and_translate(filename, media_type, session_id, logger=None):
         # 重新抛出异常，让调用者知道发生了什么
         raise e
 
+
+def _keyframe_url(keyframe_path):
+    # 将关键帧的绝对路径转换为相对URL
+    if not keyframe_path:
+        return None
+    keyframe_url = keyframe_path.replace(Config.BASE_DIR, '').replace('\\', '/')
+    if not keyframe_url.startswith('/'):
+        keyframe_url = '/' + keyframe_url
+    return keyframe_url
+
+
+def stream_recognize_and_translate(filename, media_type, session_id):
+    """
+    流式版本的 recognize_and_translate：先逐段产出 ('delta', 英文描述片段)，
+    最后产出 ('done', (中文描述, 英文描述, 关键帧URL))
+    """
+    if isinstance(filename, tuple):
+        filename = filename[0]
+    media_path = os.path.join(Config.UPLOAD_FOLDER, os.path.basename(filename))
+    if not os.path.exists(media_path):
+        raise FileNotFoundError(f"Video file not found at: {media_path}")
+    from media_analysis import MediaAnalyzer
+    analyzer = MediaAnalyzer(Config.VISION_MODEL, media_type, session_id)
+    chunks, keyframe_path = analyzer.stream_media(filename)
+
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield 'delta', chunk
+    analysis_result = ''.join(parts).strip()
+    if not analysis_result:
+        raise ValueError('Media recognition returned None or empty result')
+    yield 'done', (translate_text(analysis_result), analysis_result, _keyframe_url(keyframe_path))
+
+
+def add_poems_to_corpus(poems, poems_eng):
+    """把新诗（及其英文翻译）编码后追加到诗歌存储，不重写已有数据"""
+    embeddings = vectorize_texts(poems)
+    return get_poem_store().append(poems, poems_eng, embeddings)
+
+
 # 怀旧打字机，纸上诉真情。
+@single_flight('find_similar', key=lambda translated_result, n=3: (
+    model.config._name_or_path, translated_result, n))
 def find_similar(translated_result, n=3):
-    # 读中英文版的
-    poems = list()
-    poems_eng = list()
-    with open('knowledge_base/nvshu_origin_with_eng.txt', 'r', encoding='utf-8') as file:
-        for index, line in enumerate(file):
-            # Check if the line index is even or odd
-            if index % 2 == 0:
-                poems.append(line.rstrip())
-            else:
-                poems_eng.append(line.rstrip())
-    poem_embeddings = load_dict_from_file("knowledge_base/poem_embeddings")
+    # 中英文诗句和句向量常驻内存，文件变化时才重新读取
+    corpus = get_poem_corpus()
     try:
         # 找到最相似的诗句
-        input_embedding = vectorize_texts([translated_result])
-        most_similar_texts, idx = find_most_similar_texts(input_embedding, poem_embeddings, poems, n)
-        most_similar_texts_eng = [poems_eng[i] for i in idx]
+        input_embedding = vectorize_text(translated_result)
+        most_similar_texts, most_similar_texts_eng, _ = corpus.most_similar(input_embedding, n)
 
         return most_similar_texts, most_similar_texts_eng
     except Exception as e:
@@ -230,59 +566,176 @@ def ensure_five_chars(poem):
     # 重新组合
     return '，'.join(processed_parts)
 
+_POEM_SYSTEM_PROMPT = "你是一位旧时的女性诗人，必须严格按照五言诗格式（两句，每句五个字）生成诗歌。写一句五言诗，如：一齐花纸女，我来几俫欢。要求：上下两句，每句都是五个字，严禁不同字数，共十个中文字。直接给出诗句，中间用逗号分开，不要用特殊字符。"
+
+# 多候选模式下的候选诗格式通过率统计
+_poem_candidate_stats = {'rounds': 0, 'candidates': 0, 'passed': 0}
+_poem_candidate_lock = threading.Lock()
+
+
+def _poem_messages(video_description, similar_poems):
+    # v2
+    return [
+        {
+            "role": "system",
+            "content": _POEM_SYSTEM_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": f"{video_description}，基于这段文字内容，请你以旧时的女性的视角，结合这三句诗句：{similar_poems}创作一个新的五言诗。必须严格按照五言诗格式（两句，每句五个字）生成诗歌。直接给出诗歌。"
+                }
+            ]
+        }
+    ]
+
+
+def _request_poem(video_description, similar_poems):
+    completion = zhipu_chat(
+        model=Config.LLM_MODEL,
+        messages=_poem_messages(video_description, similar_poems),
+        max_tokens=50,
+    )
+    return [completion.choices[0].message.content.strip()]
+
+
+def _request_poem_candidates(video_description, similar_poems, n):
+    # 一次请求生成 n 首候选诗，要求返回 JSON 数组
+    completion = zhipu_chat(
+        model=Config.LLM_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": _POEM_SYSTEM_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": f"{video_description}，基于这段文字内容，请你以旧时的女性的视角，结合这三句诗句：{similar_poems}创作{n}首不同的五言诗。每首必须严格按照五言诗格式（两句，每句五个字）。只返回一个 JSON 字符串数组，每个元素是一首诗，不要其他内容。"
+            }
+        ],
+        max_tokens=40 * n + 50,
+    )
+    content = completion.choices[0].message.content.strip()
+    try:
+        candidates = json.loads(content[content.find('['):content.rfind(']') + 1])
+        if not isinstance(candidates, list):
+            raise ValueError("候选诗不是列表")
+    except ValueError:
+        # 没有按 JSON 返回时按行拆分
+        candidates = [line.strip(' -*"\'0123456789.、') for line in content.splitlines()]
+    return [str(candidate).strip() for candidate in candidates if str(candidate).strip()]
+
+
+def select_poem(candidates):
+    """依次整理候选诗，返回第一首符合五言诗格式的；都不符合时返回 None"""
+    for candidate in candidates:
+        poem = ensure_five_chars(candidate)
+        if validate_poem_format(poem):
+            return poem
+    return None
+
+
+def _record_poem_candidates(candidates):
+    passed = sum(1 for candidate in candidates if validate_poem_format(ensure_five_chars(candidate)))
+    with _poem_candidate_lock:
+        stats = _poem_candidate_stats
+        stats['rounds'] += 1
+        stats['candidates'] += len(candidates)
+        stats['passed'] += passed
+        rate = stats['passed'] / stats['candidates'] if stats['candidates'] else 0.0
+    print(f"候选诗通过 {passed}/{len(candidates)}，累计通过率 {rate:.1%}")
+
+
+def poem_candidate_stats():
+    """多候选生成的轮数、候选数和格式通过率"""
+    with _poem_candidate_lock:
+        stats = dict(_poem_candidate_stats)
+    stats['pass_rate'] = stats['passed'] / stats['candidates'] if stats['candidates'] else 0.0
+    stats['candidates_per_round'] = Config.POEM_CANDIDATES
+    return stats
+
+
+def _accept_poem(new_poem):
+    # 翻译通过校验的新诗，按配置写入诗歌存储，返回英文翻译
+    new_poem_en = translate_text(new_poem, 'zh-cn', 'en')
+    if Config.POEM_STORE_APPEND_ACCEPTED:
+        try:
+            add_poems_to_corpus([new_poem], [new_poem_en])
+        except Exception as e:
+            print(f"新诗写入诗歌存储失败: {e}")
+    return new_poem_en
+
+
+class PoemFormatError(ValueError):
+    """生成的诗不符合五言诗格式"""
+
+
+def _poem_retryable(error):
+    # 格式不合格时重新生成；其他错误按统一策略判断
+    return isinstance(error, PoemFormatError) or is_retryable(error)
+
+
+@single_flight('create_new_poem', key=lambda video_description, similar_poems, max_retries=2: (
+    Config.LLM_MODEL, video_description, similar_poems, Config.POEM_CANDIDATES))
 def create_new_poem(video_description, similar_poems, max_retries=2):
-    retry_count = 0
-    last_error = None
-    
-    while retry_count <= max_retries:
+    def attempt():
+        if Config.POEM_CANDIDATES > 1:
+            # 一次请求多首候选诗，本地挑出第一首格式正确的，都不合格才再请求一轮
+            candidates = _request_poem_candidates(video_description, similar_poems, Config.POEM_CANDIDATES)
+            _record_poem_candidates(candidates)
+        else:
+            candidates = _request_poem(video_description, similar_poems)
+
+        # 确保每句都是5个字，并检查诗歌格式（确保是五言诗）
+        new_poem = select_poem(candidates)
+        if new_poem is None:
+            print(candidates)
+            raise PoemFormatError("Generated poem does not meet the required format")
+        return new_poem
+
+    policy = RetryPolicy(max_attempts=max_retries + 1, retry_on=_poem_retryable, name='create_new_poem')
+    try:
+        new_poem = policy.call(attempt)
+    except Exception as e:
+        # 如果所有尝试都失败（或已到截止时间），返回默认值
+        print(f"All retries failed. Last error: {e}")
+        default_poem = "江永女书奇，闺中秘语稀。"
         try:
-            # v2
-            completion = nvshu_ai.chat.completions.create(
-                model=Config.LLM_MODEL,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "你是一位旧时的女性诗人，必须严格按照五言诗格式（两句，每句五个字）生成诗歌。写一句五言诗，如：一齐花纸女，我来几俫欢。要求：上下两句，每句都是五个字，严禁不同字数，共十个中文字。直接给出诗句，中间用逗号分开，不要用特殊字符。",
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"{video_description}，基于这段文字内容，请你以旧时的女性的视角，结合这三句诗句：{similar_poems}创作一个新的五言诗。必须严格按照五言诗格式（两句，每句五个字）生成诗歌。直接给出诗歌。"
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=50,
-            )
-            new_poem = completion.choices[0].message.content.strip()
-            
-            # 确保每句都是5个字
-            new_poem = ensure_five_chars(new_poem)
+            default_translation = translate_text(default_poem, 'zh-cn', 'en')
+        except:
+            default_translation = "Jiang Yong female script, secret words in boudoir."
+        return default_poem, default_translation
 
-            # 检查诗歌格式（确保是五言诗）
-            if not validate_poem_format(new_poem):
-                print(new_poem)
-                raise ValueError("Generated poem does not meet the required format")
+    # 返回诗歌及其翻译
+    return new_poem, _accept_poem(new_poem)
 
-            # 返回诗歌及其翻译
-            return new_poem, translate_text(new_poem, 'zh-cn', 'en')
-        except Exception as e:
-            last_error = e
-            print(f"Attempt {retry_count + 1} failed: {e}")
-            retry_count += 1
-            if retry_count <= max_retries:
-                time.sleep(1)  # 稍作延迟再重试
-    # 如果所有尝试都失败，返回默认值
-    print(f"All retries failed. Last error: {last_error}")
-    default_poem = "江永女书奇，闺中秘语稀。"
+
+
+def stream_new_poem(video_description, similar_poems):
+    """
+    流式生成五言诗：先逐段产出 ('delta', 文本片段)，最后产出 ('done', (诗句, 英文翻译))。
+    流式结果不符合五言诗格式时退回 create_new_poem 重新生成，done 中总是校验过的诗句
+    """
+    parts = []
     try:
-        default_translation = translate_text(default_poem, 'zh-cn', 'en')
-    except:
-        default_translation = "Jiang Yong female script, secret words in boudoir."
-    return default_poem, default_translation
+        for chunk in zhipu_chat_stream(model=Config.LLM_MODEL,
+                                       messages=_poem_messages(video_description, similar_poems),
+                                       max_tokens=50):
+            parts.append(chunk)
+            yield 'delta', chunk
+        new_poem = select_poem([''.join(parts).strip()])
+    except Exception as e:
+        print(f"流式生成诗歌失败: {e}")
+        new_poem = None
 
+    if new_poem is None:
+        print(''.join(parts))
+        new_poem, new_poem_en = create_new_poem(video_description, similar_poems)
+    else:
+        new_poem_en = _accept_poem(new_poem)
+    yield 'done', (new_poem, new_poem_en)
 
 # create_nvshu_from_poem('江永女书奇，闺中秘语稀。')
 # poem = '江永女书奇，闺中秘语稀。'
@@ -301,14 +754,9 @@ def create_nvshu_from_poem(poem):
             raise RuntimeError("词向量管理器未正确初始化")
         
         # A发送诗句给B
-        EL_mappings = load_dict_from_file('knowledge_tmp/EL_vectors.pkl')
-        
-        with open('knowledge_base/pca.pkl', 'rb') as f:
-            pca = pickle.load(f)
-
-        current_knowledge = SharedKnowledge()
-        current_knowledge.known_mappings = EL_mappings
-        current_knowledge.simple_el_dict = simple_el_dict
+        # 本次请求的修改只写入覆盖层，不会影响共享快照和其他请求
+        current_knowledge = get_base_knowledge().overlay()
+        pca = get_pca()
 
         # 创建两个Machine对象
         machine_A = Machine('A', current_knowledge, n=1, pca=pca)
@@ -326,7 +774,7 @@ def create_nvshu_from_poem(poem):
 
         # B接收诗句并猜测EL字符
         max_tries = 5
-        list_to_guess = list()
+        list_to_guess = iter(())
         word_idx = 0
         list_of_guess = []
         for j in range(max_tries):
@@ -336,13 +784,13 @@ def create_nvshu_from_poem(poem):
             if j == 0:
                 word_idx = get_differing_indices(guess, poem)[0]
                 random_number = random.randint(1000, 4000)
-                list_to_guess = get_transition_keys(word_vectors, guess[word_idx], poem[word_idx])
-                list_to_guess = sample_transition_keys(list_to_guess, random_number)
-                # print(list_to_guess)
+                # 只按需排出实际用到的候选字（最多 max_tries - 1 个），顺序与
+                # sample_transition_keys(get_transition_keys(...)) 完全一致
+                list_to_guess = iter_transition_keys(word_vectors, guess[word_idx], poem[word_idx], random_number)
             else:
-                if len(list_to_guess) > 0:
-                    guess = replace_string_element(guess, word_idx, list_to_guess[0])
-                    list_to_guess = list_to_guess[1:]
+                next_guess = next(list_to_guess, None)
+                if next_guess is not None:
+                    guess = replace_string_element(guess, word_idx, next_guess)
                     
             # print(f"Guess result {j}: {guess}")
             list_of_guess.append(guess[machine_A.replaced_indices[0]])
@@ -373,8 +821,10 @@ def create_nvshu_from_poem(poem):
         # 中文字, 中文字位置, 女书字（3-dim），768-dim vect, list of guess, list of guess(translated in eng), 带有替换字的五言诗的翻译
         idx = poem.index(feedback[0])
         guess_poems = [poem[:idx] + i + poem[idx+1:] for i in list_of_guess]
-        char_3dim = machine_A.knowledge.simple_el_dict[feedback[0]]['char_3dim']
-        return feedback[0], idx, char_3dim, list(feedback[1].astype('float')), list_of_guess, [translate_text(x, 'zh-cn', 'en').lower() for x in list_of_guess], [translate_text(x, 'zh-cn', 'en').lower() for x in guess_poems]
+        char_3dim = reserve_char_3dim(feedback[0], machine_A.knowledge.simple_el_dict[feedback[0]]['char_3dim'])
+        # 猜测的字和诗句一起批量翻译，保持顺序
+        translated = [x.lower() for x in translate_many(list(list_of_guess) + guess_poems, 'zh-cn', 'en')]
+        return feedback[0], idx, char_3dim, list(feedback[1].astype('float')), list_of_guess, translated[:len(list_of_guess)], translated[len(list_of_guess):]
     except Exception as e:
         # 提供更详细的错误信息
         error_msg = f"生成女书字符失败: {str(e)}"
@@ -389,8 +839,13 @@ def create_nvshu_from_poem(poem):
         raise RuntimeError(error_msg)
 
 def get_char_translate(char_cn, poem, poem_eng):
+    # 离线释义表中有这个字时不再请求大模型
+    gloss = get_char_gloss(char_cn)
+    if gloss is not None:
+        return gloss
     try:
-        completion = nvshu_ai.chat.completions.create(
+        completion = default_policy.call(
+            zhipu_chat,
             model=Config.LLM_MODEL,  # 使用LLM模型而不是VISION模型
             messages=[
                 {
@@ -460,7 +915,7 @@ def replace_with_simple_el(message):
     replaced_indices = []
 
     # 先检查消息中的字符是否所有都在EL字典中
-    known_chinese = list(simple_el_dict.keys()) + ['，', '。', '！', '？', '\n']
+    known_chinese = list(get_base_knowledge().simple_el_dict.keys()) + ['，', '。', '！', '？', '\n']
     check_in_el = [char in known_chinese for char in message]
     
     # 找出 True 值的位置
@@ -479,7 +934,7 @@ def replace_with_simple_el(message):
 # message = '江永女书奇，闺中秘语稀。'
 def init_marked_message(message):
     # A发送诗句给B
-    known_chinese = list(simple_el_dict.keys())
+    known_chinese = list(get_base_knowledge().simple_el_dict.keys())
     possible_choices = [char for char in message if (char not in ['，', '。', '！', '？']) and (not char in known_chinese)]
     i = random.randrange(len(possible_choices))
     char = possible_choices[i]
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, session, send_from_directory, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, send_from_directory, redirect, url_for, Response, stream_with_context, g
 import os
 import uuid
 import json
@@ -14,9 +14,11 @@ log.setLevel(logging.ERROR)
 
 # 加载环境变量
 load_dotenv()
-from ai_nvshu_functions import find_similar, recognize_and_translate, create_new_poem, create_nvshu_from_poem, create_combined_nvshu_image, replace_with_simple_el, get_char_translate, translate_text
+from ai_nvshu_functions import find_similar, recognize_and_translate, create_new_poem, create_nvshu_from_poem, create_combined_nvshu_image, replace_with_simple_el, get_char_translate, translate_text, stream_recognize_and_translate, stream_new_poem, accept_char
 from utils import load_dict_from_file
 from process_video import pixelate
+from retry_policy import set_deadline, reset_deadline
+from cache_store import SqliteStore
 import logging
 from flask_cors import CORS
 import atexit
@@ -55,6 +57,21 @@ app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # 禁用静态资源缓存（开发环境）
 
+# 每个请求的截止时间，沿调用链传递给外部服务调用和重试策略
+@app.before_request
+def start_request_deadline():
+    g.deadline_token = set_deadline(Config.REQUEST_DEADLINE)
+
+@app.teardown_request
+def end_request_deadline(exc=None):
+    token = g.pop('deadline_token', None)
+    if token is not None:
+        try:
+            reset_deadline(token)
+        except ValueError:
+            # 流式响应在另一个上下文中结束时 token 无法复原，截止时间随上下文一起丢弃
+            pass
+
 # 在模板中注入 DEBUG 标志和语言信息
 @app.context_processor
 def inject_debug_flag():
@@ -96,6 +113,47 @@ def dev_version():
     resp.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     return resp
 
+# /__stats/* 暴露内部状态，与 /__dev_version 一样只在调试模式下可用，生产环境需显式开启 STATS_ENDPOINTS
+@app.before_request
+def guard_stats_endpoints():
+    if request.path.startswith('/__stats/') and not (app.debug or Config.STATS_ENDPOINTS):
+        return jsonify({}), 404
+
+@app.route('/__stats/embedding')
+def embedding_stats():
+    # 文本向量化微批处理的队列深度和批大小统计
+    from ai_nvshu_functions import embedding_batcher_stats
+    return jsonify(embedding_batcher_stats())
+
+@app.route('/__stats/translation')
+def translation_stats():
+    # 翻译缓存的命中统计和对冲翻译的统计
+    from translation_cache import get_translation_cache
+    from ai_nvshu_functions import translation_hedge_stats
+    cache = get_translation_cache()
+    return jsonify({
+        'cache': cache.stats() if cache is not None else {'enabled': False},
+        'hedge': translation_hedge_stats(),
+    })
+
+@app.route('/__stats/poem')
+def poem_stats():
+    # 多候选生成五言诗的格式通过率
+    from ai_nvshu_functions import poem_candidate_stats
+    return jsonify(poem_candidate_stats())
+
+@app.route('/__stats/single_flight')
+def single_flight_stats():
+    # 合并的重复调用次数
+    from single_flight import single_flight_stats
+    return jsonify(single_flight_stats())
+
+@app.route('/__stats/ai_clients')
+def ai_clients_stats():
+    # 外部服务（googletrans、智谱 AI）的熔断器状态
+    from ai_clients import health
+    return jsonify(health())
+
 # 确保上传目录存在
 if not os.path.exists(Config.UPLOAD_FOLDER):
     os.makedirs(Config.UPLOAD_FOLDER) 
@@ -280,6 +338,30 @@ def think():
                          original_media_url=original_media_url,
                          media_type=media_type)
 
+def resolve_media_path(data):
+    """根据 session（或请求中的 original_media_url）找到上传的媒体文件，返回 (绝对路径, 文件名)"""
+    media_url = session.get('original_media_url', session.get('media_url'))
+    if not media_url:
+        raise ValueError('No media URL provided for describe_video')
+
+    if data and data.get('original_media_url'):
+        media_url = data['original_media_url']
+
+    # 从 URL 中提取文件名
+    filename = os.path.basename(media_url.split('?')[0])
+    # 构建完整的文件路径
+    media_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    # 规范化路径
+    media_path = os.path.abspath(os.path.normpath(media_path))
+
+    # 验证文件是否存在
+    if not os.path.isfile(media_path):
+        raise FileNotFoundError(f'文件不存在: {media_path}')
+    # 验证路径是否在允许的目录内
+    if not media_path.startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
+        raise ValueError('无效的文件路径')
+    return media_path, filename
+
 @app.route('/describe_video', methods=['POST'])
 def describe_video():
     try:
@@ -296,27 +378,7 @@ def describe_video():
             })
         else:
             media_type = session.get('media_type')
-            media_url = session.get('original_media_url', session.get('media_url'))
-            if not media_url:
-                raise ValueError('No media URL provided for describe_video')
-            
-            data = request.get_json()
-            if data and data.get('original_media_url'):
-                media_url = data['original_media_url']
-            
-            # 从 URL 中提取文件名
-            filename = os.path.basename(media_url.split('?')[0])
-            # 构建完整的文件路径
-            media_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            # 规范化路径
-            media_path = os.path.abspath(os.path.normpath(media_path))
-            
-            # 验证文件是否存在
-            if not os.path.isfile(media_path):
-                raise FileNotFoundError(f'文件不存在: {media_path}')
-            # 验证路径是否在允许的目录内
-            if not media_path.startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
-                raise ValueError('无效的文件路径')
+            media_path, filename = resolve_media_path(request.get_json())
 
             app.logger.info(f"开始处理媒体文件: {filename}")
             result = recognize_and_translate(media_path, media_type, session['session_id'], logger=app.logger)
@@ -367,6 +429,102 @@ def generate_poem():
         return jsonify({"error": str(e)}), 500
 
 
+
+def ndjson_stream(events):
+    """
+    把 (类型, 数据) 事件流转换为逐行的 JSON（application/x-ndjson）响应：
+    {"type": "delta", "text": ...} 在模型生成时逐段发送，最后一行是 done 或 error
+    """
+    def generate():
+        try:
+            for event in events:
+                yield json.dumps(event, ensure_ascii=False) + '\n'
+        except Exception as e:
+            app.logger.error(f"流式响应失败: {str(e)}")
+            yield json.dumps({'type': 'error', 'error': str(e)}, ensure_ascii=False) + '\n'
+    # 关闭 nginx 的响应缓冲，否则客户端要等到全部生成完才收到数据
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'})
+
+# 流式接口的最终结果（多个 worker 共享），响应开始后无法写 session，由 /save_stream_result 凭 result_id 写入
+_stream_results = SqliteStore(Config.STREAM_RESULT_PATH, table='stream_results', ttl=Config.STREAM_RESULT_TTL)
+
+def save_stream_result_for_session(session_id, values):
+    """保存服务端生成的结果，返回交给客户端的 result_id"""
+    result_id = uuid.uuid4().hex
+    _stream_results.put(result_id, json.dumps({'session_id': session_id, 'values': values}, ensure_ascii=False).encode('utf-8'))
+    return result_id
+
+@app.route('/describe_video_stream', methods=['POST'])
+def describe_video_stream():
+    """
+    /describe_video 的流式版本：英文描述逐段返回，
+    最后一行 {"type": "done", "video_desc": ..., "video_desc_eng": ..., "result_id": ...}。
+    响应开始后无法再修改 session，客户端需要把 result_id 交给 /save_stream_result
+    """
+    use_mock_data = app.debug or os.getenv('USE_MOCK_AI', 'false').lower() == 'true'
+    try:
+        if use_mock_data:
+            video_desc_en = 'I see a woman sitting at a table in what appears to be a café or restaurant. She is wearing a sleeveless top and holding a rose close to her face.'
+            events = iter([('delta', video_desc_en), ('done', ('我看到一个女人坐在看似是咖啡馆或餐厅的桌子上。她穿着无袖上衣，拿着玫瑰靠近脸。', video_desc_en, None))])
+        else:
+            media_path, filename = resolve_media_path(request.get_json(silent=True))
+            app.logger.info(f"开始流式处理媒体文件: {filename}")
+            events = stream_recognize_and_translate(media_path, session.get('media_type'), session['session_id'])
+    except Exception as e:
+        app.logger.error(f"视频描述失败: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    session_id = session['session_id']
+
+    def describe_events():
+        for kind, value in events:
+            if kind == 'delta':
+                yield {'type': 'delta', 'text': value}
+            else:
+                video_desc, video_desc_en, keyframe_url = value
+                result_id = save_stream_result_for_session(session_id, {'media_url': keyframe_url} if keyframe_url else {})
+                yield {'type': 'done', 'video_desc': video_desc, 'video_desc_eng': video_desc_en, 'result_id': result_id}
+    return ndjson_stream(describe_events())
+
+@app.route('/generate_poem_stream', methods=['POST'])
+def generate_poem_stream():
+    """
+    /generate_poem 的流式版本：诗句逐段返回，最后一行 {"type": "done", "poem": ..., "poem_eng": ...}
+    中的诗句经过五言诗格式校验（不合格时已重新生成），可能与逐段返回的文本不同。
+    客户端需要把 done 中的 result_id 交给 /save_stream_result，由服务端把诗句写入 session
+    """
+    if app.debug:
+        events = iter([('delta', '江永女书奇，'), ('delta', '闺中秘语稀。'), ('done', ('江永女书奇，闺中秘语稀。', 'This is machine generated poem'))])
+    else:
+        data = request.get_json(silent=True) or {}
+        events = stream_new_poem(data.get('video_description'), data.get('similar_poems'))
+    session_id = session['session_id']
+
+    def poem_events():
+        for kind, value in events:
+            if kind == 'delta':
+                yield {'type': 'delta', 'text': value}
+            else:
+                result_id = save_stream_result_for_session(session_id, {'poem': value[0], 'poem_eng': value[1]})
+                yield {'type': 'done', 'poem': value[0], 'poem_eng': value[1], 'result_id': result_id}
+    return ndjson_stream(poem_events())
+
+@app.route('/save_stream_result', methods=['POST'])
+def save_stream_result():
+    """把流式接口在服务端保存的最终结果写入 session（流式响应开始后无法再写 session）"""
+    data = request.get_json(silent=True) or {}
+    stored = _stream_results.get(str(data.get('result_id', '')))
+    if stored is None:
+        return jsonify({'status': 'error', 'message': '结果不存在或已过期'}), 404
+    result = json.loads(stored)
+    # 只能取回本会话生成的结果
+    if result['session_id'] != session.get('session_id'):
+        return jsonify({'status': 'error', 'message': '结果不存在或已过期'}), 404
+    for key in ('poem', 'poem_eng', 'media_url'):
+        if key in result['values']:
+            session[key] = result['values'][key]
+    return jsonify({'status': 'success'})
+
 @app.route('/find_similar_poems', methods=['POST'])
 def find_similar_poems():
     try:
@@ -670,7 +828,6 @@ def search_dictionary():
 @app.route('/add_to_dictionary', methods=['POST'])
 def add_to_dictionary():
     try:
-        from dict_io import add_to_dictionary
         char = session.get('char')
         char_3dim = session.get('char_3dim')
         char_translate = session.get('char_translate')
@@ -681,11 +838,14 @@ def add_to_dictionary():
         # media_url = session.get('media_url')  # 使用关键帧URL而不是原始视频URL
         
         if char and char_3dim:
-            add_to_dictionary(char, char_3dim, char_translate, user_name, 
-                            char_img_path, poem, poem_eng)  # , media_url)
+            # 写入字典的同时更新进程内的知识库快照，之后生成的字不会再用到这个编码
+            accept_char(char, char_3dim, char_translate, user_name,
+                        char_img_path, poem, poem_eng)  # , media_url)
             return jsonify({'status': 'success'})
         else:
             return jsonify({'status': 'error', 'message': 'Missing character data'}), 400
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 409
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -0,0 +1,198 @@
+"""
+进程内 LRU 缓存与多进程共享的持久化键值存储
+
+LRUCache 是线程安全的有界内存缓存；SqliteStore 是基于 SQLite（WAL 模式）的
+磁盘存储，多个 gunicorn worker 可以同时读写同一个文件。两者组合成两级缓存：
+先查内存，再查磁盘，都没有时才计算，计算结果写回两级。
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存，超过 maxsize 时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize=1024):
+        if maxsize <= 0:
+            raise ValueError(f"LRU 缓存容量必须为正数: {maxsize}")
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 条目集合每变化一次（新增或淘汰）递增，调用方可据此判断派生数据是否过期
+        self.version = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            else:
+                self.version += 1
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.version += 1
+
+    __setitem__ = put
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        # 返回快照，迭代期间其他线程的写入不会导致 RuntimeError
+        with self._lock:
+            return iter(list(self._data))
+
+    def items(self):
+        """(键, 值) 列表的快照，按最近使用从旧到新排列，不影响 LRU 顺序和命中统计"""
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            if self._data:
+                self.version += 1
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+class SqliteStore:
+    """
+    基于 SQLite 的持久化键值存储（键为字符串，值为 bytes）。
+    使用 WAL 模式和 busy_timeout，多进程并发读写安全；每个线程使用独立的连接。
+    指定 max_bytes 时，值的总大小超过上限后按写入时间从旧到新淘汰；
+    指定 ttl（秒）时，超过有效期的条目视为不存在，并在淘汰时删除。
+    """
+
+    # 每写入这么多次检查一次总大小
+    _EVICT_CHECK_INTERVAL = 32
+
+    def __init__(self, path, table='cache', busy_timeout_ms=5000, max_bytes=None, ttl=None):
+        self.path = path
+        self.table = table
+        self.busy_timeout_ms = busy_timeout_ms
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} '
+                '(key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)'
+            )
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at)')
+
+    def _connect(self):
+        # fork 之后不能沿用父进程的连接，按进程号区分
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _oldest_valid(self):
+        # 有效期内最早的写入时间；没有设置 ttl 时所有条目都有效
+        return time.time() - self.ttl if self.ttl is not None else float('-inf')
+
+    def get(self, key, default=None):
+        row = self._connect().execute(f'SELECT value FROM {self.table} WHERE key = ? AND created_at >= ?',
+                                      (key, self._oldest_valid())).fetchone()
+        return default if row is None else row[0]
+
+    def get_many(self, keys):
+        """返回 {键: 值}，只包含存在的键"""
+        keys = list(keys)
+        found = {}
+        conn = self._connect()
+        # SQLite 对单条语句的参数个数有限制，分批查询
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = conn.execute(f'SELECT key, value FROM {self.table} WHERE key IN ({placeholders}) AND created_at >= ?',
+                                batch + [self._oldest_valid()])
+            found.update(rows)
+        return found
+
+    def put(self, key, value, replace=False):
+        """写入一个条目；replace=False 时已存在的键保持不变（先写入者为准）"""
+        self.put_many([(key, value)], replace=replace)
+
+    def put_many(self, items, replace=False):
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                f'{verb} INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)',
+                [(key, value, now) for key, value in items],
+            )
+        if self.max_bytes is not None or self.ttl is not None:
+            self._writes += 1
+            if self._writes % self._EVICT_CHECK_INTERVAL == 1:
+                self.evict()
+
+    def evict(self):
+        """
+        删除过期的条目；总大小仍超过 max_bytes 时再删除最早写入的条目，
+        直到降到上限的 90%。返回删除的条目数
+        """
+        conn = self._connect()
+        expired = 0
+        if self.ttl is not None:
+            with conn:
+                expired = conn.execute(f'DELETE FROM {self.table} WHERE created_at < ?', (self._oldest_valid(),)).rowcount
+        total = conn.execute(f'SELECT COALESCE(SUM(LENGTH(value)), 0) FROM {self.table}').fetchone()[0]
+        if self.max_bytes is None or total <= self.max_bytes:
+            return expired
+        excess = total - int(self.max_bytes * 0.9)
+        doomed = []
+        for key, size in conn.execute(f'SELECT key, LENGTH(value) FROM {self.table} ORDER BY created_at'):
+            if excess <= 0:
+                break
+            doomed.append((key,))
+            excess -= size
+        with conn:
+            conn.executemany(f'DELETE FROM {self.table} WHERE key = ?', doomed)
+        return expired + len(doomed)
+
+    def __contains__(self, key):
+        return self._connect().execute(f'SELECT 1 FROM {self.table} WHERE key = ? AND created_at >= ?',
+                                       (key, self._oldest_valid())).fetchone() is not None
+
+    def __len__(self):
+        return self._connect().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
@@ -0,0 +1,154 @@
+"""
+离线的单字英文释义表
+
+/generate_char 中每个猜测的字都要翻译成英文，以前每个字都要请求一次翻译服务。
+这里预先为 knowledge_base/chinese_list.txt 中的每个字生成一个英文释义，保存为
+带版本的 JSON（Config.CHAR_GLOSS_PATH），运行时单字翻译直接查表，
+只有表中没有的字和整句诗才需要联网。
+
+构建时按批请求翻译服务（先 googletrans 批量，失败时用大模型一次翻译一批），
+已有的释义会保留，中途失败后重新运行只补齐缺失的字。
+
+命令行用法：
+    python char_gloss.py            # 补齐缺失的字
+    python char_gloss.py --force    # 全部重新生成
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from ai_clients import google_translate, zhipu_chat
+from config import Config
+
+# 释义表格式版本，修改文件结构时需要递增
+CHAR_GLOSS_VERSION = 1
+
+CHINESE_LIST_PATH = 'knowledge_base/chinese_list.txt'
+
+
+def read_chinese_list(path=CHINESE_LIST_PATH):
+    """chinese_list.txt 中的字（去重、去掉空白），保持原有顺序"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [char for char in dict.fromkeys(f.read()) if not char.isspace()]
+
+
+def chinese_list_digest(path=CHINESE_LIST_PATH):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_char_gloss(path=None):
+    """读取释义表，返回 {字: 英文释义}；文件不存在、损坏或版本不符时返回空字典"""
+    path = path or Config.CHAR_GLOSS_PATH
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            table = json.load(f)
+    except Exception as e:
+        logging.warning(f"单字释义表读取失败: {e}")
+        return {}
+    if table.get('version') != CHAR_GLOSS_VERSION:
+        logging.warning(f"单字释义表版本不兼容: {table.get('version')}")
+        return {}
+    return table['glosses']
+
+
+def save_char_gloss(glosses, path=None, digest=None):
+    """原子地写入释义表"""
+    path = path or Config.CHAR_GLOSS_PATH
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': CHAR_GLOSS_VERSION, 'chinese_list': digest or chinese_list_digest(),
+                   'glosses': glosses}, f, ensure_ascii=False, indent=0)
+    os.replace(tmp_path, path)
+
+
+def _clean_gloss(text):
+    # 统一为小写、去掉首尾空白和标点
+    return text.strip().strip('.,;:!?"\'。，').lower()
+
+
+def _gloss_batch_google(chars):
+    results = google_translate(list(chars), 'zh-cn', 'en')
+    if not isinstance(results, list) or len(results) != len(chars):
+        raise ValueError("googletrans 批量翻译返回的数量不一致")
+    return [result.text for result in results]
+
+
+def _gloss_batch_llm(chars):
+    prompt = ("请给出以下每个汉字最常用的英文释义（一个单词或很短的词组）。输入是一个 JSON 数组，"
+              "请返回同样长度、同样顺序的 JSON 数组，不要其他内容：\n"
+              f"{json.dumps(list(chars), ensure_ascii=False)}")
+    completion = zhipu_chat(
+        model=Config.LLM_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=20 * len(chars) + 100,
+    )
+    content = completion.choices[0].message.content.strip()
+    content = content[content.find('['):content.rfind(']') + 1]
+    glosses = json.loads(content)
+    if not isinstance(glosses, list) or len(glosses) != len(chars):
+        raise ValueError("大模型批量翻译返回的数量不一致")
+    return [str(gloss) for gloss in glosses]
+
+
+def build_char_gloss(path=None, batch_size=100, force=False):
+    """为 chinese_list 中缺少释义的字生成释义并写入释义表，返回 (已有释义数, 总字数)"""
+    path = path or Config.CHAR_GLOSS_PATH
+    chars = read_chinese_list()
+    digest = chinese_list_digest()
+    glosses = {} if force else load_char_gloss(path)
+    missing = [char for char in chars if not glosses.get(char)]
+    logging.info(f"单字释义：共 {len(chars)} 个字，需要生成 {len(missing)} 个")
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        for backend, batch_fn in (('google', _gloss_batch_google), ('zhipu', _gloss_batch_llm)):
+            try:
+                results = batch_fn(batch)
+            except Exception as e:
+                logging.warning(f"第 {start // batch_size + 1} 批释义生成失败（{backend}）: {e}")
+                continue
+            for char, gloss in zip(batch, results):
+                gloss = _clean_gloss(gloss)
+                # 翻译服务原样返回汉字时视为失败，留待下次补齐
+                if gloss and gloss != char:
+                    glosses[char] = gloss
+            break
+        # 每批写入一次，中途失败时已生成的释义不会丢失
+        save_char_gloss(glosses, path, digest)
+
+    done = sum(1 for char in chars if glosses.get(char))
+    logging.info(f"单字释义表构建完成：{done}/{len(chars)}")
+    return done, len(chars)
+
+
+_char_gloss = None
+_char_gloss_lock = threading.Lock()
+
+
+def get_char_gloss(char):
+    """单字的英文释义，表中没有时返回 None"""
+    global _char_gloss
+    if _char_gloss is None:
+        with _char_gloss_lock:
+            if _char_gloss is None:
+                _char_gloss = load_char_gloss()
+                logging.info(f"单字释义表已加载：{len(_char_gloss)} 个字")
+    return _char_gloss.get(char)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='为 chinese_list.txt 中的字生成离线英文释义表')
+    parser.add_argument('--force', action='store_true', help='忽略已有释义全部重新生成')
+    parser.add_argument('--batch-size', type=int, default=100, help='每次请求翻译的字数')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    done, total = build_char_gloss(batch_size=args.batch_size, force=args.force)
+    print(f"{Config.CHAR_GLOSS_PATH}: {done}/{total} 个字有释义")
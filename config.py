@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 # 基础配置
 class Config:
@@ -10,6 +11,77 @@ class Config:
     # MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
     ALLOWED_EXTENSIONS = {'mp4', 'webm', 'jpg', 'jpeg', 'png'}
     DICTIONARY_PATH = 'knowledge_tmp/simple.pkl'
+    GLYPH_RESERVATION_TTL = 24 * 3600  # 生成后未被确认加入字典的字，其字形编码保留的时间（秒）
+    WORD_CLUSTERS_PATH = 'knowledge_base/word_clusters.pkl'  # 预先计算的词向量聚类结果
+    WORD_VECTORS_NPY_PATH = 'knowledge_base/word_vectors.npy'         # 内存映射的词向量矩阵（float32）
+    WORD_VECTORS_KEYS_PATH = 'knowledge_base/word_vectors_keys.json'  # 矩阵每一行对应的字
+    OOV_CACHE_PATH = 'knowledge_base/oov_vectors.sqlite3'  # chinese_list 以外的字的词向量（持久化，多进程共享）
+    OOV_MEMORY_CACHE_SIZE = int(os.getenv('OOV_MEMORY_CACHE_SIZE', '2048'))  # 内存中保留的新字向量数量
+    OOV_BATCH_SIZE = 64  # 批量计算新字向量时每次前向计算的字数
+    # 词向量聚类引擎: agglomerative（精确，O(n²)）/ knn_graph / minibatch_kmeans
+    CLUSTER_ENGINE = os.getenv('CLUSTER_ENGINE', 'agglomerative')
+    CLUSTER_DISTANCE_THRESHOLD = 0.2   # agglomerative / knn_graph / minibatch_kmeans（分区内细分）的距离阈值
+    CLUSTER_KNN_NEIGHBORS = 10         # knn_graph 每个字保留的近邻数
+    POEM_STORE_DIR = 'knowledge_base/poem_store'  # 只追加的诗歌存储（诗句、翻译、句向量）
+    # 是否把 create_new_poem 成功生成的诗追加到诗歌存储，供之后的 find_similar 检索
+    POEM_STORE_APPEND_ACCEPTED = os.getenv('POEM_STORE_APPEND_ACCEPTED', 'false').lower() == 'true'
+    EMBED_BATCH_SIZE = 16          # vectorize_texts 每次前向计算的最大文本数
+    # 是否把并发请求的文本向量化合并为一批（进程内微批处理）
+    EMBED_MICRO_BATCH = os.getenv('EMBED_MICRO_BATCH', 'false').lower() == 'true'
+    EMBED_MICRO_BATCH_WAIT_MS = 5  # 微批处理收集请求的最长等待时间
+    EMBED_CACHE_SIZE = 1024        # 内存中缓存的文本向量数量
+    # 文本向量的磁盘缓存（多个 worker 共享，按总大小淘汰）
+    EMBED_CACHE_DISK = os.getenv('EMBED_CACHE_DISK', 'false').lower() == 'true'
+    EMBED_CACHE_PATH = 'knowledge_base/embedding_cache.sqlite3'
+    EMBED_CACHE_DISK_MAX_MB = 256
+    # translate_text 的持久化缓存（SQLite，多个 worker 共享）
+    TRANSLATION_CACHE = os.getenv('TRANSLATION_CACHE', 'true').lower() == 'true'
+    TRANSLATION_CACHE_PATH = 'knowledge_base/translation_cache.sqlite3'
+    TRANSLATION_CACHE_TTL_DAYS = 30    # 翻译条目的有效期
+    TRANSLATION_CACHE_MAX_MB = 64      # 超过该大小时淘汰最早的条目
+    # 外部服务客户端与熔断器
+    GOOGLE_TRANSLATE_TIMEOUT = 5       # googletrans 单次请求超时（秒）
+    ZHIPU_TIMEOUT = 60                 # 智谱 AI 单次请求超时（秒）
+    ZHIPU_MAX_CONNECTIONS = 20         # 智谱 AI 连接池大小
+    # 同一台机器上所有 worker 共享的智谱 AI 限流
+    ZHIPU_RATE_PER_SECOND = float(os.getenv('ZHIPU_RATE_PER_SECOND', '5'))   # 每秒允许的调用数
+    ZHIPU_BURST = int(os.getenv('ZHIPU_BURST', '10'))                         # 令牌桶容量（允许的突发调用数）
+    ZHIPU_MAX_IN_FLIGHT = int(os.getenv('ZHIPU_MAX_IN_FLIGHT', '8'))          # 同时进行的调用数上限
+    RATE_LIMIT_DIR = os.getenv('RATE_LIMIT_DIR', os.path.join(tempfile.gettempdir(), 'ai_nvshu_ratelimit'))
+    # 合并同时进行的相同 AI 调用（进程内 + 同一台机器上的其他 worker）
+    SINGLE_FLIGHT = os.getenv('SINGLE_FLIGHT', 'true').lower() == 'true'
+    SINGLE_FLIGHT_DIR = os.getenv('SINGLE_FLIGHT_DIR', os.path.join(tempfile.gettempdir(), 'ai_nvshu_singleflight'))
+    SINGLE_FLIGHT_RESULT_TTL = 60      # 结果文件保留的时间（秒），只用于交给正在等待的 worker
+    # 流式接口的最终结果保存在服务端，客户端凭 result_id 通过 /save_stream_result 写入 session
+    STREAM_RESULT_PATH = os.getenv('STREAM_RESULT_PATH', os.path.join(tempfile.gettempdir(), 'ai_nvshu_stream_results.sqlite3'))
+    STREAM_RESULT_TTL = 600            # 结果保留的时间（秒）
+    BREAKER_FAILURE_THRESHOLD = 3      # 连续失败多少次后熔断
+    BREAKER_COOLDOWN = 30              # 熔断后跳过该后端的时间（秒）
+    # 外部服务调用的重试策略（full jitter 退避）和每个请求的截止时间
+    RETRY_MAX_ATTEMPTS = 3             # 最多调用次数（含第一次）
+    RETRY_BASE_DELAY = 0.5             # 退避基数（秒），第 n 次重试前等待 [0, 基数·2^n] 中的随机时间
+    RETRY_MAX_DELAY = 4                # 单次退避的上限（秒）
+    RETRY_MIN_ATTEMPT_SECONDS = 0.5    # 估计单次调用耗时的下限，剩余时间不够时不再重试
+    REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', '90'))  # 每个请求的截止时间（秒）
+    # /__stats/* 统计接口暴露内部状态（包括上游的错误信息），默认只在调试模式下可用
+    STATS_ENDPOINTS = os.getenv('STATS_ENDPOINTS', 'false').lower() == 'true'
+    # 对冲翻译：googletrans 超过近期延迟的分位数仍未返回时同时请求智谱 AI
+    TRANSLATE_HEDGE = os.getenv('TRANSLATE_HEDGE', 'false').lower() == 'true'
+    TRANSLATE_HEDGE_PERCENTILE = 95    # 用 googletrans 近期延迟的该分位数作为对冲等待时间
+    TRANSLATE_HEDGE_DELAY_MS = 300     # 延迟样本不足时的对冲等待时间（毫秒）
+    # create_new_poem 每次请求生成的候选诗数量；大于 1 时一次请求多首，在本地挑选格式正确的
+    POEM_CANDIDATES = int(os.getenv('POEM_CANDIDATES', '1'))
+    CHAR_GLOSS_PATH = 'knowledge_base/char_gloss.json'  # 单字英文释义表（python char_gloss.py 生成）
+    TRANSLATE_MANY_DEADLINE = 15   # translate_many 的整体时限（秒），超时的条目使用本地兜底
+    TRANSLATE_MAX_WORKERS = 8      # translate_many 逐条并发翻译的线程数
+    # 诗歌检索索引: exact（精确）/ ivf（纯 NumPy 倒排索引）/ hnsw（需要 hnswlib）
+    POEM_INDEX = os.getenv('POEM_INDEX', 'exact')
+    POEM_INDEX_MIN_SIZE = 50000    # 诗歌少于该数量时始终使用精确检索
+    POEM_INDEX_PATH = 'knowledge_base/poem_index'  # 索引文件前缀，后缀为索引类型
+    # 已保存的索引缺失或过期时是否在后台线程中构建（否则只能通过 python poem_index.py build 构建）
+    POEM_INDEX_BACKGROUND_BUILD = os.getenv('POEM_INDEX_BACKGROUND_BUILD', 'true').lower() == 'true'
+    POEM_INDEX_NPROBE = 16         # ivf 查询时检查的桶数
+    POEM_INDEX_HNSW_EF = 64        # hnsw 查询时的候选集大小
     OUTPUT_DIR = os.path.join(UPLOAD_FOLDER, 'output_frames')     # 帧输出目录
     MAX_FRAMES = 5                 # 最大截取帧数
     PROMPT = "请客观地描述一下你看到的内容，用亲眼所见的口吻来描述，直接说你看见了什么。请以 I see 开头，不要使用 video, picture, photo, scene 或者 camera 之类的字眼，大概100 字。" # 图像分析提示词
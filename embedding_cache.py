@@ -0,0 +1,78 @@
+"""
+文本向量的结果缓存
+
+同一段视频描述经常多次到达 find_similar（刷新页面、think.js 重试、演示用的固定描述），
+每次都要完整地跑一遍 BERT。这里以 (模型标识, 文本) 的 SHA-256 为键缓存向量：
+内存中是 LRU，可选的磁盘层（SQLite）按总大小淘汰，并在多个 worker 之间共享。
+模型标识是键的一部分，更换模型后旧的条目自然不再命中。
+"""
+
+import hashlib
+import threading
+
+import numpy as np
+
+from cache_store import LRUCache, SqliteStore
+
+
+class EmbeddingCache:
+    def __init__(self, model_id, memory_size=1024, disk_path=None, disk_max_bytes=None):
+        self.model_id = model_id
+        self._memory = LRUCache(memory_size)
+        self._disk = SqliteStore(disk_path, table='embeddings', max_bytes=disk_max_bytes) if disk_path else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return hashlib.sha256(f'{self.model_id}\0{text}'.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        """返回 {下标: 向量}，只包含命中的文本"""
+        keys = [self.key(text) for text in texts]
+        found = {}
+        missing = []
+        for i, key in enumerate(keys):
+            vector = self._memory.get(key)
+            if vector is None:
+                missing.append(i)
+            else:
+                found[i] = vector
+        disk_found = 0
+        if missing and self._disk is not None:
+            stored = self._disk.get_many({keys[i] for i in missing})
+            for i in missing:
+                if keys[i] in stored:
+                    vector = np.frombuffer(stored[keys[i]], dtype=np.float32)
+                    self._memory.put(keys[i], vector)
+                    found[i] = vector
+                    disk_found += 1
+        with self._lock:
+            self.hits += len(found) - disk_found
+            self.disk_hits += disk_found
+            self.misses += len(texts) - len(found)
+        return found
+
+    def put_many(self, texts, vectors):
+        items = []
+        for text, vector in zip(texts, vectors):
+            vector = np.ascontiguousarray(vector, dtype=np.float32)
+            key = self.key(text)
+            self._memory.put(key, vector)
+            items.append((key, vector.tobytes()))
+        if self._disk is not None and items:
+            self._disk.put_many(items, replace=True)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'model': self.model_id,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_size': len(self._memory),
+                'disk_enabled': self._disk is not None,
+            }
@@ -0,0 +1,115 @@
+"""
+女书字形编码（char_3dim）的分配
+
+每个 EL 字由三个女书部件上下拼接而成，每个部件编号 0-23，
+共 24³ = 13824 种组合。GlyphCodeSpace 记录哪些组合已被占用，
+并在常数时间内给出离目标编码最近的空闲编码。
+"""
+
+import numpy as np
+
+GLYPH_BASE = 24                      # 每一维的部件数量（knowledge_base/nvshu_comp 下 0-23.png）
+GLYPH_SPACE_SIZE = GLYPH_BASE ** 3   # 所有可能的三维编码数量
+
+# 查找最近空闲编码时每批检查的偏移量个数
+_OFFSET_CHUNK = 512
+_offsets = None
+
+
+class GlyphCodeSpaceFull(RuntimeError):
+    """所有 24³ 个字形编码都已被占用"""
+
+
+def encode_char_3dim(char_3dim):
+    """[a, b, c] -> 0..13823 的整数，可用作字典键或文件名"""
+    a, b, c = (int(x) for x in char_3dim)
+    if not all(0 <= x < GLYPH_BASE for x in (a, b, c)):
+        raise ValueError(f"字形编码超出范围 0-{GLYPH_BASE - 1}: {list(char_3dim)}")
+    return (a * GLYPH_BASE + b) * GLYPH_BASE + c
+
+
+def decode_char_3dim(code):
+    """encode_char_3dim 的逆运算，返回 [a, b, c]"""
+    code = int(code)
+    if not 0 <= code < GLYPH_SPACE_SIZE:
+        raise ValueError(f"字形编码超出范围 0-{GLYPH_SPACE_SIZE - 1}: {code}")
+    return [code // (GLYPH_BASE * GLYPH_BASE), code // GLYPH_BASE % GLYPH_BASE, code % GLYPH_BASE]
+
+
+def _sorted_offsets():
+    """三维偏移量 (da, db, dc)，按欧氏距离从近到远排序（距离相同时按字典序）"""
+    global _offsets
+    if _offsets is None:
+        r = np.arange(-(GLYPH_BASE - 1), GLYPH_BASE)
+        grid = np.stack(np.meshgrid(r, r, r, indexing='ij'), axis=-1).reshape(-1, 3)
+        order = np.argsort((grid ** 2).sum(axis=1), kind='stable')
+        _offsets = grid[order]
+    return _offsets
+
+
+class GlyphCodeSpace:
+    """
+    字形编码占用表；同一编码可以被计数多次（兼容历史数据中的重复编码）。
+    parent 为只读快照的占用表时，parent 中的编码同样视为已占用，本表只记录新增部分。
+    """
+
+    def __init__(self, codes=(), parent=None):
+        self._counts = np.zeros(GLYPH_SPACE_SIZE, dtype=np.int32)
+        self._parent = parent
+        self._occupied = 0  # 本表独有（parent 中没有）的已占用编码数
+        for char_3dim in codes:
+            self.add(char_3dim)
+
+    def _in_parent(self, code):
+        return self._parent is not None and self._parent._taken(code)
+
+    def _taken(self, codes):
+        """codes（整数或整数数组）是否已被占用"""
+        taken = self._counts[codes] > 0
+        if self._parent is not None:
+            taken = taken | self._parent._taken(codes)
+        return taken
+
+    def add(self, char_3dim):
+        code = encode_char_3dim(char_3dim)
+        if self._counts[code] == 0 and not self._in_parent(code):
+            self._occupied += 1
+        self._counts[code] += 1
+
+    def discard(self, char_3dim):
+        code = encode_char_3dim(char_3dim)
+        if self._counts[code] > 0:
+            self._counts[code] -= 1
+            if self._counts[code] == 0 and not self._in_parent(code):
+                self._occupied -= 1
+
+    def __contains__(self, char_3dim):
+        return bool(self._taken(encode_char_3dim(char_3dim)))
+
+    def __len__(self):
+        return self._occupied + (len(self._parent) if self._parent is not None else 0)
+
+    def is_full(self):
+        return len(self) >= GLYPH_SPACE_SIZE
+
+    def nearest_free(self, char_3dim):
+        """
+        返回离 char_3dim 最近（欧氏距离）的空闲编码，char_3dim 本身空闲时原样返回。
+        编码空间已满时抛出 GlyphCodeSpaceFull。
+        """
+        target = np.asarray([int(x) for x in char_3dim])
+        if not self._taken(encode_char_3dim(target)):
+            return target.tolist()
+        if self.is_full():
+            raise GlyphCodeSpaceFull(f"女书字形编码已全部占用（{GLYPH_SPACE_SIZE} 个），无法再生成新字")
+
+        # 空间不满时，最近的几批偏移量里几乎总能找到空位
+        offsets = _sorted_offsets()
+        for start in range(0, len(offsets), _OFFSET_CHUNK):
+            candidates = target + offsets[start:start + _OFFSET_CHUNK]
+            candidates = candidates[((candidates >= 0) & (candidates < GLYPH_BASE)).all(axis=1)]
+            codes = (candidates[:, 0] * GLYPH_BASE + candidates[:, 1]) * GLYPH_BASE + candidates[:, 2]
+            free = np.flatnonzero(~self._taken(codes))
+            if len(free):
+                return candidates[free[0]].tolist()
+        raise GlyphCodeSpaceFull(f"女书字形编码已全部占用（{GLYPH_SPACE_SIZE} 个），无法再生成新字")
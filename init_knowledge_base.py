@@ -191,9 +191,10 @@ for key in list(EL_mappings.keys()):  # 使用 list() 创建键的副本，因
     if key in punctuations:
         del EL_mappings[key]
 
-save_dict_to_file(EL_mappings, f'{tmp_dir}/EL_vectors.pkl')
-save_dict_to_file(word_vectors, f'{tmp_dir}/word_vectors.pkl')
-save_dict_to_file(machine_A.knowledge.simple_el_dict, f'{tmp_dir}/simple.pkl')
+save_dict_to_file(dict(EL_mappings), f'{tmp_dir}/EL_vectors.pkl')
+# word_vectors 是带锁和数据库连接的管理器，不能直接 pickle，保存为普通字典
+save_dict_to_file({k: np.asarray(v) for k, v in word_vectors.items()}, f'{tmp_dir}/word_vectors.pkl')
+save_dict_to_file(dict(machine_A.knowledge.simple_el_dict), f'{tmp_dir}/simple.pkl')
 
 
 EL_mappings_ = load_dict_from_file(f'{consolidated_dir}/EL_vectors.pkl')
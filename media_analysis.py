@@ -9,7 +9,8 @@ from io import BytesIO
 from config import Config
 from process_video import convert_webm_to_mp4
 from dotenv import load_dotenv
-from zhipuai import ZhipuAI
+from ai_clients import zhipu_chat, zhipu_chat_stream
+from retry_policy import default_policy
 from logging_config import get_optimized_logger
 
 # 配置日志
@@ -17,8 +18,6 @@ logger = get_optimized_logger(__name__)
 
 # 加载 .env 文件中的环境变量
 load_dotenv()
-ZHIPU_API_KEY = os.getenv('ZHIPU_API_KEY')
-nvshu_ai = ZhipuAI(api_key=ZHIPU_API_KEY)
 
 
 class MediaAnalyzer:
@@ -71,45 +70,42 @@ class MediaAnalyzer:
         image.save(buffered, format="JPEG")
         return base64.b64encode(buffered.getvalue()).decode('utf-8')
     
+    def image_messages(self, base64_image):
+        """图像分析请求的消息"""
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": Config.PROMPT,
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}"
+                        }
+                    }
+                ]
+            }
+        ]
+
     def analyze_frame(self, image):
-        max_retries = 2
-        retry_count = 0
         base64_image = self.encode_image_to_base64(image)
-        while retry_count <= max_retries:
-            try:
-                completion = nvshu_ai.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": Config.PROMPT,
-                                },
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64_image}"
-                                    }
-                                }
-                            ]
-                        }
-                    ],
-                    max_tokens=512,
-                )
-                # return completion.choices[0].message['content']
-                return completion.choices[0].message.content
-            except Exception as e:
-                retry_count += 1
-                if retry_count <= max_retries:
-                    print(f"API调用出错: {e}")
-                    continue
-                else:
-                    print(f"API调用最终失败: {str(e)}")
-                    raise
-            
-    
+        try:
+            # 统一的重试策略：只重试网络错误和 5xx，熔断中或到截止时间时立即失败
+            completion = default_policy.call(
+                zhipu_chat,
+                model=self.model,
+                messages=self.image_messages(base64_image),
+                max_tokens=512,
+            )
+        except Exception as e:
+            print(f"API调用最终失败: {str(e)}")
+            raise
+        # return completion.choices[0].message['content']
+        return completion.choices[0].message.content
+
     def analyze_video(self, video_path):
         """
         分析整个视频内容
@@ -119,30 +115,58 @@ class MediaAnalyzer:
             video_path = os.path.normpath(video_path)
             print(f"处理视频路径: {video_path}")
             
-            # 1. webm to mp4
-            if video_path.lower().endswith('.webm'):
-                # 如果是 webm 格式，先转换为 mp4
-                mp4_path = convert_webm_to_mp4(video_path)
-                if mp4_path is None:
-                    raise Exception("WebM 转 MP4 失败")
-                video_path = mp4_path
-                print(f"转换后的视频路径: {video_path}")
-            
-            # 2. 抽取关键帧
-            frames, frame_paths = self.extract_key_frames(video_path)
-            if not frames:
-                raise Exception("无法从视频中抽取关键帧")
-            
-            # 3. 分析每一帧，并返回关键帧路径
-            for i, frame in enumerate(frames):
-                if i == int(Config.MAX_FRAMES) // 2:
-                    analysis = self.analyze_frame(frame)
-                    # 返回分析结果和关键帧路径
-                    keyframe_path = frame_paths[i] if i < len(frame_paths) else None
-                    return analysis, keyframe_path
+            # 1-3. 转换格式、抽取关键帧，分析中间的一帧
+            frame, keyframe_path = self.select_key_frame(video_path)
+            analysis = self.analyze_frame(frame)
+            # 返回分析结果和关键帧路径
+            return analysis, keyframe_path
         except Exception as e:
             print(f"视频分析出错: {str(e)}")
             raise
+
+    def select_key_frame(self, video_path):
+        """
+        转换格式并抽取关键帧，返回用于分析的中间一帧及其路径
+        """
+        # 1. webm to mp4
+        if video_path.lower().endswith('.webm'):
+            # 如果是 webm 格式，先转换为 mp4
+            mp4_path = convert_webm_to_mp4(video_path)
+            if mp4_path is None:
+                raise Exception("WebM 转 MP4 失败")
+            video_path = mp4_path
+            print(f"转换后的视频路径: {video_path}")
+
+        # 2. 抽取关键帧
+        frames, frame_paths = self.extract_key_frames(video_path)
+        if not frames:
+            raise Exception("无法从视频中抽取关键帧")
+
+        # 3. 取中间的一帧
+        i = int(Config.MAX_FRAMES) // 2
+        if i >= len(frames):
+            raise Exception(f"视频只抽取到 {len(frames)} 帧，无法取第 {i} 帧")
+        keyframe_path = frame_paths[i] if i < len(frame_paths) else None
+        return frames[i], keyframe_path
+
+    def stream_media(self, media_path):
+        """
+        流式分析媒体，返回 (逐段产出描述文本的生成器, 关键帧路径)
+        """
+        if self.media_type == 'video':
+            frame, keyframe_path = self.select_key_frame(os.path.normpath(media_path))
+            base64_image = self.encode_image_to_base64(frame)
+        elif self.media_type == 'image':
+            base64_image, keyframe_path = self.encode_image_file_to_base64(media_path), None
+        else:
+            raise ValueError(f"不支持的媒体类型: {self.media_type}")
+        chunks = zhipu_chat_stream(
+            model=self.model,
+            messages=self.image_messages(base64_image),
+            max_tokens=512,
+        )
+        return chunks, keyframe_path
+
     def analyze_media(self, media_path):
         if self.media_type == 'video':
             return self.analyze_video(media_path)
@@ -152,7 +176,10 @@ class MediaAnalyzer:
             raise ValueError(f"不支持的媒体类型: {self.media_type}")
         
     
-    def analyse_image(self, image_path):
+    def encode_image_file_to_base64(self, image_path):
+        """
+        读取图像文件，转换为 JPEG 并编码为 base64 字符串
+        """
         # 1. 打开图像文件
         with Image.open(image_path) as img:
             # 2. 如果是 PNG 格式，转换为 JPEG（必须去除 alpha 通道）
@@ -165,28 +192,17 @@ class MediaAnalyzer:
             buffer.seek(0)
 
             # 4. 编码为 base64 字符串
-            base64_image = base64.b64encode(buffer.read()).decode('utf-8')
+            return base64.b64encode(buffer.read()).decode('utf-8')
+
+    def analyse_image(self, image_path):
+        # 1-4. 读取图像并编码为 base64 字符串
+        base64_image = self.encode_image_file_to_base64(image_path)
 
-        # 5. 发送到 nvshu_ai 模型接口
-        completion = nvshu_ai.chat.completions.create(
+        # 5. 发送到智谱 AI 模型接口
+        completion = default_policy.call(
+            zhipu_chat,
             model=self.model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": Config.PROMPT,
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
+            messages=self.image_messages(base64_image),
             max_tokens=512,
         )
 
@@ -0,0 +1,129 @@
+"""
+进程内的微批处理调度器
+
+多个线程并发提交单条输入时，调度线程最多等待 max_wait_ms 毫秒（或凑满 max_batch_size 条），
+把这段时间内到达的输入合并成一批调用一次批处理函数，再把结果分发回各个调用方。
+用于 BERT 推理：在只有 CPU 的机器上，一次 N 条的前向计算远快于 N 次单条计算。
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from retry_policy import DeadlineExceeded, timeout_within
+
+
+class MicroBatcher:
+    def __init__(self, batch_fn, max_batch_size=16, max_wait_ms=5, name='micro-batcher'):
+        """batch_fn 接收输入列表，返回等长的结果列表"""
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        # 统计
+        self._batches = 0
+        self._items = 0
+        self._max_batch = 0
+        self._batch_sizes = {}  # 批大小 -> 次数
+        self._wait_seconds = 0.0
+
+    def _ensure_worker(self):
+        # gunicorn 在 fork 之后不会带上父进程的线程，按进程号判断是否需要重新启动；
+        # 调度线程意外退出时也重新启动，队列中已有的输入由新线程继续处理
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        """提交一条输入，返回 Future"""
+        thread = self._thread
+        if self._pid != os.getpid() or thread is None or not thread.is_alive():
+            self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future, time.monotonic()))
+        return future
+
+    def __call__(self, item, timeout=None):
+        """
+        提交一条输入并等待结果。等待时间不超过 timeout 和当前请求的剩余时间，
+        超时则取消尚未开始计算的输入并抛出 DeadlineExceeded
+        """
+        timeout = timeout_within(timeout)
+        future = self.submit(item)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            if future.done() and not future.cancelled():
+                # 批处理函数自己抛出了 TimeoutError，或者恰好在超时之后完成
+                return future.result()
+            future.cancel()
+            raise DeadlineExceeded(f"{self.name} 等待批处理结果超时（{timeout:.1f}s）")
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            now = time.monotonic()
+            # 调用方已经超时取消的输入不再计算；之后 Future 不能再被取消
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if batch:
+                self._run_batch(batch, now)
+
+    def _run_batch(self, batch, now):
+        items = [item for item, _, _ in batch]
+        futures = [future for _, future, _ in batch]
+        try:
+            results = self.batch_fn(items)
+            if len(results) != len(futures):
+                raise ValueError(f"{self.name} 的批处理函数返回了 {len(results)} 个结果，输入为 {len(futures)} 个")
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        except BaseException as e:
+            # 任何失败都要让等待中的调用方返回；BaseException 之后调度线程退出，下次提交时重新启动
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            with self._lock:
+                self._batches += 1
+                self._items += len(batch)
+                self._max_batch = max(self._max_batch, len(batch))
+                self._batch_sizes[len(batch)] = self._batch_sizes.get(len(batch), 0) + 1
+                self._wait_seconds += sum(now - submitted for _, _, submitted in batch)
+
+    def stats(self):
+        """队列深度和批大小统计"""
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'batches': self._batches,
+                'items': self._items,
+                'mean_batch_size': self._items / self._batches if self._batches else 0.0,
+                'max_batch_size': self._max_batch,
+                'batch_size_histogram': dict(sorted(self._batch_sizes.items())),
+                'mean_wait_ms': self._wait_seconds * 1000 / self._items if self._items else 0.0,
+            }
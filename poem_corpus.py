@@ -0,0 +1,141 @@
+"""
+常驻内存的女书诗歌语料
+
+find_similar 需要诗句（中英文）和对应的 BERT 句向量，它们保存在只追加的
+poem_store 中。这里每个进程只读取一次，并预先把句向量按行做 L2 归一化，
+查询时一次矩阵-向量乘积就得到所有余弦相似度，再用 argpartition 取前 k 个；
+语料很大时可以改用 poem_index 中的近似索引。
+存储变化（manifest 修改时间变化）时自动重新加载，原有语料文件被编辑时先重新导入存储；
+只是追加了新分段时，只归一化新增的行并把它们补充进索引。
+近似索引尚未构建时先用精确检索，索引文件由命令行或后台线程写入后再切换过去。
+"""
+
+import logging
+import threading
+
+import numpy as np
+
+from poem_index import ExactIndex, index_stamp, load_index, normalize_rows, uses_ann
+from poem_store import get_poem_store
+
+
+class PoemCorpus:
+    """诗句、英文翻译和归一化后的句向量矩阵，存储变化时自动重新加载"""
+
+    def __init__(self, store=None):
+        self._store = store
+        # (诗句, 英文翻译, 归一化句向量, 检索索引) 整体替换，查询时不会读到新旧混合的数据
+        embeddings = np.empty((0, 0), dtype=np.float32)
+        self._snapshot = ([], [], embeddings, ExactIndex(embeddings))
+        self._segments = []
+        self._mtime = None
+        # 应该使用近似索引却退回了精确检索时为 True，记录当时索引文件的状态
+        self._awaiting_index = False
+        self._index_stamp = None
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = get_poem_store()
+        return self._store
+
+    def _load(self):
+        # 在读取索引之前取得索引文件的状态，之后才写入的索引不会被漏掉
+        stamp = index_stamp()
+        manifest = self.store.read_manifest()
+        segments = [segment['file'] for segment in manifest['segments']]
+        try:
+            poems, poems_eng, raw = self.store.load()
+        except FileNotFoundError:
+            # 读取期间恰好发生了压缩，旧分段已被删除，重新读取一次
+            manifest = self.store.read_manifest()
+            segments = [segment['file'] for segment in manifest['segments']]
+            poems, poems_eng, raw = self.store.load()
+
+        _, _, old_embeddings, old_index = self._snapshot
+        n_old = len(old_embeddings)
+        if self._segments and segments[:len(self._segments)] == self._segments and n_old <= len(raw):
+            # 只追加了新分段：已有的行不变，只归一化新行，索引增量补充
+            embeddings = np.concatenate([old_embeddings, normalize_rows(raw[n_old:])])
+            index = old_index.extended(embeddings)
+            if isinstance(index, ExactIndex):
+                # 语料可能已经超过使用近似索引的阈值
+                index = load_index(embeddings)
+        else:
+            embeddings = normalize_rows(raw)
+            index = load_index(embeddings)
+        self._publish(poems, poems_eng, embeddings, index, stamp)
+        self._segments = segments
+
+    def _publish(self, poems, poems_eng, embeddings, index, stamp):
+        self._awaiting_index = isinstance(index, ExactIndex) and uses_ann(len(embeddings))
+        self._index_stamp = stamp
+        self._snapshot = (poems, poems_eng, embeddings, index)
+
+    def _refresh_index(self):
+        """退回精确检索之后，索引文件被写入（命令行或后台构建完成）时加载近似索引"""
+        if not self._awaiting_index or index_stamp() == self._index_stamp:
+            return
+        with self._lock:
+            stamp = index_stamp()
+            if self._awaiting_index and stamp != self._index_stamp:
+                poems, poems_eng, embeddings, _ = self._snapshot
+                index = load_index(embeddings)
+                self._publish(poems, poems_eng, embeddings, index, stamp)
+                if not isinstance(index, ExactIndex):
+                    logging.info(f"诗歌检索切换到 {index.name} 索引：{len(embeddings)} 首")
+
+    @property
+    def poems(self):
+        return self._snapshot[0]
+
+    @property
+    def poems_eng(self):
+        return self._snapshot[1]
+
+    @property
+    def embeddings(self):
+        return self._snapshot[2]
+
+    def refresh(self):
+        """存储发生变化（或尚未加载）时重新加载，返回是否发生了重新加载"""
+        # 原有语料文件被编辑时先重新导入存储
+        self.store.sync_legacy()
+        mtime = self.store.manifest_mtime()
+        if mtime == self._mtime:
+            self._refresh_index()
+            return False
+        with self._lock:
+            if mtime != self._mtime:
+                self._load()
+                self._mtime = mtime
+                logging.info(f"诗歌语料已加载：{len(self.poems)} 首")
+                return True
+        return False
+
+    def most_similar(self, query_embedding, n=3, skip=1):
+        """
+        与 query_embedding 余弦相似度最高的 n 首诗，返回 (中文诗句列表, 英文翻译列表, 下标)。
+        默认跳过第 0 行，与原来的 find_most_similar_texts 一致。
+        """
+        self.refresh()
+        poems, poems_eng, _, index = self._snapshot
+        query = normalize_rows(np.reshape(query_embedding, (1, -1)))[0]
+        indices = index.search(query, n + skip)
+        # 跳过前 skip 行；hnsw 索引原地更新，可能返回本快照之后追加的行
+        indices = indices[(indices >= skip) & (indices < len(poems))][:n]
+        return [poems[i] for i in indices], [poems_eng[i] for i in indices], indices
+
+
+_poem_corpus = None
+_poem_corpus_lock = threading.Lock()
+
+
+def get_poem_corpus():
+    """进程内共享的诗歌语料"""
+    global _poem_corpus
+    with _poem_corpus_lock:
+        if _poem_corpus is None:
+            _poem_corpus = PoemCorpus()
+        return _poem_corpus
@@ -0,0 +1,429 @@
+"""
+诗歌句向量的近似最近邻（ANN）索引
+
+语料只有几百首诗时，PoemCorpus 直接做精确的暴力检索；用户生成和导入的诗歌达到
+数十万首时，可以切换到近似索引：
+    ivf   纯 NumPy 的倒排索引（IVF-Flat）：用 k-means 把句向量分到 nlist 个桶，
+          查询时只在最近的 nprobe 个桶里做精确的内积计算
+    hnsw  使用可选依赖 hnswlib（pip install hnswlib），未安装时不可用
+
+所有索引都假设句向量已经 L2 归一化，内积即余弦相似度。
+由 Config.POEM_INDEX（环境变量 POEM_INDEX）选择，语料少于 Config.POEM_INDEX_MIN_SIZE
+时始终使用精确检索。构建大索引需要几分钟，不在请求中进行：已保存的索引缺失或过期时
+先使用精确检索，由命令行或后台线程（Config.POEM_INDEX_BACKGROUND_BUILD）构建。
+
+命令行用法：
+    python poem_index.py build --backend ivf       # 构建并保存索引
+    python poem_index.py bench --backend ivf --synthetic 200000
+                                                   # 与精确检索比较 recall@k 和延迟
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from config import Config
+
+try:
+    import hnswlib
+except ImportError:  # 可选依赖
+    hnswlib = None
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只在进程内避免重复构建
+    fcntl = None
+
+# 索引文件的格式版本，修改索引结构时需要递增
+POEM_INDEX_VERSION = 2
+
+
+def normalize_rows(matrix):
+    """按行 L2 归一化为连续的 float32 矩阵，零向量保持为零"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(matrix / norms)
+
+
+def top_k_indices(scores, k):
+    """
+    scores 中最大的 k 个的下标（从大到小），用 argpartition 避免完整排序。
+    分数相同时下标较大的在前（即稳定排序下的 np.argsort(...)[-k:][::-1]）。
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.arange(len(scores)) if k == len(scores) else np.sort(np.argpartition(scores, len(scores) - k)[-k:])
+    return top[np.argsort(scores[top], kind='stable')[::-1]]
+
+
+def embeddings_fingerprint(embeddings):
+    """
+    句向量矩阵的指纹。语料只追加，因此已保存的索引只要与当前矩阵的前 rows 行一致
+    就仍然可用，新增的行在加载后补充进索引
+    """
+    return {
+        'version': POEM_INDEX_VERSION,
+        'rows': len(embeddings),
+        'dim': int(embeddings.shape[1]),
+        'sha1': hashlib.sha1(np.ascontiguousarray(embeddings).tobytes()).hexdigest(),
+    }
+
+
+class ExactIndex:
+    """精确检索：一次矩阵-向量乘积"""
+
+    name = 'exact'
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def search(self, query, k):
+        """返回与 query 内积最大的 k 行的下标（从大到小）"""
+        return top_k_indices(self.embeddings @ query, k)
+
+    def extended(self, embeddings):
+        """embeddings 是在原矩阵之后追加了新行的矩阵，返回覆盖所有行的索引"""
+        return ExactIndex(embeddings)
+
+
+class IVFIndex:
+    """
+    倒排索引（IVF-Flat），桶内保存原始句向量，按桶连续存放。
+    构建之后追加的行不重新分桶，放在 extra 中，每次查询都精确计算；
+    extra 较多时重新构建索引（python poem_index.py build）。
+    """
+
+    name = 'ivf'
+
+    def __init__(self, centroids, order, offsets, vectors, extra=None, nprobe=None):
+        self.centroids = centroids  # (nlist, dim)，已归一化
+        self.order = order          # 按桶排列后的第 i 行对应原矩阵的行号
+        self.offsets = offsets      # 第 j 个桶占 order[offsets[j]:offsets[j + 1]]
+        self.vectors = vectors      # 按桶排列的句向量
+        self.n_indexed = len(order)
+        # 构建之后追加的行，行号从 n_indexed 开始
+        self.extra = extra if extra is not None else np.empty((0, vectors.shape[1]), dtype=np.float32)
+        self.nprobe = nprobe or Config.POEM_INDEX_NPROBE
+
+    @classmethod
+    def build(cls, embeddings, nlist=None):
+        from sklearn.cluster import MiniBatchKMeans
+
+        n = len(embeddings)
+        # 常用的经验值：桶数约为 4·√n
+        nlist = min(n, nlist or max(1, int(4 * np.sqrt(n))))
+        kmeans = MiniBatchKMeans(n_clusters=nlist, batch_size=4096, n_init=1, random_state=0)
+        # 聚类中心只用一部分样本训练，再把所有句向量分配到最近的桶
+        rng = np.random.default_rng(0)
+        sample = embeddings if n <= 64 * nlist else embeddings[rng.choice(n, 64 * nlist, replace=False)]
+        kmeans.fit(sample)
+        labels = kmeans.predict(embeddings)
+        centroids = normalize_rows(kmeans.cluster_centers_)
+
+        order = np.argsort(labels, kind='stable')
+        offsets = np.searchsorted(labels[order], np.arange(nlist + 1))
+        return cls(centroids, order, offsets, np.ascontiguousarray(embeddings[order]))
+
+    def search(self, query, k):
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(self.centroids @ query, len(self.centroids) - nprobe)[-nprobe:]
+        # 每个桶是连续的一段，直接切片计算，不需要按行号收集
+        spans = [(self.offsets[j], self.offsets[j + 1]) for j in probes]
+        scores = np.concatenate([self.vectors[a:b] @ query for a, b in spans] + [self.extra @ query])
+        ids = np.concatenate([self.order[a:b] for a, b in spans]
+                             + [np.arange(self.n_indexed, self.n_indexed + len(self.extra))])
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp)
+        top = np.argpartition(scores, len(scores) - k)[-k:]
+        # 按分数从大到小，分数相同时原行号较大的在前，与精确检索一致
+        return ids[top[np.lexsort((ids[top], scores[top]))[::-1]]]
+
+    def extended(self, embeddings):
+        """embeddings 是在原矩阵之后追加了新行的矩阵，返回覆盖所有行的索引（本索引不变）"""
+        if len(embeddings) - self.n_indexed > max(1000, self.n_indexed // 10):
+            logging.warning(f"ivf 索引之后追加了 {len(embeddings) - self.n_indexed} 条，建议重新构建索引")
+        return IVFIndex(self.centroids, self.order, self.offsets, self.vectors,
+                        np.ascontiguousarray(embeddings[self.n_indexed:]), self.nprobe)
+
+    def save(self, path, fingerprint):
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                 fingerprint=json.dumps(fingerprint))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, embeddings, fingerprint):
+        with np.load(path) as data:
+            if json.loads(str(data['fingerprint'])) != fingerprint:
+                return None
+            order = data['order']
+            return cls(data['centroids'], order, data['offsets'], np.ascontiguousarray(embeddings[order]))
+
+
+class HNSWIndex:
+    """
+    基于 hnswlib 的 HNSW 图索引。
+    追加新行时图原地扩展，多个快照共享同一个 hnswlib 索引；hnswlib 不支持
+    resize_index/add_items 与 knn_query 并发执行，因此查询和扩展共用一把锁串行化。
+    """
+
+    name = 'hnsw'
+
+    def __init__(self, index, lock=None):
+        self.index = index
+        if lock is None:
+            self.index.set_ef(Config.POEM_INDEX_HNSW_EF)
+        self._lock = lock or threading.Lock()
+        # 本快照覆盖的行数
+        self.count = index.get_current_count()
+
+    @classmethod
+    def build(cls, embeddings):
+        if hnswlib is None:
+            raise RuntimeError("未安装 hnswlib，无法使用 hnsw 索引（pip install hnswlib）")
+        index = hnswlib.Index(space='ip', dim=embeddings.shape[1])
+        index.init_index(max_elements=len(embeddings), M=16, ef_construction=200, random_seed=0)
+        index.add_items(embeddings, np.arange(len(embeddings)))
+        return cls(index)
+
+    def search(self, query, k):
+        k = min(k, self.count)
+        with self._lock:
+            labels, _ = self.index.knn_query(query, k=k)
+        return labels[0].astype(np.intp)
+
+    def extended(self, embeddings):
+        """
+        把追加的新行插入图中，返回覆盖所有行的新快照。图是共享的，
+        旧快照可能查到超出其范围的行号，调用方需要过滤。
+        """
+        with self._lock:
+            start = self.index.get_current_count()
+            if len(embeddings) > start:
+                self.index.resize_index(len(embeddings))
+                self.index.add_items(embeddings[start:], np.arange(start, len(embeddings)))
+        return HNSWIndex(self.index, self._lock)
+
+    def save(self, path, fingerprint):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with self._lock:
+            self.index.save_index(tmp_path)
+        os.replace(tmp_path, path)
+        # 指纹最后写入：读到新指纹时索引文件一定已经替换完成
+        tmp_path = f'{path}.json.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(fingerprint, f)
+        os.replace(tmp_path, f'{path}.json')
+
+    @classmethod
+    def load(cls, path, embeddings, fingerprint):
+        if hnswlib is None:
+            raise RuntimeError("未安装 hnswlib，无法使用 hnsw 索引（pip install hnswlib）")
+        with open(f'{path}.json', 'r', encoding='utf-8') as f:
+            if json.load(f) != fingerprint:
+                return None
+        index = hnswlib.Index(space='ip', dim=embeddings.shape[1])
+        index.load_index(path, max_elements=len(embeddings))
+        return cls(index)
+
+
+POEM_INDEX_BACKENDS = {
+    'exact': ExactIndex,
+    'ivf': IVFIndex,
+    'hnsw': HNSWIndex,
+}
+
+
+def index_path(backend):
+    suffix = {'ivf': '.npz', 'hnsw': '.bin'}[backend]
+    return f'{Config.POEM_INDEX_PATH}_{backend}{suffix}'
+
+
+def uses_ann(n, backend=None):
+    """n 条语料是否应该使用近似索引"""
+    backend = backend or Config.POEM_INDEX
+    return backend != 'exact' and n >= Config.POEM_INDEX_MIN_SIZE
+
+
+def index_stamp(backend=None):
+    """已保存索引的 (修改时间, 大小)，用于发现命令行或其他进程新构建的索引；不存在时返回 None"""
+    path = index_path(backend or Config.POEM_INDEX)
+    try:
+        # hnsw 的指纹文件在索引文件之后写入
+        stat = os.stat(path if path.endswith('.npz') else f'{path}.json')
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def build_index(embeddings, backend, save=True):
+    """构建指定类型的索引，save=True 时保存到 Config.POEM_INDEX_PATH"""
+    if backend not in POEM_INDEX_BACKENDS:
+        raise ValueError(f"未知的索引类型: {backend}，可选: {', '.join(POEM_INDEX_BACKENDS)}")
+    if backend == 'exact':
+        return ExactIndex(embeddings)
+    index = POEM_INDEX_BACKENDS[backend].build(embeddings)
+    if save:
+        index.save(index_path(backend), embeddings_fingerprint(embeddings))
+    return index
+
+
+def _saved_fingerprint(path):
+    """已保存索引的指纹，不存在或无法读取时返回 None"""
+    try:
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                return json.loads(str(data['fingerprint']))
+        with open(f'{path}.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+_building = set()
+_building_lock = threading.Lock()
+
+
+def _build_and_save(embeddings, backend, lock_file):
+    start = time.perf_counter()
+    try:
+        build_index(embeddings, backend)
+        logging.info(f"{backend} 诗歌索引后台构建完成：{len(embeddings)} 条，耗时 {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        logging.error(f"{backend} 诗歌索引后台构建失败: {e}")
+    finally:
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        with _building_lock:
+            _building.discard(backend)
+
+
+def build_in_background(embeddings, backend):
+    """
+    在后台线程中构建并保存索引，返回是否启动了构建。
+    同一台机器上同时只有一个进程构建（非阻塞文件锁），其他进程在索引文件更新后加载它。
+    """
+    with _building_lock:
+        if backend in _building:
+            return False
+        lock_file = None
+        if fcntl:
+            lock_file = open(f'{index_path(backend)}.lock', 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+        _building.add(backend)
+    threading.Thread(target=_build_and_save, args=(embeddings, backend, lock_file),
+                     name=f'poem-index-{backend}', daemon=True).start()
+    return True
+
+
+def load_index(embeddings, backend=None):
+    """
+    为归一化的句向量矩阵选择检索索引：语料较小或 backend 为 exact 时使用精确检索；
+    否则读取已保存的索引（并补充之后追加的行）。已保存的索引缺失或过期时不在这里构建，
+    记录警告并退回精确检索（按配置在后台构建）。
+    """
+    backend = backend or Config.POEM_INDEX
+    if backend not in POEM_INDEX_BACKENDS:
+        raise ValueError(f"未知的索引类型: {backend}，可选: {', '.join(POEM_INDEX_BACKENDS)}")
+    if not uses_ann(len(embeddings), backend):
+        return ExactIndex(embeddings)
+
+    path = index_path(backend)
+    saved = _saved_fingerprint(path)
+    if saved is not None and saved.get('version') == POEM_INDEX_VERSION and saved['rows'] <= len(embeddings):
+        try:
+            # 已保存的索引只覆盖前 rows 行时，加载后再补充新增的行
+            prefix = embeddings[:saved['rows']]
+            if embeddings_fingerprint(prefix) == saved:
+                index = POEM_INDEX_BACKENDS[backend].load(path, prefix, saved)
+                if index is not None:
+                    return index.extended(embeddings) if len(prefix) < len(embeddings) else index
+        except Exception as e:
+            logging.warning(f"诗歌索引读取失败: {e}")
+    if Config.POEM_INDEX_BACKGROUND_BUILD and build_in_background(embeddings, backend):
+        logging.warning(f"{backend} 诗歌索引缺失或已过期，后台构建期间使用精确检索（{len(embeddings)} 条）")
+    else:
+        logging.warning(f"{backend} 诗歌索引缺失或已过期，使用精确检索；"
+                        f"可运行 python poem_index.py build --backend {backend} 构建")
+    return ExactIndex(embeddings)
+
+
+def benchmark(embeddings, index, k=10, n_queries=200, seed=0):
+    """
+    用加噪声的语料向量作为查询，比较 index 与精确检索：
+    返回 recall@k 和两者每次查询的平均延迟（毫秒）
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(len(embeddings), size=n_queries)
+    dim = embeddings.shape[1]
+    # 噪声的整体范数约为 0.1（句向量已归一化）
+    queries = normalize_rows(embeddings[picks] + rng.normal(0, 0.1 / np.sqrt(dim), (n_queries, dim)))
+
+    report = {'n': len(embeddings), 'k': k}
+    results = {}
+    for name, searcher in (('exact', ExactIndex(embeddings)), ('ann', index)):
+        start = time.perf_counter()
+        results[name] = [searcher.search(q, k) for q in queries]
+        report[f'{name}_ms'] = (time.perf_counter() - start) * 1000 / n_queries
+    hits = sum(len(set(t) & set(r)) for t, r in zip(results['exact'], results['ann']))
+    report['recall'] = hits / sum(len(t) for t in results['exact'])
+    return report
+
+
+def _synthetic_corpus(embeddings, size, seed=0):
+    # 在真实句向量附近采样，模拟大规模语料的分布
+    rng = np.random.default_rng(seed)
+    base = embeddings[rng.integers(len(embeddings), size=size)]
+    # 噪声的整体范数约为 0.3（句向量已归一化）
+    return normalize_rows(base + rng.normal(0, 0.3 / np.sqrt(base.shape[1]), base.shape).astype(np.float32))
+
+
+if __name__ == '__main__':
+    from poem_corpus import get_poem_corpus
+
+    parser = argparse.ArgumentParser(description='构建诗歌句向量索引，或与精确检索比较')
+    parser.add_argument('command', choices=['build', 'bench'])
+    parser.add_argument('--backend', choices=[b for b in POEM_INDEX_BACKENDS if b != 'exact'], default='ivf')
+    parser.add_argument('--k', type=int, default=10, help='bench: 计算 recall@k')
+    parser.add_argument('--queries', type=int, default=200, help='bench: 查询次数')
+    parser.add_argument('--synthetic', type=int, default=None, help='bench: 生成 N 条合成句向量代替真实语料')
+    parser.add_argument('--nprobe', type=int, nargs='*', default=None, help='bench: ivf 依次尝试的 nprobe')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # 这里只需要句向量，不加载（也不在后台构建）已保存的索引
+    Config.POEM_INDEX = 'exact'
+    corpus = get_poem_corpus()
+    corpus.refresh()
+    embeddings = corpus.embeddings
+
+    if args.command == 'build':
+        build_index(embeddings, args.backend)
+        print(f"{index_path(args.backend)}: {len(embeddings)} 条")
+    else:
+        if args.synthetic:
+            embeddings = _synthetic_corpus(embeddings, args.synthetic)
+        start = time.perf_counter()
+        index = build_index(embeddings, args.backend, save=False)
+        print(f"{args.backend} 索引构建耗时 {time.perf_counter() - start:.1f}s，{len(embeddings)} 条")
+        print(f"{'nprobe':>8}{'recall@k':>10}{'exact_ms':>10}{'ann_ms':>10}")
+        # nprobe 只对 ivf 有效
+        for nprobe in (args.nprobe or [Config.POEM_INDEX_NPROBE]) if args.backend == 'ivf' else [None]:
+            if nprobe is not None:
+                index.nprobe = nprobe
+            r = benchmark(embeddings, index, args.k, args.queries)
+            print(f"{nprobe or '-':>8}{r['recall']:>10.3f}{r['exact_ms']:>10.2f}{r['ann_ms']:>10.2f}")
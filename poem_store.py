@@ -0,0 +1,341 @@
+"""
+只追加的诗歌存储（诗句、英文翻译、句向量）
+
+目录结构（Config.POEM_STORE_DIR）：
+    manifest.json       各分段文件及其行数、文本文件名，是存储内容的唯一依据
+    poems_000000.jsonl  每行一首诗 {"poem": ..., "eng": ...}，行顺序与句向量的行顺序一致
+                        （早期创建的存储为 poems.jsonl）
+    seg_000000.npy ...  float32 句向量分段，每次追加写入一个新分段
+
+追加时先写新分段和文本，最后原子地替换 manifest；manifest 之外的残留
+（进程中途退出时写了一半的数据）在读取时被忽略，下次追加或压缩时清理。
+已有的分段从不修改，读取时用内存映射打开。
+
+存储是检索语料的唯一来源。knowledge_base/nvshu_origin_with_eng.txt 和
+knowledge_base/poem_embeddings 仍是人工维护的原有语料：首次使用时导入，
+manifest 中记录两个文件的摘要，之后文件内容变化时重新导入，替换存储中的前
+legacy_rows 行（原有语料），之后追加的诗保留不变。
+
+命令行用法：
+    python poem_store.py info       # 查看分段和诗歌数量
+    python poem_store.py compact    # 把所有分段合并为一个
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from config import Config
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，退化为不加文件锁
+    fcntl = None
+
+# 存储格式版本，修改目录结构时需要递增
+POEM_STORE_VERSION = 1
+
+LEGACY_POEMS_PATH = 'knowledge_base/nvshu_origin_with_eng.txt'
+LEGACY_EMBEDDINGS_PATH = 'knowledge_base/poem_embeddings'
+
+
+def _file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def legacy_fingerprint(poems_path=LEGACY_POEMS_PATH, embeddings_path=LEGACY_EMBEDDINGS_PATH):
+    """原有语料文件的内容摘要，任一文件不存在时返回 None"""
+    if not (os.path.exists(poems_path) and os.path.exists(embeddings_path)):
+        return None
+    return {'poems': _file_digest(poems_path), 'embeddings': _file_digest(embeddings_path)}
+
+
+def read_legacy(poems_path=LEGACY_POEMS_PATH, embeddings_path=LEGACY_EMBEDDINGS_PATH):
+    """读取原来的奇偶行文本和 pickle 句向量，返回 (诗句列表, 英文翻译列表, 句向量)"""
+    poems, poems_eng = [], []
+    with open(poems_path, 'r', encoding='utf-8') as file:
+        for index, line in enumerate(file):
+            # 偶数行是中文诗句，奇数行是英文翻译
+            if index % 2 == 0:
+                poems.append(line.rstrip())
+            else:
+                poems_eng.append(line.rstrip())
+    with open(embeddings_path, 'rb') as f:
+        embeddings = pickle.load(f)
+    n = min(len(poems), len(poems_eng), len(embeddings))
+    if not len(poems) == len(poems_eng) == len(embeddings):
+        logging.warning(f"诗句（{len(poems)}）、翻译（{len(poems_eng)}）、句向量（{len(embeddings)}）数量不一致，只导入前 {n} 首")
+    return poems[:n], poems_eng[:n], np.asarray(embeddings[:n], dtype=np.float32)
+
+
+class PoemStore:
+    def __init__(self, directory=None):
+        self.directory = directory or Config.POEM_STORE_DIR
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        # 上次检查时原有语料文件的 (大小, 修改时间)
+        self._legacy_stat = None
+
+    def texts_path(self, manifest):
+        return os.path.join(self.directory, manifest.get('texts', 'poems.jsonl'))
+
+    # 读取 --------------------
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def manifest_mtime(self):
+        """manifest 的修改时间，每次追加或压缩都会变化，可用于判断是否需要重新加载"""
+        return os.stat(self.manifest_path).st_mtime_ns
+
+    def read_manifest(self):
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != POEM_STORE_VERSION:
+            raise ValueError(f"诗歌存储版本不兼容: {manifest.get('version')}")
+        return manifest
+
+    def load(self):
+        """返回 (诗句列表, 英文翻译列表, 句向量矩阵)，所有分段按顺序拼接"""
+        manifest = self.read_manifest()
+        n_rows = sum(segment['rows'] for segment in manifest['segments'])
+
+        poems, poems_eng = [], []
+        with open(self.texts_path(manifest), 'r', encoding='utf-8') as f:
+            for line in f:
+                if len(poems) == n_rows:
+                    break  # manifest 之外的行属于未完成的追加
+                record = json.loads(line)
+                poems.append(record['poem'])
+                poems_eng.append(record['eng'])
+        if len(poems) != n_rows:
+            raise ValueError(f"诗歌文本只有 {len(poems)} 行，manifest 记录了 {n_rows} 行")
+
+        segments = [np.load(os.path.join(self.directory, segment['file']), mmap_mode='r')
+                    for segment in manifest['segments']]
+        if not segments:
+            embeddings = np.empty((0, manifest['dim']), dtype=np.float32)
+        elif len(segments) == 1:
+            embeddings = segments[0]
+        else:
+            embeddings = np.concatenate(segments)
+        return poems, poems_eng, embeddings
+
+    # 写入 --------------------
+    def _lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, 'manifest.lock'), 'w')
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _unlock(self, lock_file):
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def _write_manifest(self, manifest):
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _write_segment(self, manifest, embeddings):
+        name = f"seg_{manifest['next_segment']:06d}.npy"
+        tmp_path = os.path.join(self.directory, f'{name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, embeddings)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        manifest['next_segment'] += 1
+        return {'file': name, 'rows': len(embeddings)}
+
+    def _truncate_texts(self, texts_path, n_rows):
+        # 去掉上次未完成的追加留下的多余行，保证新行紧接在 manifest 记录的行之后
+        if not os.path.exists(texts_path):
+            open(texts_path, 'w').close()
+            return
+        with open(texts_path, 'r+b') as f:
+            for _ in range(n_rows):
+                if not f.readline():
+                    raise ValueError(f"诗歌文本少于 manifest 记录的 {n_rows} 行")
+            f.truncate()
+
+    def _new_manifest(self, dim):
+        return {'version': POEM_STORE_VERSION, 'dim': dim, 'segments': [], 'next_segment': 0,
+                'texts': 'poems_000000.jsonl'}
+
+    def _append_texts(self, texts_path, poems, poems_eng):
+        with open(texts_path, 'a', encoding='utf-8') as f:
+            for poem, eng in zip(poems, poems_eng):
+                f.write(json.dumps({'poem': poem, 'eng': eng}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, poems, poems_eng, embeddings, if_empty=False):
+        """
+        追加若干首诗；embeddings 的行数必须与 poems 一致，返回追加后的诗歌总数。
+        if_empty=True 时只在存储尚未创建时写入（用于初始导入）。
+        """
+        embeddings = np.ascontiguousarray(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        if not (len(poems) == len(poems_eng) == len(embeddings)):
+            raise ValueError(f"诗句、翻译、句向量数量不一致: {len(poems)}, {len(poems_eng)}, {len(embeddings)}")
+
+        lock_file = self._lock()
+        try:
+            if self.exists():
+                manifest = self.read_manifest()
+                if if_empty:
+                    return sum(segment['rows'] for segment in manifest['segments'])
+            else:
+                manifest = self._new_manifest(embeddings.shape[1])
+            if embeddings.shape[1] != manifest['dim']:
+                raise ValueError(f"句向量维度 {embeddings.shape[1]} 与存储的 {manifest['dim']} 不一致")
+
+            n_rows = sum(segment['rows'] for segment in manifest['segments'])
+            texts_path = self.texts_path(manifest)
+            self._truncate_texts(texts_path, n_rows)
+            if len(poems):
+                manifest['segments'].append(self._write_segment(manifest, embeddings))
+                self._append_texts(texts_path, poems, poems_eng)
+            self._write_manifest(manifest)
+            return n_rows + len(poems)
+        finally:
+            self._unlock(lock_file)
+
+    def compact(self):
+        """把所有分段合并为一个新分段，并删除旧分段和多余的文本行；返回诗歌总数"""
+        lock_file = self._lock()
+        try:
+            poems, poems_eng, embeddings = self.load()
+            manifest = self.read_manifest()
+            old_files = [segment['file'] for segment in manifest['segments']]
+
+            manifest['segments'] = [self._write_segment(manifest, np.ascontiguousarray(embeddings))]
+            self._truncate_texts(self.texts_path(manifest), len(poems))
+            self._write_manifest(manifest)
+            # 已经映射旧分段的进程不受影响（文件的 inode 在关闭前仍然有效）
+            for name in old_files:
+                os.remove(os.path.join(self.directory, name))
+            logging.info(f"诗歌存储压缩完成：{len(poems)} 首，{len(old_files)} 个分段合并为 1 个")
+            return len(poems)
+        finally:
+            self._unlock(lock_file)
+
+    def import_legacy(self, poems_path=LEGACY_POEMS_PATH, embeddings_path=LEGACY_EMBEDDINGS_PATH):
+        """
+        导入原有语料，替换存储中前 legacy_rows 行，之后追加的诗保留在后面；
+        返回诗歌总数。manifest 中记录原有语料文件的摘要。
+        """
+        fingerprint = legacy_fingerprint(poems_path, embeddings_path)
+        poems, poems_eng, embeddings = read_legacy(poems_path, embeddings_path)
+
+        lock_file = self._lock()
+        try:
+            if self.exists():
+                manifest = self.read_manifest()
+                if manifest.get('legacy') == fingerprint:
+                    # 其他 worker 已经导入
+                    return sum(segment['rows'] for segment in manifest['segments'])
+                old_poems, old_eng, old_embeddings = self.load()
+                legacy_rows = manifest.get('legacy_rows', 0)
+                kept = old_poems[legacy_rows:], old_eng[legacy_rows:], np.ascontiguousarray(old_embeddings[legacy_rows:])
+                old_files = [segment['file'] for segment in manifest['segments']] + [manifest.get('texts', 'poems.jsonl')]
+            else:
+                manifest = self._new_manifest(embeddings.shape[1])
+                kept, old_files = ([], [], None), []
+            if embeddings.shape[1] != manifest['dim']:
+                raise ValueError(f"句向量维度 {embeddings.shape[1]} 与存储的 {manifest['dim']} 不一致")
+
+            # 写入新的文本文件和分段，替换 manifest 之后再删除旧文件；
+            # 正在读取旧文件的进程会遇到 FileNotFoundError 并重新读取
+            manifest['texts'] = f"poems_{manifest['next_segment']:06d}.jsonl"
+            texts_path = self.texts_path(manifest)
+            self._truncate_texts(texts_path, 0)
+            manifest['segments'] = [self._write_segment(manifest, embeddings)]
+            self._append_texts(texts_path, poems, poems_eng)
+            if kept[0]:
+                manifest['segments'].append(self._write_segment(manifest, kept[2]))
+                self._append_texts(texts_path, kept[0], kept[1])
+            manifest['legacy'] = fingerprint
+            manifest['legacy_rows'] = len(poems)
+            self._write_manifest(manifest)
+            for name in old_files:
+                if name not in (manifest['texts'], *[segment['file'] for segment in manifest['segments']]):
+                    os.remove(os.path.join(self.directory, name))
+            logging.info(f"原有语料已导入诗歌存储：{len(poems)} 首，保留之后追加的 {len(kept[0])} 首")
+            return len(poems) + len(kept[0])
+        finally:
+            self._unlock(lock_file)
+
+    def sync_legacy(self):
+        """
+        原有语料文件变化时重新导入，返回是否重新导入。先比较文件的大小和修改时间，
+        变化时才计算摘要，因此可以在每次刷新语料时调用
+        """
+        try:
+            stat = [(os.stat(path).st_size, os.stat(path).st_mtime_ns)
+                    for path in (LEGACY_POEMS_PATH, LEGACY_EMBEDDINGS_PATH)]
+        except FileNotFoundError:
+            return False
+        if stat == self._legacy_stat:
+            return False
+        fingerprint = legacy_fingerprint()
+        manifest = self.read_manifest()
+        reimported = False
+        if 'legacy' not in manifest:
+            # 早期的存储没有记录摘要，无法判断是否与文件一致，按当前文件记录
+            logging.warning(f"诗歌存储没有记录原有语料的摘要，假定与 {LEGACY_POEMS_PATH} 一致")
+            self.adopt_legacy(fingerprint, len(read_legacy()[0]))
+        elif manifest['legacy'] != fingerprint:
+            logging.info(f"{LEGACY_POEMS_PATH} 或 {LEGACY_EMBEDDINGS_PATH} 已变化，重新导入原有语料")
+            self.import_legacy()
+            reimported = True
+        self._legacy_stat = stat
+        return reimported
+
+    def adopt_legacy(self, fingerprint, legacy_rows):
+        """为早期创建、没有记录原有语料摘要的存储补充记录，不修改内容"""
+        lock_file = self._lock()
+        try:
+            manifest = self.read_manifest()
+            if 'legacy' not in manifest:
+                manifest['legacy'] = fingerprint
+                manifest['legacy_rows'] = min(legacy_rows, sum(segment['rows'] for segment in manifest['segments']))
+                self._write_manifest(manifest)
+        finally:
+            self._unlock(lock_file)
+
+_poem_store = None
+
+
+def get_poem_store():
+    """默认的诗歌存储；第一次使用时导入原有语料"""
+    global _poem_store
+    if _poem_store is None:
+        store = PoemStore()
+        if not store.exists():
+            logging.info("初始化诗歌存储：导入原有语料")
+            store.import_legacy()
+        store.sync_legacy()
+        _poem_store = store
+    return _poem_store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='诗歌存储的维护命令')
+    parser.add_argument('command', choices=['info', 'compact'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = get_poem_store()
+    if args.command == 'compact':
+        store.compact()
+    manifest = store.read_manifest()
+    rows = sum(segment['rows'] for segment in manifest['segments'])
+    print(f"{store.directory}: {rows} 首诗，{len(manifest['segments'])} 个分段，{manifest['dim']} 维")
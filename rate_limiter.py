@@ -0,0 +1,177 @@
+"""
+同一台机器上所有 worker 共享的限流器
+
+多个 gunicorn worker 各自调用智谱 AI，合起来很容易超过服务商的限流，
+被拒绝后的重试又进一步加重负载。这里用文件锁实现两层限制，所有进程共享：
+    - 令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个，每次调用消耗一个；
+      状态（令牌数、更新时间）保存在一个 16 字节的文件中，读写时加 fcntl 锁；
+    - 并发上限：max_in_flight 个槽位文件，调用期间对其中一个加非阻塞的独占锁，
+      进程异常退出时锁由操作系统自动释放。
+没有 fcntl 的平台（Windows）退化为进程内的实现。
+
+排队等待的时间计入统计，并通过 last_queue_wait() 提供给调用方。
+"""
+
+import contextvars
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from config import Config
+from retry_policy import DeadlineExceeded, remaining
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，退化为进程内的限流
+    fcntl = None
+
+# 没有空闲槽位时的轮询间隔（秒）
+_POLL_INTERVAL = 0.02
+
+_last_wait = contextvars.ContextVar('rate_limiter_last_wait', default=0.0)
+
+
+def last_queue_wait():
+    """当前上下文中最近一次调用在限流器中排队的秒数"""
+    return _last_wait.get()
+
+
+class RateLimiter:
+    def __init__(self, name, rate, burst, max_in_flight, directory=None):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_in_flight = int(max_in_flight)
+        self.directory = directory or Config.RATE_LIMIT_DIR
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 进程内的替代实现（没有 fcntl 时使用）
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._semaphore = threading.BoundedSemaphore(self.max_in_flight)
+        # 统计
+        self._calls = 0
+        self._wait_seconds = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._in_flight = 0
+
+    # 令牌桶 --------------------
+    def _bucket_file(self):
+        # 每个线程、每个进程使用自己的文件描述符
+        f = getattr(self._local, 'bucket', None)
+        if f is None or self._local.pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{self.name}.bucket')
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            f = os.fdopen(fd, 'r+b', buffering=0)
+            self._local.bucket = f
+            self._local.pid = os.getpid()
+        return f
+
+    def _take_token(self):
+        """尝试取一个令牌，成功返回 0，否则返回还需等待的秒数"""
+        now = time.time()
+        if fcntl is None:
+            with self._lock:
+                tokens, updated = self._tokens, self._updated
+                tokens, wait = self._refill(tokens, updated, now)
+                self._tokens, self._updated = tokens, now
+                return wait
+
+        f = self._bucket_file()
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            data = f.read(16)
+            tokens, updated = struct.unpack('dd', data) if len(data) == 16 else (self.burst, now)
+            tokens, wait = self._refill(tokens, updated, now)
+            f.seek(0)
+            f.write(struct.pack('dd', tokens, now))
+            return wait
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refill(self, tokens, updated, now):
+        # 返回 (取令牌后的令牌数, 需要等待的秒数)
+        tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0.0
+        return tokens, (1 - tokens) / self.rate
+
+    # 并发槽位 --------------------
+    def _try_slot(self):
+        """尝试占用一个槽位，成功返回释放函数，否则返回 None"""
+        if fcntl is None:
+            if self._semaphore.acquire(blocking=False):
+                return self._semaphore.release
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        for i in range(self.max_in_flight):
+            fd = os.open(os.path.join(self.directory, f'{self.name}.slot{i}'), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+
+            def release(fd=fd):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            return release
+        return None
+
+    def _sleep(self, seconds, start):
+        # 等待不能超过请求的截止时间
+        left = remaining()
+        if left is not None and left < seconds:
+            with self._lock:
+                self._timeouts += 1
+            raise DeadlineExceeded(f"{self.name} 限流排队 {time.monotonic() - start:.1f} 秒后超过截止时间")
+        time.sleep(seconds)
+
+    @contextmanager
+    def slot(self):
+        """取得令牌和并发槽位后进入 with 块，返回排队等待的秒数"""
+        start = time.monotonic()
+        while True:
+            wait = self._take_token()
+            if wait == 0:
+                break
+            self._sleep(wait, start)
+        while True:
+            release = self._try_slot()
+            if release is not None:
+                break
+            self._sleep(_POLL_INTERVAL, start)
+
+        waited = time.monotonic() - start
+        _last_wait.set(waited)
+        with self._lock:
+            self._calls += 1
+            self._wait_seconds += waited
+            self._max_wait = max(self._max_wait, waited)
+            self._in_flight += 1
+        try:
+            yield waited
+        finally:
+            release()
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self):
+        """本进程的排队统计（令牌桶和槽位是所有进程共享的）"""
+        with self._lock:
+            return {
+                'rate_per_second': self.rate,
+                'burst': self.burst,
+                'max_in_flight': self.max_in_flight,
+                'shared_across_processes': fcntl is not None,
+                'calls': self._calls,
+                'in_flight': self._in_flight,
+                'mean_wait_ms': self._wait_seconds * 1000 / self._calls if self._calls else 0.0,
+                'max_wait_ms': self._max_wait * 1000,
+                'deadline_timeouts': self._timeouts,
+            }
@@ -0,0 +1,145 @@
+"""
+统一的重试与超时策略
+
+以前 retry_on_network_error 对任何异常都按固定的指数间隔重试，analyze_frame 和
+create_new_poem 又各自套了一层重试循环，最坏情况下延迟逐层相乘。这里：
+    - RetryPolicy 使用 full jitter 退避（在 [0, min(上限, 基数·2^n)] 中随机取等待时间），
+      只重试可重试的错误（网络错误、超时、429 和 5xx），请求本身有误或后端熔断时立即失败；
+    - 每个请求有一个截止时间，保存在 contextvar 中，沿调用链向下传递
+      （线程池中的任务需要用 contextvars.copy_context() 提交）；
+    - 剩余时间不足以完成一次“等待 + 调用”时不再开始新的重试。
+"""
+
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from config import Config
+
+# 当前请求的截止时间（time.monotonic() 的值），None 表示不限
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求的截止时间已到"""
+
+
+def set_deadline(seconds):
+    """为当前上下文设置截止时间（不会晚于已有的截止时间），返回用于 reset_deadline 的 token"""
+    current = _deadline.get()
+    new = time.monotonic() + seconds
+    return _deadline.set(new if current is None else min(current, new))
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+@contextmanager
+def deadline(seconds):
+    """在 with 块内限定截止时间"""
+    token = set_deadline(seconds)
+    try:
+        yield
+    finally:
+        reset_deadline(token)
+
+
+def remaining():
+    """距离截止时间的秒数，没有截止时间时返回 None"""
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+
+def timeout_within(default):
+    """不超过剩余时间的超时（秒）；已经超时则抛出 DeadlineExceeded"""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("请求已超过截止时间")
+    return min(default, left) if default is not None else left
+
+
+def is_retryable(error):
+    """网络错误、超时、限流（429）和服务端错误（5xx）可以重试，其他错误直接失败"""
+    from ai_clients import BackendUnavailable
+    if isinstance(error, (BackendUnavailable, DeadlineExceeded)):
+        return False
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # httpx、zhipuai 的网络错误和超时不继承内置的 ConnectionError，按类名判断
+    return any(name in type(error).__name__ for name in ('Timeout', 'Connect', 'Network', 'Transport', 'Protocol'))
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None, retry_on=is_retryable, name='default'):
+        """retry_on(异常) 返回 True 时才重试"""
+        self.max_attempts = max_attempts or Config.RETRY_MAX_ATTEMPTS
+        self.base_delay = base_delay if base_delay is not None else Config.RETRY_BASE_DELAY
+        self.max_delay = max_delay if max_delay is not None else Config.RETRY_MAX_DELAY
+        self.retry_on = retry_on
+        self.name = name
+        self._lock = threading.Lock()
+        # 单次调用耗时的滑动平均，用于判断剩余时间是否够再试一次
+        self._attempt_seconds = Config.RETRY_MIN_ATTEMPT_SECONDS
+        # 统计
+        self._retries = 0
+        self._gave_up_deadline = 0
+
+    def backoff(self, attempt):
+        """第 attempt 次失败后的等待时间（full jitter）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _observe(self, seconds):
+        with self._lock:
+            self._attempt_seconds = 0.8 * self._attempt_seconds + 0.2 * max(seconds, Config.RETRY_MIN_ATTEMPT_SECONDS)
+
+    def call(self, fn, *args, **kwargs):
+        for attempt in range(self.max_attempts):
+            left = remaining()
+            if left is not None and left <= 0:
+                raise DeadlineExceeded(f"{self.name}: 请求已超过截止时间")
+            start = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                self._observe(time.monotonic() - start)
+                if attempt == self.max_attempts - 1 or not self.retry_on(e):
+                    raise
+                delay = self.backoff(attempt)
+                left = remaining()
+                if left is not None and delay + self._attempt_seconds > left:
+                    # 剩余时间不够完成下一次尝试，不再重试
+                    with self._lock:
+                        self._gave_up_deadline += 1
+                    raise
+                with self._lock:
+                    self._retries += 1
+                print(f"{self.name} 第 {attempt + 1} 次调用失败，{delay:.2f} 秒后重试: {e}")
+                time.sleep(delay)
+
+    def __call__(self, func):
+        """作为装饰器使用"""
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            return {
+                'retries': self._retries,
+                'gave_up_for_deadline': self._gave_up_deadline,
+                'attempt_seconds': round(self._attempt_seconds, 3),
+            }
+
+
+# 外部服务调用的默认策略
+default_policy = RetryPolicy(name='外部服务调用')
@@ -0,0 +1,236 @@
+"""
+合并同时进行的相同调用（single-flight）
+
+用户双击或 think.js 重试时，同一个媒体或同一段描述会同时发起多个相同的
+describe_video / find_similar_poems / generate_poem 请求，每个都要单独调用一次大模型。
+这里按 (函数名, 模型, 输入) 的规范化哈希合并：
+    - 进程内：第一个调用者执行，其他调用者等待同一个 Future，共享结果或异常；
+    - 跨 worker：执行者持有 Config.SINGLE_FLIGHT_DIR 下以哈希命名的锁文件，
+      结果以 JSON 写入同名的结果文件；其他 worker 拿不到锁时等待锁释放，
+      读取在自己开始等待之后写入的结果。执行者失败（没有写结果）时由等待者自己执行。
+只合并时间上重叠的调用，不缓存结果；结果文件超过 SINGLE_FLIGHT_RESULT_TTL 秒后删除。
+锁的持有者在释放前删除锁文件，拿到锁的进程确认路径仍指向同一个文件（inode 相同），
+否则重新打开；进程异常退出留下的锁文件在清理结果文件时一并删除。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from config import Config
+from retry_policy import DeadlineExceeded, remaining
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只在进程内合并
+    fcntl = None
+
+# 等待其他 worker 释放锁时的轮询间隔（秒）
+_POLL_INTERVAL = 0.05
+
+
+def flight_key(name, parts):
+    """调用的规范化哈希"""
+    canonical = json.dumps([name, parts], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.directory = directory or Config.SINGLE_FLIGHT_DIR
+        self._lock = threading.Lock()
+        self._calls = {}  # 哈希 -> Future
+        # 统计
+        self._leaders = 0
+        self._coalesced_local = 0
+        self._coalesced_remote = 0
+
+    def do(self, parts, fn):
+        """parts 相同的调用同时只执行一次 fn()，返回其结果"""
+        key = flight_key(self.name, parts)
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self._coalesced_local += 1
+        if not leader:
+            left = remaining()
+            return future.result(timeout=max(0.0, left) if left is not None else None)
+
+        try:
+            result = self._run_shared(key, fn)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    # 跨 worker --------------------
+    def _paths(self, key):
+        return os.path.join(self.directory, f'{key}.lock'), os.path.join(self.directory, f'{key}.json')
+
+    def _run_shared(self, key, fn):
+        if fcntl is None:
+            with self._lock:
+                self._leaders += 1
+            return fn()
+
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        lock_path, result_path = self._paths(key)
+        started = time.time()
+        lock_fd, waited = self._acquire(lock_path)
+        try:
+            if waited:
+                found, result = self._read_result(result_path, started)
+                if found:
+                    with self._lock:
+                        self._coalesced_remote += 1
+                    return result
+            with self._lock:
+                self._leaders += 1
+            result = fn()
+            self._write_result(result_path, result)
+            return result
+        finally:
+            self._release(lock_fd, lock_path)
+
+    def _acquire(self, lock_path):
+        """对锁文件加独占锁，返回 (文件描述符, 是否等待过其他 worker)"""
+        waited = False
+        while True:
+            lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except OSError:
+                        # 其他 worker 正在执行相同的调用
+                        waited = True
+                        left = remaining()
+                        if left is not None and left <= _POLL_INTERVAL:
+                            raise DeadlineExceeded(f"{self.name}: 等待其他 worker 的相同调用时超过截止时间")
+                        time.sleep(_POLL_INTERVAL)
+            except BaseException:
+                os.close(lock_fd)
+                raise
+            if _same_file(lock_fd, lock_path):
+                return lock_fd, waited
+            # 上一个持有者已经删除了这个锁文件，重新打开（关闭时锁自动释放）
+            os.close(lock_fd)
+
+    def _release(self, lock_fd, lock_path):
+        # 持有锁时路径一定指向本文件（只有持有者会删除），先删除再解锁
+        try:
+            os.unlink(lock_path)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+    def _read_result(self, result_path, started):
+        """读取在 started 之后写入的结果，返回 (是否找到, 结果)"""
+        try:
+            if os.stat(result_path).st_mtime < started:
+                return False, None
+            with open(result_path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+            # 大多数调用返回元组，JSON 中保存为列表，读取时还原
+            return True, tuple(payload['value']) if payload['tuple'] else payload['value']
+        except (OSError, ValueError, KeyError):
+            return False, None
+
+    def _write_result(self, result_path, result):
+        try:
+            payload = json.dumps({'tuple': isinstance(result, tuple), 'value': result}, ensure_ascii=False)
+        except (TypeError, ValueError):
+            # 结果不能序列化时不跨 worker 共享，等待者自己执行
+            return
+        tmp_path = f'{result_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, result_path)
+        self._cleanup()
+
+    def _cleanup(self):
+        # 删除过期的结果文件，以及进程异常退出时留下的锁文件
+        cutoff = time.time() - Config.SINGLE_FLIGHT_RESULT_TTL
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                elif entry.name.endswith('.lock') and entry.stat().st_mtime < cutoff:
+                    _remove_stale_lock(entry.path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'executed': self._leaders,
+                'coalesced_in_process': self._coalesced_local,
+                'coalesced_across_workers': self._coalesced_remote,
+            }
+
+
+def _same_file(fd, path):
+    """path 是否仍指向 fd 打开的文件"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(fd)
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+def _remove_stale_lock(path):
+    # 只删除没有被持有的锁文件；加锁后确认路径仍指向同一个文件再删除
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        if _same_file(fd, path):
+            os.unlink(path)
+    finally:
+        os.close(fd)
+
+
+_flights = {}
+
+
+def single_flight(name, key):
+    """
+    装饰器：key(*args, **kwargs) 返回用于判断调用是否相同的输入（需要包含模型名），
+    Config.SINGLE_FLIGHT 关闭时直接调用原函数
+    """
+    flight = _flights.setdefault(name, SingleFlight(name))
+
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not Config.SINGLE_FLIGHT:
+                return func(*args, **kwargs)
+            return flight.do(key(*args, **kwargs), lambda: func(*args, **kwargs))
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.flight = flight
+        return wrapper
+    return decorator
+
+
+def single_flight_stats():
+    return {name: flight.stats() for name, flight in _flights.items()}
@@ -996,6 +996,115 @@ function updateStatusItem(
   }
 }
 
+// 创建描述覆盖层 - 只覆盖中心区域，不影响边缘的轨道媒体；已存在时直接返回
+function createDescriptionOverlay() {
+  let descriptionOverlay = document.getElementById("description-overlay");
+  if (descriptionOverlay) {
+    return descriptionOverlay;
+  }
+  const leftContent = document.getElementById("left-content");
+
+  descriptionOverlay = document.createElement("div");
+  descriptionOverlay.id = "description-overlay";
+  descriptionOverlay.className =
+    "absolute z-20 w-[85%] h-[85%] rounded-full bg-yellow-50 bg-opacity-90 flex-col flex items-center justify-center p-6 text-center";
+  descriptionOverlay.style.top = "7.5%";
+  descriptionOverlay.style.left = "7.5%";
+  descriptionOverlay.innerHTML = `
+            <div class="w-full h-full flex flex-col items-center justify-center space-y-4 px-8 py-6 overflow-y-scroll scrollbar-hide">
+                <div class="text-gray-800 text-lg font-medium leading-relaxed text-center max-w-[90%]">
+                    <div id="chinese-desc" class="description"></div>
+                </div>
+                <div class="w-12 h-px bg-gray-300 opacity-50"></div>
+                <div class="text-gray-600 text-base leading-relaxed text-center max-w-[90%]">
+                    <div id="english-desc" class="description"></div>
+                </div>
+            </div>
+        `;
+
+  // 添加覆盖层到媒体圆形容器
+  const mediaCircle = document.querySelector(
+    '[data-component="media-circle-overlay"]'
+  );
+  if (mediaCircle) {
+    mediaCircle.appendChild(descriptionOverlay);
+  } else {
+    leftContent.appendChild(descriptionOverlay);
+  }
+  return descriptionOverlay;
+}
+
+// 调用 NDJSON 流式接口：每收到一段文本调用 onDelta，返回最后的 done 行。
+// 流式响应开始后服务器无法写 session，结果保存在服务器上，凭 result_id 通过 /save_stream_result 写入
+async function fetchNdjson(url, body, onDelta) {
+  const response = await fetch(url, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify(body),
+  });
+
+  if (!response.ok) {
+    let message = `Server responded with status ${response.status}`;
+    try {
+      const data = await response.json();
+      if (data.error) {
+        message = data.error;
+      }
+    } catch (e) {
+      // 响应不是 JSON，保留状态码信息
+    }
+    throw new Error(message);
+  }
+
+  let result = null;
+  const handleLine = (line) => {
+    if (!line.trim()) {
+      return;
+    }
+    const event = JSON.parse(line);
+    if (event.type === "delta") {
+      onDelta(event.text);
+    } else if (event.type === "error") {
+      throw new Error(event.error);
+    } else if (event.type === "done") {
+      result = event;
+    }
+  };
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split("\n");
+    buffer = lines.pop();
+    lines.forEach(handleLine);
+  }
+  handleLine(buffer + decoder.decode());
+
+  if (!result) {
+    throw new Error("Stream ended without a result");
+  }
+
+  const saveResponse = await fetch("/save_stream_result", {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify({ result_id: result.result_id }),
+  });
+  if (!saveResponse.ok) {
+    throw new Error(`Server responded with status ${saveResponse.status}`);
+  }
+  return result;
+}
+
 async function describeVideo(mediaUrl) {
   // 预先创建所有状态项
   const analyzingItem = addStatusItem(
@@ -1023,22 +1132,15 @@ async function describeVideo(mediaUrl) {
   lastStepTime = Date.now();
 
   try {
-    const response = await fetch("/describe_video", {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify({ media_url: mediaUrl }),
-    });
-
-    if (!response.ok) {
-      throw new Error(`Server responded with status ${response.status}`);
-    }
-
-    const data = await response.json();
-    if (data.error) {
-      throw new Error(data.error);
-    }
+    // 流式接口：英文描述边生成边显示在描述覆盖层中，最后一行是完整结果
+    const data = await fetchNdjson(
+      "/describe_video_stream",
+      { media_url: mediaUrl },
+      (text) => {
+        createDescriptionOverlay();
+        document.getElementById("english-desc").textContent += text;
+      }
+    );
 
     // Update the status item with toggleable content
     const toggleContent = `
@@ -1064,37 +1166,8 @@ async function describeVideo(mediaUrl) {
       toggleContent
     );
 
-    // 2. 展示对媒体内容的描述 - 在中心区域添加描述覆盖层
-    const leftContent = document.getElementById("left-content");
-
-    // 创建描述覆盖层 - 只覆盖中心区域，不影响边缘的轨道媒体
-    const descriptionOverlay = document.createElement("div");
-    descriptionOverlay.id = "description-overlay";
-    descriptionOverlay.className =
-      "absolute z-20 w-[85%] h-[85%] rounded-full bg-yellow-50 bg-opacity-90 flex-col flex items-center justify-center p-6 text-center";
-    descriptionOverlay.style.top = "7.5%";
-    descriptionOverlay.style.left = "7.5%";
-    descriptionOverlay.innerHTML = `
-            <div class="w-full h-full flex flex-col items-center justify-center space-y-4 px-8 py-6 overflow-y-scroll scrollbar-hide">
-                <div class="text-gray-800 text-lg font-medium leading-relaxed text-center max-w-[90%]">
-                    <div id="chinese-desc" class="description"></div>
-                </div>
-                <div class="w-12 h-px bg-gray-300 opacity-50"></div>
-                <div class="text-gray-600 text-base leading-relaxed text-center max-w-[90%]">
-                    <div id="english-desc" class="description"></div>
-                </div>
-            </div>
-        `;
-
-    // 添加覆盖层到媒体圆形容器
-    const mediaCircle = document.querySelector(
-      '[data-component="media-circle-overlay"]'
-    );
-    if (mediaCircle) {
-      mediaCircle.appendChild(descriptionOverlay);
-    } else {
-      leftContent.appendChild(descriptionOverlay);
-    }
+    // 2. 展示对媒体内容的描述 - 在中心区域添加描述覆盖层（流式阶段可能已经创建）
+    createDescriptionOverlay();
 
     // Split both descriptions into lines
     const chineseLines = data.video_desc.split("。");
@@ -1334,21 +1407,25 @@ async function generatePoem(description, poems) {
   lastStepTime = Date.now();
 
   try {
-    const response = await fetch("/generate_poem", {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify({
+    // 流式接口：诗句边生成边显示，最后一行是经过格式校验的完整结果
+    let streamedPoem = "";
+    const data = await fetchNdjson(
+      "/generate_poem_stream",
+      {
         video_description: description,
         similar_poems: poems,
-      }),
-    });
-    const data = await response.json();
-
-    if (data.error) {
-      throw new Error(data.error);
-    }
+      },
+      (text) => {
+        streamedPoem += text;
+        const descriptionOverlay = createDescriptionOverlay();
+        descriptionOverlay.innerHTML = `
+            <div class="w-full h-full flex items-center justify-center p-6">
+                <div id="poem-preview" class="text-gray-800 text-xl leading-relaxed text-center max-w-[85%]"></div>
+            </div>
+        `;
+        document.getElementById("poem-preview").textContent = streamedPoem;
+      }
+    );
 
     // Update the status item with toggleable content
     const toggleContent = `
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def nvshu(monkeypatch):
+    """ai_nvshu_functions 模块；导入时会加载 BERT 和 knowledge_base 下的文件，缺少依赖时跳过"""
+    pytest.importorskip('transformers')
+    pytest.importorskip('torch')
+    monkeypatch.chdir(ROOT)
+    import ai_nvshu_functions
+    return ai_nvshu_functions
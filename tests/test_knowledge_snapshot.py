@@ -0,0 +1,54 @@
+import pytest
+
+
+@pytest.fixture
+def dictionary(nvshu, tmp_path, monkeypatch):
+    """临时的 DICTIONARY_PATH，以及重置后的进程内快照和编码预留"""
+    path = str(tmp_path / 'simple.pkl')
+    nvshu.save_dict_to_file({'江': {'char_3dim': [5, 5, 5], 'char_translate': 'river', 'creator': 'default'}}, path)
+    monkeypatch.setattr(nvshu.Config, 'DICTIONARY_PATH', path)
+    monkeypatch.setattr(nvshu, '_base_knowledge', None)
+    monkeypatch.setattr(nvshu, '_base_stamp', None)
+    monkeypatch.setattr(nvshu, '_reserved_codes', {})
+    return path
+
+
+def _generate(nvshu, char, target):
+    # 与 create_nvshu_from_poem 相同：在请求自己的覆盖层里分配编码，返回前预留
+    knowledge = nvshu.get_base_knowledge().overlay()
+    char_3dim = knowledge.simple_el_dict.codes.nearest_free(target)
+    knowledge.simple_el_dict[char] = {'char_3dim': char_3dim}
+    return nvshu.reserve_char_3dim(char, char_3dim)
+
+
+def test_consecutive_requests_get_distinct_codes(nvshu, dictionary):
+    first = _generate(nvshu, '永', [5, 5, 5])
+    second = _generate(nvshu, '女', [5, 5, 5])
+    assert first != [5, 5, 5]
+    assert second not in ([5, 5, 5], first)
+
+
+def test_accepted_char_is_visible_to_later_requests(nvshu, dictionary):
+    first = _generate(nvshu, '永', [5, 5, 5])
+    nvshu.accept_char('永', first, 'forever')
+    assert '永' in nvshu.get_base_knowledge().simple_el_dict
+    assert nvshu.init_marked_message('江永女')[1] == '女'
+
+    second = _generate(nvshu, '女', first)
+    assert second not in ([5, 5, 5], first)
+    assert nvshu.load_dict_from_file(dictionary)['永']['char_3dim'] == first
+
+
+def test_dictionary_written_by_another_worker_is_reloaded(nvshu, dictionary):
+    nvshu.get_base_knowledge()
+    entries = nvshu.load_dict_from_file(dictionary)
+    entries['书'] = {'char_3dim': [1, 2, 3], 'char_translate': 'book', 'creator': 'default'}
+    nvshu.save_dict_to_file(entries, dictionary)
+
+    assert '书' in nvshu.get_base_knowledge().simple_el_dict
+    assert _generate(nvshu, '女', [1, 2, 3]) != [1, 2, 3]
+
+
+def test_accepting_a_taken_code_is_rejected(nvshu, dictionary):
+    with pytest.raises(ValueError):
+        nvshu.accept_char('女', [5, 5, 5], 'woman')
@@ -0,0 +1,34 @@
+import time
+
+from retry_policy import timeout_within
+
+
+def test_slow_backend_past_deadline_falls_back_and_frees_the_pool(nvshu, monkeypatch):
+    finished = []
+
+    def slow_backend(*args, **kwargs):
+        # 与真实客户端一样：单次请求的超时不超过请求剩余的时间，超时后抛出
+        time.sleep(timeout_within(10))
+        finished.append(time.monotonic())
+        raise TimeoutError("后端响应太慢")
+
+    def failing_batch(*args, **kwargs):
+        raise ValueError("批量翻译不可用")
+
+    monkeypatch.setattr(nvshu, 'get_translation_cache', lambda: None)
+    monkeypatch.setattr(nvshu.Config, 'TRANSLATE_HEDGE', False)
+    monkeypatch.setattr(nvshu, '_translate_batch_google', failing_batch)
+    monkeypatch.setattr(nvshu, '_translate_batch_llm', failing_batch)
+    monkeypatch.setattr(nvshu, 'google_translate', slow_backend)
+    monkeypatch.setattr(nvshu, 'zhipu_chat', slow_backend)
+
+    # 条目比线程池的线程多，逐条翻译会占满线程池
+    texts = ['moon', 'flower'] + [f'word {i}' for i in range(2 * nvshu.Config.TRANSLATE_MAX_WORKERS)]
+    start = time.monotonic()
+    result = nvshu.translate_many(texts, 'en', 'zh-cn', deadline=1.0)
+    assert time.monotonic() - start < 1.5
+    assert result == ['月', '花'] + texts[2:]
+
+    # 已经开始的任务同样在截止时间前后结束，之后的请求不会排在被放弃的任务后面
+    nvshu._translate_executor.submit(lambda: None).result(timeout=1.0)
+    assert finished and max(finished) - start < 1.5
@@ -0,0 +1,92 @@
+"""
+翻译结果的持久化缓存
+
+translate_text 会翻译每一段视频描述、每一首生成的诗、每一个猜测的字和每一句猜测的诗，
+其中 chinese_list 里的单字在不同用户之间反复出现。这里把 (原文, 源语言, 目标语言) -> 译文
+保存在 SQLite（WAL 模式）中，多个 gunicorn worker 共享；前面再加一层进程内 LRU。
+每个条目记录产生它的后端（google / zhipu），条目有有效期，总大小超过上限时淘汰最早的条目。
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from cache_store import LRUCache, SqliteStore
+from config import Config
+
+
+class TranslationCache:
+    def __init__(self, path, ttl=None, max_bytes=None, memory_size=4096):
+        self.ttl = ttl
+        self._disk = SqliteStore(path, table='translations', ttl=ttl, max_bytes=max_bytes)
+        self._memory = LRUCache(memory_size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.backends = {}  # 写入缓存的条目按后端计数
+
+    @staticmethod
+    def key(text, src_language, target_language):
+        return hashlib.sha256(f'{src_language}\0{target_language}\0{text}'.encode('utf-8')).hexdigest()
+
+    def get(self, text, src_language, target_language):
+        """返回 {'translation': ..., 'backend': ...}，未命中时返回 None"""
+        key = self.key(text, src_language, target_language)
+        entry = None
+        cached = self._memory.get(key)
+        # 内存中的条目同样遵守有效期
+        if cached is not None and (self.ttl is None or time.time() - cached[1] < self.ttl):
+            entry = cached[0]
+        else:
+            data = self._disk.get(key)
+            if data is not None:
+                record = json.loads(data)
+                entry = {'translation': record['translation'], 'backend': record['backend']}
+                self._memory.put(key, (entry, record.get('created_at', time.time())))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, text, src_language, target_language, translation, backend):
+        key = self.key(text, src_language, target_language)
+        entry = {'translation': translation, 'backend': backend}
+        now = time.time()
+        self._memory.put(key, (entry, now))
+        record = dict(entry, text=text, src=src_language, dst=target_language, created_at=now)
+        self._disk.put(key, json.dumps(record, ensure_ascii=False).encode('utf-8'), replace=True)
+        with self._lock:
+            self.backends[backend] = self.backends.get(backend, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stored_by_backend': dict(self.backends),
+                'memory_size': len(self._memory),
+            }
+
+
+_translation_cache = None
+_translation_cache_lock = threading.Lock()
+
+
+def get_translation_cache():
+    """进程内共享的翻译缓存；Config.TRANSLATION_CACHE 关闭时返回 None"""
+    global _translation_cache
+    if not Config.TRANSLATION_CACHE:
+        return None
+    with _translation_cache_lock:
+        if _translation_cache is None:
+            _translation_cache = TranslationCache(
+                Config.TRANSLATION_CACHE_PATH,
+                ttl=Config.TRANSLATION_CACHE_TTL_DAYS * 24 * 3600,
+                max_bytes=Config.TRANSLATION_CACHE_MAX_MB * 1024 * 1024,
+            )
+        return _translation_cache
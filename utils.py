@@ -1,10 +1,14 @@
 import random
 import pickle
 import numpy as np
-from sklearn.cluster import AgglomerativeClustering
 import logging
-from sklearn.metrics.pairwise import cosine_similarity
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from sklearn.preprocessing import normalize
 from word_vector_manager import *
+from word_clusters import cluster_word_vectors, get_word_clusters
+from glyph_codes import GlyphCodeSpace, GlyphCodeSpaceFull, encode_char_3dim, decode_char_3dim
 
 def make_chinese_english_pairs(chinese_list, english_list):
     """
@@ -25,11 +29,314 @@ def load_dict_from_file(filename):
         dictionary = pickle.load(f)
     return dictionary
 
+def vector_key(vector):
+    """
+    EL 向量的精确匹配键，用于 O(1) 反查。
+    与 np.array_equal 一致：同值的 list / float32 / float64 向量得到同一个键；
+    标点等字符串映射值直接以自身为键。
+    """
+    if isinstance(vector, str):
+        return vector
+    # 统一转为 float64（float32 -> float64 是精确的），加 0.0 把 -0.0 规整为 0.0
+    array = np.asarray(vector, dtype=np.float64) + 0.0
+    return array.shape, array.tobytes()
+
+
+_MISSING = object()
+
+
+class LayeredMapping(MutableMapping):
+    """
+    可以叠加在只读 base 之上的映射（写时复制）：
+    读取先查本层再查 base，写入和删除只落在本层，base 不受影响。
+    没有 base 时就是一个普通的映射。子类通过 _on_set / _on_delete 维护索引。
+    """
+
+    def __init__(self, data=None, base=None):
+        self._base = base
+        self._data = {} if data is None else data
+        self._deleted = set()  # 本层删除的 base 键
+        self._frozen = False
+        self._size = len(self._data) if base is None else len(base) + sum(1 for k in self._data if k not in base)
+
+    def __getitem__(self, key):
+        if key in self._data:
+            return self._data[key]
+        if self._base is not None and key not in self._deleted:
+            return self._base[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._data:
+            return True
+        return self._base is not None and key not in self._deleted and key in self._base
+
+    def __setitem__(self, key, value):
+        self._check_writable()
+        old = self.get(key, _MISSING)
+        if old is _MISSING:
+            self._size += 1
+        self._data[key] = value
+        self._deleted.discard(key)
+        self._on_set(key, old, value)
+
+    def __delitem__(self, key):
+        self._check_writable()
+        old = self[key]
+        from_layer = key in self._data
+        if from_layer:
+            del self._data[key]
+        if self._base is not None and key in self._base:
+            self._deleted.add(key)
+        self._size -= 1
+        self._on_delete(key, old, from_layer)
+
+    def __iter__(self):
+        # base 的键在前（保持 base 的顺序），本层新增的键在后
+        if self._base is not None:
+            for key in self._base:
+                if key not in self._deleted:
+                    yield key
+        for key in self._data:
+            if self._base is None or key not in self._base:
+                yield key
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def _check_writable(self):
+        if self._frozen:
+            raise TypeError("只读的知识库快照不能修改，请在 overlay() 创建的覆盖层上写入")
+
+    def _on_set(self, key, old, value):
+        pass
+
+    def _on_delete(self, key, old, from_layer):
+        pass
+
+    def freeze(self):
+        """冻结为只读，之后可以安全地被多个线程共享，并作为覆盖层的 base"""
+        self._frozen = True
+        return self
+
+    def layer_changes(self):
+        """本层的写入 {键: 值} 和删除的 base 键集合"""
+        return dict(self._data), set(self._deleted)
+
+
+class KnownMappings(LayeredMapping):
+    """已知映射 {原始字符: EL向量}，同时维护 EL向量 -> 原始字符 的反向索引"""
+
+    def __init__(self, mappings=None, base=None):
+        super().__init__(base=base)
+        self._index = {}  # 本层的 vector_key -> 原始字符，同一向量对应多个字符时保留最早插入的
+        if mappings:
+            self.update(mappings)
+
+    def _on_set(self, key, old, value):
+        if old is not _MISSING:
+            self._unindex(key, old)
+        self._index.setdefault(vector_key(value), key)
+
+    def _on_delete(self, key, old, from_layer):
+        if from_layer:
+            self._unindex(key, old)
+
+    def _unindex(self, key, old):
+        vkey = vector_key(old)
+        if self._index.get(vkey) != key:
+            return
+        del self._index[vkey]
+        # 罕见情况：另一个字符映射到同一向量，按插入顺序接替
+        for other, value in self._data.items():
+            if other != key and vector_key(value) == vkey:
+                self._index[vkey] = other
+                break
+
+    def find_key(self, vector):
+        """返回与 vector 完全相等的 EL 向量所对应的原始字符，没有则返回 None"""
+        if self._base is not None:
+            # base 的键在迭代顺序中更靠前；被本层覆盖或删除的不算
+            key = self._base.find_key(vector)
+            if key is not None and key not in self._data and key not in self._deleted:
+                return key
+        return self._index.get(vector_key(vector))
+
+
+class PendingMappings(list):
+    """待加入的 (原始字符, EL向量) 列表，同时维护 向量 -> 字符 和 字符 -> 向量 的索引"""
+
+    def __init__(self, mappings=()):
+        super().__init__(mappings)
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._by_vector = {}
+        self._by_char = {}
+        for char, vector in self:
+            self._index_mapping(char, vector)
+        self._dirty = False
+
+    def _index_mapping(self, char, vector):
+        # 与线性扫描取第一个匹配项的行为一致，重复项保留最早的
+        self._by_vector.setdefault(vector_key(vector), char)
+        self._by_char.setdefault(char, vector)
+
+    def append(self, mapping):
+        super().append(mapping)
+        if not self._dirty:
+            self._index_mapping(*mapping)
+
+    def find_char(self, vector):
+        """返回 EL 向量对应的原始字符，没有则返回 None"""
+        if self._dirty:
+            self._rebuild_index()
+        return self._by_vector.get(vector_key(vector))
+
+    def find_vector(self, char):
+        """返回原始字符对应的 EL 向量，没有则返回 None"""
+        if self._dirty:
+            self._rebuild_index()
+        return self._by_char.get(char)
+
+    def has_char(self, char):
+        if self._dirty:
+            self._rebuild_index()
+        return char in self._by_char
+
+
+def _invalidating(name):
+    # 除 append 以外的修改操作只标记索引失效，下次查询时重建
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._dirty = True
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ('extend', 'insert', 'pop', 'remove', 'clear', 'sort', 'reverse',
+              '__setitem__', '__delitem__', '__iadd__'):
+    setattr(PendingMappings, _name, _invalidating(_name))
+
+
+def _char_3dim_of(value):
+    # simple_el_dict 的值是 {'char_3dim': [...], ...}，旧格式直接是三维列表
+    char_3dim = value.get('char_3dim', []) if isinstance(value, dict) else value
+    if char_3dim is None or len(char_3dim) != 3:
+        return None
+    return char_3dim
+
+
+class SimpleElDict(LayeredMapping):
+    """
+    简单EL字典 {原始字符: {'char_3dim': [...], ...}}，同时维护字形编码占用表 codes。
+    没有 base 时直接以传入的 dict 作为底层存储，不做拷贝；
+    有 base 时占用表叠加在 base 的占用表之上，base 中的编码始终视为已占用。
+    """
+
+    def __init__(self, data=None, base=None):
+        super().__init__(data, base)
+        self.codes = GlyphCodeSpace(
+            (c for c in map(_char_3dim_of, self._data.values()) if c is not None),
+            parent=None if base is None else base.codes,
+        )
+
+    def _on_set(self, key, old, value):
+        if old is not _MISSING:
+            self._release(old)
+        char_3dim = _char_3dim_of(value)
+        if char_3dim is not None:
+            self.codes.add(char_3dim)
+
+    def _on_delete(self, key, old, from_layer):
+        self._release(old)
+
+    def _release(self, value):
+        # base 中的编码不在本层计数里，discard 对它们没有影响
+        char_3dim = _char_3dim_of(value)
+        if char_3dim is not None:
+            self.codes.discard(char_3dim)
+
+
 class SharedKnowledge:
     def __init__(self):
         self.known_mappings = {}  # 已知的原始字符和EL字向量的映射关系
         self.pending_mappings = []  # 待加入的EL字符
         self.simple_el_dict = {}  # 简单的EL字典，存储降维后的向量
+        self.base = None  # overlay() 创建的覆盖层指向其只读快照
+
+    # 赋值普通的 dict / list 时自动包装为带索引的结构
+    @property
+    def known_mappings(self):
+        return self._known_mappings
+
+    @known_mappings.setter
+    def known_mappings(self, mappings):
+        if not isinstance(mappings, KnownMappings):
+            mappings = KnownMappings(mappings)
+        self._known_mappings = mappings
+
+    @property
+    def pending_mappings(self):
+        return self._pending_mappings
+
+    @pending_mappings.setter
+    def pending_mappings(self, mappings):
+        if not isinstance(mappings, PendingMappings):
+            mappings = PendingMappings(mappings)
+        self._pending_mappings = mappings
+
+    @property
+    def simple_el_dict(self):
+        return self._simple_el_dict
+
+    @simple_el_dict.setter
+    def simple_el_dict(self, el_dict):
+        if not isinstance(el_dict, SimpleElDict):
+            el_dict = SimpleElDict(el_dict)
+        self._simple_el_dict = el_dict
+
+    def freeze(self):
+        """冻结为只读快照，可以在进程内被多个请求/线程共享"""
+        self.known_mappings.freeze()
+        self.simple_el_dict.freeze()
+        return self
+
+    def overlay(self):
+        """
+        在本快照之上创建写时复制的覆盖层：创建代价与快照大小无关，
+        请求中的新映射只写入覆盖层，直到显式调用 promoted() 才会进入新快照。
+        """
+        self.freeze()
+        layer = SharedKnowledge()
+        layer.known_mappings = KnownMappings(base=self.known_mappings)
+        layer.simple_el_dict = SimpleElDict(base=self.simple_el_dict)
+        layer.base = self
+        return layer
+
+    def promoted(self, base=None):
+        """
+        把覆盖层的写入应用到 base（默认是创建它的快照），返回一个新的、已冻结的快照。
+        原快照保持不变，仍在使用它的请求不受影响。
+        """
+        base = base or self.base
+        snapshot = SharedKnowledge()
+        snapshot.known_mappings = _apply_layer(base.known_mappings, self.known_mappings)
+        snapshot.simple_el_dict = _apply_layer(base.simple_el_dict, self.simple_el_dict)
+        return snapshot.freeze()
+
+
+def _apply_layer(base, layer):
+    # 压平为普通 dict 再重建索引，新快照不再依赖旧快照
+    updated, deleted = layer.layer_changes()
+    merged = {k: v for k, v in base.items() if k not in deleted}
+    merged.update(updated)
+    return type(layer)(merged)
 
 
 
@@ -43,7 +350,10 @@ class Machine:
 
         # 初始化 known_mappings
         self.knowledge.known_mappings.update({punctuation: punctuation for punctuation in ['，', '。', '！', '？']})
-        self.word_clusters = self.cluster_word_vectors(word_vectors.vectors)
+        # 聚类结果在知识库构建时计算，进程内所有 Machine 共享同一份
+        clusters = get_word_clusters(list(dict.fromkeys(chinese_list)), word_vectors)
+        self.word_clusters = clusters['word_clusters']
+        self.cluster_members = clusters['cluster_members']
 
     def delete_from_simple_el_dict(self, original_char):
         if original_char in self.knowledge.simple_el_dict:
@@ -54,23 +364,8 @@ class Machine:
         # 使用PCA模型将向量降维
         transformed_vector = self.transform_with_pca(vector)
 
-        # 检查这个向量是否已经在simple_el_dict字典中
-        max_attempts = 20  # 设定最大尝试次数
-        attempts = 0  # 初始化尝试次数计数器
-        
-        # 获取所有现有的3维向量进行比较
-        existing_vectors = []
-        for value in self.knowledge.simple_el_dict.values():
-            if isinstance(value, dict):
-                existing_vectors.append(value.get('char_3dim', []))
-            else:
-                existing_vectors.append(value)
-        
-        while any([np.array_equal(transformed_vector, existing_vector)
-            for existing_vector in existing_vectors]) and attempts < max_attempts:
-                # 如果已经在字典中，直接随机生成一个新的三维向量（每个元素在0-23之间 包括23）
-                transformed_vector = [random.randint(0, 23) for _ in range(3)]
-                attempts += 1
+        # 编码已被占用时取离它最近的空闲编码；24³ 个编码全部用完时抛出 GlyphCodeSpaceFull
+        transformed_vector = self.knowledge.simple_el_dict.codes.nearest_free(transformed_vector)
 
         # 将降维后的向量添加到simple_el_dict字典中，使用新的字典格式
         #print(f"=====end add_to_simple_el_dict=======")
@@ -104,26 +399,13 @@ class Machine:
 
         return integer_vector.tolist()
 
-    def cluster_word_vectors(self, word_vectors):
-        # 将字典形式的词向量转换为矩阵形式
-        vectors_matrix = np.array([vectors for word, vectors in word_vectors.items()])
-
-        # Agglomerative Clustering Cluster BERT 的词向量
-        agglomerative_clustering_model = AgglomerativeClustering(
-            n_clusters=None,
-            # affinity='cosine',
-            linkage='average',
-            distance_threshold=0.2  # 用于根据距离控制簇的数量
-        )
-        labels = agglomerative_clustering_model.fit_predict(vectors_matrix)
-
-        # 创建一个映射关系，关联字符与对应的聚类标签
-        word_clusters = {word: label for (word, _), label in zip(word_vectors.items(), labels)}
-
-        return word_clusters
+    def cluster_word_vectors(self, word_vectors, engine=None):
+        return cluster_word_vectors(word_vectors, engine)
 
     def send_message(self, message):
         # 将一条消息中的一些原始字符替换为EL字符，然后发送这条消息
+        # 先批量取出整句的词向量：不在 chinese_list 中的字只做一次前向计算
+        word_vectors.get_vectors(message)
         el_message, replaced_indices = self.replace_with_el(message)
 
         # 记录替换的位置
@@ -137,8 +419,8 @@ class Machine:
         for i, c in enumerate(message):
             if c in self.knowledge.known_mappings and i in replaced_indices:
                 el_message_vectors.append(self.knowledge.known_mappings[c])
-            elif c in [mapping[0] for mapping in self.knowledge.pending_mappings] and i in replaced_indices:
-                el_char = [mapping[1] for mapping in self.knowledge.pending_mappings if mapping[0] == c][0]
+            elif self.knowledge.pending_mappings.has_char(c) and i in replaced_indices:
+                el_char = self.knowledge.pending_mappings.find_vector(c)
                 el_message_vectors.append(el_char)
             else:
                 el_message_vectors.append(word_vectors.get_vector(c))  # 变更: 设置未被替换的原汉字向量
@@ -151,9 +433,8 @@ class Machine:
 
         # 加入已知EL到原始字符的转换
         for idx, el_char in enumerate(el_message_vectors):
-            # 5/0
-            if any([np.array_equal(el_char, v) for v in self.knowledge.known_mappings.values()]):
-                original_char = [mapping[0] for mapping in self.knowledge.known_mappings.items() if np.array_equal(mapping[1], el_char)][0]
+            original_char = self.knowledge.known_mappings.find_key(el_char)
+            if original_char is not None:
                 message = message[:idx] + original_char + message[idx+1:]
 
         guess_message = self.guess_el(message, el_message_vectors)
@@ -254,10 +535,10 @@ class Machine:
 
         for idx in range(len(guess_message)):
             el_char = el_message_vectors[idx]
-            original_char = [mapping[0] for mapping in self.knowledge.pending_mappings if np.array_equal(mapping[1], el_char)]
+            original_char = self.knowledge.pending_mappings.find_char(el_char)
 
-            # 如果original_char列表非空且猜测不正确
-            if original_char and original_char[0] != guess_message[idx]:
+            # 如果找到了original_char且猜测不正确
+            if original_char is not None and original_char != guess_message[idx]:
                 is_correct = False
                 break
 
@@ -275,7 +556,7 @@ class Machine:
         else:
         # 从pending_mappings中获取正确映射
             correct_char = guess_message[self.replaced_indices[0]]
-            feedback = (correct_char, [mapping[1] for mapping in self.knowledge.pending_mappings if mapping[0] == correct_char][0])
+            feedback = (correct_char, self.knowledge.pending_mappings.find_vector(correct_char))
         return is_correct, feedback  # 依然返回 is_correct 变量的结果及 feedback
 
     def guess_el(self, message, el_message_vectors):
@@ -301,12 +582,11 @@ class Machine:
         if original_char in self.word_clusters.keys():
             cluster_label = self.word_clusters[original_char]  # 获取 original_char 的聚类标签
             # 过滤与 original_char 在同一聚类的词
-            candidate_words = {word for word, label in self.word_clusters.items() if label != cluster_label}
+            candidate_words = set(self.word_clusters) - set(self.cluster_members[cluster_label])
         else:
             candidate_words = {word for word in chinese_list}
 
         # 确保不重复选择已知映射和待定映射中的字符
-        known_mappings_values_set = {tuple(v) for v in self.knowledge.known_mappings.values() if isinstance(v, np.ndarray)} # 将已知映射的值转换为元组并存储在集合中
         candidate_words -= set(self.knowledge.known_mappings.keys())  # 从键中删除已知映射
         candidate_words -= set(mapping[1] for mapping in self.knowledge.pending_mappings if isinstance(mapping[1], str))  # 修改
         candidate_words -= {tuple(mapping[1]) for mapping in self.knowledge.pending_mappings if isinstance(mapping[1], np.ndarray)}  # 修改
@@ -325,13 +605,45 @@ class Machine:
 
 
 
+def _vector_table(dictionary):
+    """
+    Return (keys, matrix, key -> row) for a word-vector dictionary.
+    WordVectorManager reuses its cached contiguous float32 matrix (one
+    consistent snapshot); plain dicts are stacked on the fly.
+    """
+    if isinstance(dictionary, WordVectorManager):
+        dictionary = dictionary.table()
+    if isinstance(dictionary, VectorMatrix):
+        return dictionary.row_keys, dictionary.matrix, dictionary.key_index
+    keys = list(dictionary.keys())
+    matrix = np.asarray([dictionary[k] for k in keys])
+    return keys, matrix, {k: i for i, k in enumerate(keys)}
+
+
+def _key_position(key_index, key):
+    # Same error as list.index() for a missing key
+    try:
+        return key_index[key]
+    except KeyError:
+        raise ValueError(f"{key!r} is not in list") from None
+
+
+def _row_distances(matrix, vector):
+    """Euclidean distance from every row of matrix to vector."""
+    diff = matrix - np.asarray(vector)
+    # A stacked (1 x d) @ (d x 1) matmul runs the same BLAS dot per row as
+    # np.linalg.norm on a single vector, so the results are bit-identical to
+    # calling euclidean_distance() in a loop (norm(..., axis=1) is not).
+    return np.sqrt(np.matmul(diff[:, None, :], diff[:, :, None])[:, 0, 0])
+
+
 def get_sublist_keys(dictionary, start_key, end_key):
     # Convert dictionary keys to a list
-    keys_list = list(dictionary.keys())
+    keys_list, _, key_index = _vector_table(dictionary)
 
     # Find the indices of the start and end keys
-    start_index = keys_list.index(start_key)
-    end_index = keys_list.index(end_key)
+    start_index = _key_position(key_index, start_key)
+    end_index = _key_position(key_index, end_key)
     
     # Check if start index is actually before end index
     if start_index > end_index:
@@ -376,11 +688,11 @@ def euclidean_distance(v1, v2):
 
 def get_random_sublist_keys(dictionary, start_key, end_key, length):
     # Convert dictionary keys to a list
-    keys_list = list(dictionary.keys())
+    keys_list, matrix, key_index = _vector_table(dictionary)
 
     # Get the indices of the start and end keys
-    start_index = keys_list.index(start_key)
-    end_index = keys_list.index(end_key)
+    start_index = _key_position(key_index, start_key)
+    end_index = _key_position(key_index, end_key)
 
     # Check if start index is before end index, if not swap them
     if start_index > end_index:
@@ -402,7 +714,8 @@ def get_random_sublist_keys(dictionary, start_key, end_key, length):
     selected_keys = sorted(random.sample(keys_list[start_index+1:end_index], length-2))
 
     # Sort the selected keys based on the Euclidean distance of their values to the end key's value
-    sorted_keys = sorted(selected_keys, key=lambda k: euclidean_distance(dictionary[k], dictionary[end_key]))
+    distances = _row_distances(matrix[[key_index[k] for k in selected_keys]], matrix[key_index[end_key]])
+    sorted_keys = [selected_keys[i] for i in np.argsort(distances, kind='stable')]
 
     # Add start and end keys to the beginning and end of the list, respectively
     final_list = [start_key] + sorted_keys + [end_key]
@@ -421,10 +734,14 @@ def find_closest_key_to_midpoint(dictionary, key1, key2):
 
     # Find the key with the vector that has the smallest distance to the midpoint
     # Exclude the two provided keys from consideration
-    closest_key = min(
-        [k for k in dictionary.keys() if k not in [key1, key2]], 
-        key=lambda k: euclidean_distance(dictionary[k], midpoint)
-    )
+    keys, matrix, key_index = _vector_table(dictionary)
+    distances = _row_distances(matrix, midpoint)
+    for k in (key1, key2):
+        if k in key_index:
+            distances[key_index[k]] = np.inf
+    if not np.isfinite(distances).any():
+        raise ValueError("min() arg is an empty sequence")
+    closest_key = keys[int(np.argmin(distances))]
 
     return closest_key
 
@@ -435,9 +752,9 @@ def magnitude(v):
 
 def select_keys_from_span(dictionary, start_key, end_key, num_keys_to_select):
     # Extract keys between start and end (inclusive)
-    keys = list(dictionary.keys())
-    start_idx = keys.index(start_key)
-    end_idx = keys.index(end_key)
+    keys, matrix, key_index = _vector_table(dictionary)
+    start_idx = _key_position(key_index, start_key)
+    end_idx = _key_position(key_index, end_key)
     
     span_keys = keys[start_idx:end_idx + 1]
     
@@ -456,10 +773,12 @@ def select_keys_from_span(dictionary, start_key, end_key, num_keys_to_select):
     selected_keys = np.random.choice(span_keys, size=num_keys_to_select, replace=False, p=weights)
     
     # Sort the selected keys based on their similarity to the end key's value
-    end_vector = dictionary[end_key].reshape(1, -1)
-    similarities = [cosine_similarity(dictionary[key].reshape(1, -1), end_vector)[0][0] for key in selected_keys]
+    # Same normalize-then-dot steps as cosine_similarity(), batched over the selected rows
+    end_vector = normalize(matrix[end_idx].reshape(1, -1))
+    selected_matrix = normalize(matrix[[key_index[key] for key in selected_keys]])
+    similarities = np.matmul(selected_matrix[:, None, :], end_vector.T)[:, 0, 0]
     
-    sorted_keys = [k for _, k in sorted(zip(similarities, selected_keys), key=lambda pair: -pair[0])]
+    sorted_keys = [selected_keys[i] for i in np.argsort(-similarities, kind='stable')]
 
     sorted_keys = [start_key] + sorted_keys + [end_key]
     
@@ -472,25 +791,33 @@ def get_transition_keys(data, start_key, end_key):
     """Get keys that transition from start_key to end_key based on their vector values."""
     start_vec = data[start_key]
     end_vec = data[end_key]
-    
-    weights = {}
-    
-    for key, vec in data.items():
-        distance_to_start = euclidean_distance(vec, start_vec)
-        distance_to_end = euclidean_distance(vec, end_vec)
-        
-        # Avoid dividing by zero
-        if distance_to_start + distance_to_end == 0:
-            continue
 
-        # Calculate weight based on distances to start and end vectors
-        weight = distance_to_start / (distance_to_start + distance_to_end)
-        weights[key] = weight
+    keys, weights = transition_weights(data, start_vec, end_vec)
+
+    # Sort keys based on weight (stable, ties keep dictionary order)
+    return [keys[i] for i in np.argsort(weights, kind='stable')]
 
-    # Sort keys based on weight
-    sorted_keys = sorted(weights, key=weights.get)
-    
-    return sorted_keys
+
+def transition_weights(data, start_vec, end_vec):
+    """
+    Weight of every key on the path from start_vec to end_vec:
+    distance_to_start / (distance_to_start + distance_to_end).
+    Keys whose distances sum to zero are dropped.
+    Returns (keys, weights) with keys in dictionary order.
+    """
+    keys, matrix, _ = _vector_table(data)
+    distance_to_start = _row_distances(matrix, start_vec)
+    distance_to_end = _row_distances(matrix, end_vec)
+    total = distance_to_start + distance_to_end
+
+    # Avoid dividing by zero
+    valid = total != 0
+    if not valid.all():
+        rows = np.flatnonzero(valid)
+        keys = [keys[i] for i in rows]
+        distance_to_start, total = distance_to_start[rows], total[rows]
+
+    return keys, distance_to_start / total
 
 
 def sample_transition_keys(transition_keys, sample_length):
@@ -517,6 +844,76 @@ def sample_transition_keys(transition_keys, sample_length):
 
 
 
+def transition_sample_span(n_keys, sample_length):
+    """
+    Range [start, stop) of sorted positions that sample_transition_keys() keeps
+    out of n_keys sorted keys: its continuity pass turns the sampled indices into
+    one contiguous run ending at the largest sampled index.
+    """
+    if n_keys == 0:
+        return 0, 0
+    indices = np.linspace(0, n_keys-1, sample_length)
+    exponentiated_indices = np.power(indices, 1.5).astype(int)
+    exponentiated_indices = np.unique(np.clip(exponentiated_indices, 0, n_keys-1))
+    stop = int(exponentiated_indices[-1]) + 1
+    return stop - len(exponentiated_indices), stop
+
+
+_transition_weights_cache = OrderedDict()
+_transition_weights_cache_lock = threading.Lock()
+_TRANSITION_WEIGHTS_CACHE_SIZE = 32
+
+
+def _cached_transition_weights(data, start_key, end_key):
+    start_vec = data[start_key]
+    end_vec = data[end_key]
+    if not isinstance(data, WordVectorManager):
+        return transition_weights(data, start_vec, end_vec)
+
+    # Matrix version is part of the key: OOV rows added or evicted change the candidate set.
+    # Weights are computed from the same snapshot whose version is in the key.
+    table = data.table()
+    cache_key = (id(data), table.version, start_key, end_key)
+    with _transition_weights_cache_lock:
+        if cache_key in _transition_weights_cache:
+            _transition_weights_cache.move_to_end(cache_key)
+            return _transition_weights_cache[cache_key]
+    result = transition_weights(table, start_vec, end_vec)
+    with _transition_weights_cache_lock:
+        _transition_weights_cache[cache_key] = result
+        while len(_transition_weights_cache) > _TRANSITION_WEIGHTS_CACHE_SIZE:
+            _transition_weights_cache.popitem(last=False)
+    return result
+
+
+def _stable_rank_slice(weights, lo, hi):
+    """
+    Row indices holding ranks lo..hi-1 of a stable ascending sort of weights,
+    found with a partial selection instead of sorting everything.
+    """
+    partitioned = np.partition(weights, [lo, hi - 1])
+    low, high = partitioned[lo], partitioned[hi - 1]
+    below = np.count_nonzero(weights < low)
+    candidates = np.flatnonzero((weights >= low) & (weights <= high))
+    ordered = candidates[np.argsort(weights[candidates], kind='stable')]
+    return ordered[lo - below:hi - below]
+
+
+def iter_transition_keys(data, start_key, end_key, sample_length, batch_size=4):
+    """
+    Lazily yield the same keys, in the same order, as
+    sample_transition_keys(get_transition_keys(data, start_key, end_key), sample_length)
+    while ranking only the keys that are actually consumed.
+    """
+    keys, weights = _cached_transition_weights(data, start_key, end_key)
+    position, end = transition_sample_span(len(weights), sample_length)
+    while position < end:
+        stop = min(position + batch_size, end)
+        for i in _stable_rank_slice(weights, position, stop):
+            yield keys[i]
+        position = stop
+
+
 def sample_keys_parabolically(keys, sample_length):
     # Generate a parabolic distribution
     x = np.linspace(-1, 1, len(keys))
@@ -0,0 +1,286 @@
+"""
+词向量聚类结果的持久化管理
+
+Machine 在造字时需要知道每个字所属的语义簇。聚类（AgglomerativeClustering）
+在整个 chinese_list 上是 O(n²) 的，因此只在知识库构建时计算一次，
+结果保存在 knowledge_base/word_clusters.pkl 中；进程内共享同一份拷贝。
+当词向量（与 word_vector_store 相同的指纹：word_vectors.pkl 的大小和修改时间，
+只部署了 .npy 存储时为其键索引）或 chinese_list.txt 内容变化时自动重建。
+
+聚类引擎由 Config.CLUSTER_ENGINE（环境变量 CLUSTER_ENGINE）选择。
+
+命令行用法：
+    python word_clusters.py            # 如果已过期则重建
+    python word_clusters.py --force    # 强制重建
+    python word_clusters.py --compare knn_graph minibatch_kmeans
+                                       # 比较各引擎的耗时、内存峰值和与 agglomerative 的一致性
+"""
+
+import argparse
+import hashlib
+import logging
+import math
+import os
+import pickle
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans
+from sklearn.neighbors import NearestNeighbors
+
+from config import Config
+from word_vector_store import source_fingerprint as word_vector_store_fingerprint
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，退化为不加文件锁
+    fcntl = None
+
+# 聚类产物的格式版本，修改聚类参数或产物结构时需要递增
+WORD_CLUSTERS_VERSION = 1
+
+CHINESE_LIST_PATH = 'knowledge_base/chinese_list.txt'
+
+_word_clusters = None
+_word_clusters_lock = threading.Lock()
+
+
+def _agglomerative_labels(vectors_matrix):
+    # Agglomerative Clustering Cluster BERT 的词向量
+    agglomerative_clustering_model = AgglomerativeClustering(
+        n_clusters=None,
+        # affinity='cosine',
+        linkage='average',
+        distance_threshold=Config.CLUSTER_DISTANCE_THRESHOLD  # 用于根据距离控制簇的数量
+    )
+    return agglomerative_clustering_model.fit_predict(vectors_matrix)
+
+
+def _knn_graph_labels(vectors_matrix):
+    # 每个字只与最近的 k 个邻居连边，距离超过阈值的边丢弃，取连通分量作为簇
+    # 内存为 O(n·k)，不再需要完整的 n×n 距离矩阵
+    n_neighbors = min(Config.CLUSTER_KNN_NEIGHBORS + 1, len(vectors_matrix))
+    graph = NearestNeighbors(n_neighbors=n_neighbors).fit(vectors_matrix).kneighbors_graph(mode='distance')
+    graph.data[graph.data > Config.CLUSTER_DISTANCE_THRESHOLD] = 0
+    graph.eliminate_zeros()
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+
+def _minibatch_kmeans_labels(vectors_matrix):
+    # 先用 MiniBatchKMeans 粗分为约 √n 个分区（O(n·√n)），
+    # 再在每个分区内按距离阈值做 agglomerative 细分，每个分区平均只有约 √n 个字
+    n = len(vectors_matrix)
+    n_partitions = max(1, math.ceil(math.sqrt(n)))
+    model = MiniBatchKMeans(n_clusters=n_partitions, batch_size=4096, n_init=1, random_state=0)
+    partitions = model.fit_predict(vectors_matrix)
+
+    labels = np.zeros(n, dtype=np.int64)
+    next_label = 0
+    for partition in np.unique(partitions):
+        members = np.flatnonzero(partitions == partition)
+        if len(members) == 1:
+            sub_labels = np.zeros(1, dtype=np.int64)
+        else:
+            sub_labels = _agglomerative_labels(vectors_matrix[members])
+        labels[members] = sub_labels + next_label
+        next_label += int(sub_labels.max()) + 1
+    return labels
+
+
+CLUSTER_ENGINES = {
+    'agglomerative': _agglomerative_labels,
+    'knn_graph': _knn_graph_labels,
+    'minibatch_kmeans': _minibatch_kmeans_labels,
+}
+
+
+def _engine_params(engine):
+    """影响聚类结果的参数，写入指纹以便切换引擎或参数时自动重建"""
+    if engine == 'agglomerative':
+        return {'threshold': Config.CLUSTER_DISTANCE_THRESHOLD}
+    if engine == 'knn_graph':
+        return {'threshold': Config.CLUSTER_DISTANCE_THRESHOLD, 'k': Config.CLUSTER_KNN_NEIGHBORS}
+    return {'threshold': Config.CLUSTER_DISTANCE_THRESHOLD, 'partitions': 'sqrt'}
+
+
+def cluster_word_vectors(word_vectors, engine=None):
+    """对 {字: 向量} 聚类，返回 {字: 簇标签}；engine 默认取 Config.CLUSTER_ENGINE"""
+    engine = engine or Config.CLUSTER_ENGINE
+    if engine not in CLUSTER_ENGINES:
+        raise ValueError(f"未知的聚类引擎: {engine}，可选: {', '.join(CLUSTER_ENGINES)}")
+
+    words = list(word_vectors.keys())
+    # 将字典形式的词向量转换为矩阵形式
+    vectors_matrix = np.array([word_vectors[word] for word in words])
+    labels = CLUSTER_ENGINES[engine](vectors_matrix)
+
+    # 创建一个映射关系，关联字符与对应的聚类标签
+    return {word: int(label) for word, label in zip(words, labels)}
+
+
+def invert_word_clusters(word_clusters):
+    """由 {字: 簇标签} 生成 {簇标签: [字, ...]}，保持字的原始顺序"""
+    cluster_members = {}
+    for word, label in word_clusters.items():
+        cluster_members.setdefault(label, []).append(word)
+    return cluster_members
+
+
+def _file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _word_vectors_fingerprint():
+    # 复用 word_vector_store 的指纹，只 stat 而不读取整个 word_vectors.pkl；
+    # 只部署了 .npy 存储时，键索引（其中记录了构建存储时的来源指纹）很小，直接取摘要
+    fingerprint = word_vector_store_fingerprint()
+    if fingerprint is not None:
+        return fingerprint
+    return _file_digest(Config.WORD_VECTORS_KEYS_PATH)
+
+
+def source_fingerprint():
+    """聚类输入文件的指纹，任一文件内容变化都会导致指纹变化"""
+    return {
+        'version': WORD_CLUSTERS_VERSION,
+        'engine': Config.CLUSTER_ENGINE,
+        'engine_params': _engine_params(Config.CLUSTER_ENGINE),
+        'word_vectors': _word_vectors_fingerprint(),
+        'chinese_list': _file_digest(CHINESE_LIST_PATH),
+    }
+
+
+def _read_artifact(path, fingerprint):
+    """读取聚类产物；文件不存在、损坏或已过期时返回 None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            artifact = pickle.load(f)
+    except Exception as e:
+        logging.warning(f"聚类文件读取失败，将重建: {e}")
+        return None
+    if artifact.get('fingerprint') != fingerprint:
+        return None
+    return artifact
+
+
+def build_word_clusters(words, word_vectors, path=None, fingerprint=None):
+    """计算聚类并原子地写入 path，返回产物字典"""
+    path = path or Config.WORD_CLUSTERS_PATH
+    fingerprint = fingerprint or source_fingerprint()
+
+    word_clusters = cluster_word_vectors({word: word_vectors[word] for word in words})
+    artifact = {
+        'fingerprint': fingerprint,
+        'word_clusters': word_clusters,
+        'cluster_members': invert_word_clusters(word_clusters),
+    }
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(artifact, f)
+    os.replace(tmp_path, path)
+    logging.info(f"词向量聚类完成：{len(word_clusters)} 个字，{len(artifact['cluster_members'])} 个簇")
+    return artifact
+
+
+def load_word_clusters(words, word_vectors, path=None, force=False):
+    """读取聚类产物，过期或缺失时重建（多进程下只有一个进程执行重建）"""
+    path = path or Config.WORD_CLUSTERS_PATH
+    fingerprint = source_fingerprint()
+
+    artifact = None if force else _read_artifact(path, fingerprint)
+    if artifact is not None:
+        return artifact
+
+    lock_file = open(f'{path}.lock', 'w')
+    try:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # 拿到锁之后再检查一次，其他 worker 可能已经重建完成
+        artifact = None if force else _read_artifact(path, fingerprint)
+        if artifact is None:
+            artifact = build_word_clusters(words, word_vectors, path, fingerprint)
+        return artifact
+    finally:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def get_word_clusters(words, word_vectors):
+    """进程内共享的聚类结果，只在第一次调用时读取/构建；调用方不应修改返回值"""
+    global _word_clusters
+    with _word_clusters_lock:
+        if _word_clusters is None:
+            _word_clusters = load_word_clusters(words, word_vectors)
+        return _word_clusters
+
+
+def compare_cluster_engines(word_vectors, engines, reference='agglomerative'):
+    """
+    在同一份词向量上运行多个聚类引擎，返回每个引擎的报告：
+    耗时（秒）、NumPy/Python 分配峰值（MB）、簇数、与 reference 的调整兰德指数（ARI）
+    """
+    from sklearn.metrics import adjusted_rand_score
+
+    reports = []
+    reference_labels = None
+    for engine in [reference] + [e for e in engines if e != reference]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        word_clusters = cluster_word_vectors(word_vectors, engine)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        labels = list(word_clusters.values())
+        if reference_labels is None:
+            reference_labels = labels
+        reports.append({
+            'engine': engine,
+            'seconds': elapsed,
+            'peak_mb': peak / (1024 * 1024),
+            'clusters': len(set(labels)),
+            'ari': adjusted_rand_score(reference_labels, labels),
+        })
+    return reports
+
+
+if __name__ == '__main__':
+    from word_vector_store import load_word_vector_store
+
+    parser = argparse.ArgumentParser(description='构建词向量聚类文件')
+    parser.add_argument('--force', action='store_true', help='忽略现有文件强制重建')
+    parser.add_argument('--compare', nargs='*', choices=list(CLUSTER_ENGINES), metavar='ENGINE',
+                        help='比较聚类引擎（默认比较全部），不写入聚类文件')
+    parser.add_argument('--sample', type=int, default=None, help='比较时只取前 N 个字')
+    args = parser.parse_args()
+
+    with open(CHINESE_LIST_PATH, 'r', encoding='utf-8') as f:
+        chinese_list = list(f.read()) + ['，', '。', '！', '？']
+
+    logging.basicConfig(level=logging.INFO)
+    # 与运行时相同，从内存映射的词向量存储读取（只部署了 .npy 时也可用）；
+    # 键是 dict.fromkeys(chinese_list)，去重并保持顺序，与 WordVectorManager 中的键一致
+    words, matrix = load_word_vector_store(chinese_list)
+    word_vectors_dict = dict(zip(words, matrix))
+
+    if args.compare is not None:
+        words = words[:args.sample] if args.sample else words
+        reports = compare_cluster_engines({word: word_vectors_dict[word] for word in words},
+                                          args.compare or list(CLUSTER_ENGINES))
+        print(f"{'engine':<18}{'seconds':>10}{'peak_mb':>10}{'clusters':>10}{'ari':>8}")
+        for r in reports:
+            print(f"{r['engine']:<18}{r['seconds']:>10.2f}{r['peak_mb']:>10.1f}{r['clusters']:>10}{r['ari']:>8.3f}")
+    else:
+        load_word_clusters(words, word_vectors_dict, force=args.force)
@@ -1,20 +1,25 @@
-from transformers import BertModel, BertTokenizer
-import torch
-import pickle
+import numpy as np
 import os
+import threading
+from collections import namedtuple
+from collections.abc import Mapping
+
+from cache_store import LRUCache, SqliteStore
+from config import Config
+from word_vector_store import load_word_vector_store
 
 # 读取chinese_list.txt
 with open('knowledge_base/chinese_list.txt', 'r', encoding='utf-8') as f:
     chinese_list = list(f.read()) + ['，', '。', '！', '？']
 
 
-with open('knowledge_base/word_vectors.pkl', 'rb') as f:
-    word_vectors_dict = pickle.load(f)
-
 # 加载预训练模型 - 优先使用本地模型
 def load_bert_model():
     """加载BERT模型，优先使用本地模型"""
     try:
+        import torch
+        from transformers import BertModel, BertTokenizer
+
         # 首先尝试加载本地模型
         local_model_path = "models/bert-base-chinese"
         if os.path.exists(local_model_path):
@@ -37,8 +42,57 @@ def load_bert_model():
         print(f"❌ BERT模型加载失败: {str(e)}")
         return None, None, None
 
-# 加载模型
-bert_chinese, tokenizer_cn, device = load_bert_model()
+
+# 模型只在第一次遇到 chinese_list 以外的字时加载
+_bert = None
+_bert_lock = threading.Lock()
+
+
+def get_bert_model():
+    """返回 (model, tokenizer, device)，加载失败时抛出 RuntimeError（下次调用会重试）"""
+    global _bert
+    with _bert_lock:
+        if _bert is None:
+            model, tokenizer, device = load_bert_model()
+            if model is None:
+                raise RuntimeError("BERT模型加载失败，无法计算新字的词向量")
+            _bert = model, tokenizer, device
+        return _bert
+
+
+class WordVectorTable(Mapping):
+    """
+    {字: 向量} 的只读视图：chinese_list 中的字取自内存映射矩阵的对应行，
+    其余由 get_vector 现算的字保存在 oov（LRUCache）中
+    """
+
+    def __init__(self, keys, matrix, oov):
+        self._keys = keys
+        self._matrix = matrix
+        self._index = {k: i for i, k in enumerate(keys)}
+        self._oov = oov
+
+    def __getitem__(self, word):
+        i = self._index.get(word)
+        if i is not None:
+            # np.asarray 得到普通 ndarray 视图，数据仍在映射的文件页中
+            return np.asarray(self._matrix[i])
+        return self._oov[word]
+
+    def __contains__(self, word):
+        return word in self._index or word in self._oov
+
+    def __iter__(self):
+        yield from self._keys
+        yield from self._oov
+
+    def __len__(self):
+        return len(self._keys) + len(self._oov)
+
+
+# 所有向量组成的矩阵及其行索引。四个字段总是作为一个整体替换，
+# 读取方取一次快照即可得到彼此一致的矩阵和行号
+VectorMatrix = namedtuple('VectorMatrix', ['matrix', 'row_keys', 'key_index', 'version'])
 
 
 class WordVectorManager:
@@ -47,21 +101,127 @@ class WordVectorManager:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(WordVectorManager, cls).__new__(cls)
-            cls._instance.vectors = {}
-
-            # 初始化向量
-            for word in chinese_list:
-                # inputs = tokenizer(word, return_tensors='pt').to(device)
-                # outputs = bert_chinese(**inputs)
-                cls._instance.vectors[word] = word_vectors_dict[word]
+            # chinese_list 的向量来自共享的内存映射文件，不再逐个反序列化
+            store_keys, store_matrix = load_word_vector_store(chinese_list)
+            cls._instance._store_keys = store_keys
+            cls._instance._store_matrix = store_matrix
+            # 其他字的向量：内存中保留最近使用的一部分，全部持久化在磁盘上，多个 worker 共享
+            cls._instance._oov = LRUCache(Config.OOV_MEMORY_CACHE_SIZE)
+            cls._instance._oov_store = SqliteStore(Config.OOV_CACHE_PATH, table='oov_vectors')
+            cls._instance.vectors = WordVectorTable(store_keys, store_matrix, cls._instance._oov)
+            # (构建时的 oov 版本, VectorMatrix)，只通过一次赋值整体替换
+            cls._instance._table = None
+            cls._instance._table_lock = threading.Lock()
         return cls._instance
     
     def get_vector(self, word):
-        if word not in self.vectors:
-            inputs = tokenizer_cn(word, return_tensors='pt').to(device)
+        vector = self.vectors.get(word)
+        if vector is not None:
+            return vector
+        data = self._oov_store.get(word)
+        if data is not None:
+            vector = np.frombuffer(data, dtype=np.float32)
+        else:
+            vector = self._compute_vector(word)
+            # 多个进程同时计算同一个字时以先写入的为准，结果相同
+            self._oov_store.put(word, vector.tobytes())
+        self._oov.put(word, vector)
+        return vector
+
+    def get_vectors(self, words):
+        """
+        批量版本的 get_vector，按输入顺序返回向量列表。
+        磁盘缓存中也没有的字一起分词，每 Config.OOV_BATCH_SIZE 个字只做一次前向计算。
+        """
+        words = list(words)
+        found = {}
+        missing = []
+        for word in dict.fromkeys(words):
+            vector = self.vectors.get(word)
+            if vector is None:
+                missing.append(word)
+            else:
+                found[word] = vector
+
+        if missing:
+            for word, data in self._oov_store.get_many(missing).items():
+                found[word] = np.frombuffer(data, dtype=np.float32)
+            to_compute = [word for word in missing if word not in found]
+            for start in range(0, len(to_compute), Config.OOV_BATCH_SIZE):
+                batch = to_compute[start:start + Config.OOV_BATCH_SIZE]
+                vectors = self._compute_vectors(batch)
+                self._oov_store.put_many([(word, vector.tobytes()) for word, vector in zip(batch, vectors)])
+                found.update(zip(batch, vectors))
+            for word in missing:
+                self._oov.put(word, found[word])
+        return [found[word] for word in words]
+
+    def _compute_vector(self, word):
+        bert_chinese, tokenizer_cn, device = get_bert_model()
+        inputs = tokenizer_cn(word, return_tensors='pt').to(device)
+        outputs = bert_chinese(**inputs)
+        return np.asarray(outputs.last_hidden_state[0].mean(0).detach().cpu().numpy(), dtype=np.float32)
+
+    def _compute_vectors(self, words):
+        # 一次补齐长度的前向计算；按 attention_mask 对每个字自己的 token 取平均，
+        # 与逐字调用 _compute_vector 的结果一致（在浮点误差范围内）
+        import torch
+
+        bert_chinese, tokenizer_cn, device = get_bert_model()
+        inputs = tokenizer_cn(words, return_tensors='pt', padding=True).to(device)
+        with torch.no_grad():
             outputs = bert_chinese(**inputs)
-            self.vectors[word] = outputs.last_hidden_state[0].mean(0).detach().cpu().numpy()
-        return self.vectors[word]
+        mask = inputs['attention_mask'].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+        pooled = (outputs.last_hidden_state * mask).sum(1) / mask.sum(1)
+        return list(np.asarray(pooled.cpu().numpy(), dtype=np.float32))
+
+    def table(self):
+        """
+        当前矩阵的快照 VectorMatrix(matrix, row_keys, key_index, version)。
+        新字集合变化（新增或被 LRU 淘汰）时重建；同时需要多个字段的调用方应只取一次快照
+        """
+        current = self._table
+        if current is None or current[0] != self._oov.version:
+            with self._table_lock:
+                current = self._table
+                oov_version = self._oov.version
+                if current is None or current[0] != oov_version:
+                    version = current[1].version + 1 if current is not None else 1
+                    current = (oov_version, self._build_table(version))
+                    self._table = current
+        return current[1]
+
+    def _build_table(self, version):
+        # items() 是加锁取得的快照，行顺序与 row_keys 一致
+        oov_items = self._oov.items()
+        if oov_items:
+            oov_rows = np.array([vector for _, vector in oov_items], dtype=np.float32)
+            matrix = np.ascontiguousarray(np.vstack([self._store_matrix, oov_rows]))
+        else:
+            # 没有新字时直接使用映射的矩阵，不做拷贝
+            matrix = self._store_matrix
+        row_keys = self._store_keys + [word for word, _ in oov_items]
+        return VectorMatrix(matrix, row_keys, {k: i for i, k in enumerate(row_keys)}, version)
+
+    @property
+    def matrix(self):
+        """所有向量组成的连续 float32 矩阵（只读）；需要同时使用行号时请用 table()"""
+        return self.table().matrix
+
+    @property
+    def matrix_version(self):
+        """矩阵每次重建时递增，可用作派生结果的缓存键"""
+        return self.table().version
+
+    @property
+    def row_keys(self):
+        """矩阵每一行对应的字"""
+        return self.table().row_keys
+
+    @property
+    def key_index(self):
+        """字 -> 矩阵行号"""
+        return self.table().key_index
     
     def __getitem__(self, word):
         return self.get_vector(word)
@@ -76,4 +236,35 @@ class WordVectorManager:
         return self.vectors.values()
 
 # # 创建全局实例
-word_vectors = WordVectorManager()
\ No newline at end of file
+word_vectors = WordVectorManager()
+
+
+def _poem_characters(paths):
+    """诗歌文件中出现的所有字（去重，保持首次出现的顺序）"""
+    chars = {}
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for c in f.read():
+                if not c.isspace():
+                    chars[c] = None
+    return list(chars)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='预先计算诗歌中所有 chinese_list 以外的字的词向量')
+    parser.add_argument('paths', nargs='*', default=['knowledge_base/nvshu_final_poems.txt',
+                                                     'knowledge_base/nvshu_origin_with_eng.txt'])
+    args = parser.parse_args()
+
+    chars = _poem_characters(args.paths)
+    known = set(word_vectors._store_keys)
+    oov_chars = [c for c in chars if c not in known]
+    cached = word_vectors._oov_store.get_many(oov_chars)
+    print(f"共 {len(chars)} 个字，{len(oov_chars)} 个不在 chinese_list 中，其中 {len(cached)} 个已缓存")
+    # 分批调用，避免超出内存 LRU 的容量
+    step = max(1, min(Config.OOV_MEMORY_CACHE_SIZE, 1024))
+    for start in range(0, len(oov_chars), step):
+        word_vectors.get_vectors(oov_chars[start:start + step])
+    print(f"完成，磁盘缓存中共有 {len(word_vectors._oov_store)} 个字")
\ No newline at end of file
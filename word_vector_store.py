@@ -0,0 +1,163 @@
+"""
+词向量的内存映射存储
+
+word_vectors.pkl 是 {字: 向量} 的 pickle，每个 gunicorn worker 都要反序列化出
+成千上万个独立的 NumPy 数组。这里把它转换为一个 float32 的 .npy 矩阵加一个 JSON 键索引，
+用 np.load(mmap_mode='r') 打开：启动时只是映射文件，同一台机器上的所有 worker
+共享同一份页缓存。
+
+矩阵的行顺序与 dict.fromkeys(chinese_list) 一致。word_vectors.pkl 或 chinese_list.txt
+变化时自动重建。
+
+命令行用法：
+    python word_vector_store.py            # 如果已过期则重建
+    python word_vector_store.py --force    # 强制重建
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from config import Config
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，退化为不加文件锁
+    fcntl = None
+
+# 存储格式版本，修改矩阵或索引结构时需要递增
+WORD_VECTOR_STORE_VERSION = 1
+
+WORD_VECTORS_PATH = 'knowledge_base/word_vectors.pkl'
+CHINESE_LIST_PATH = 'knowledge_base/chinese_list.txt'
+
+
+def source_fingerprint():
+    """
+    输入文件的指纹。word_vectors.pkl 较大，只记录大小和修改时间，避免每次启动都完整读取；
+    word_vectors.pkl 不存在时（只部署了 .npy）返回 None，直接使用现有存储。
+    """
+    if not os.path.exists(WORD_VECTORS_PATH):
+        return None
+    stat = os.stat(WORD_VECTORS_PATH)
+    with open(CHINESE_LIST_PATH, 'rb') as f:
+        chinese_list_digest = hashlib.sha256(f.read()).hexdigest()
+    return {
+        'version': WORD_VECTOR_STORE_VERSION,
+        'word_vectors': [stat.st_size, stat.st_mtime_ns],
+        'chinese_list': chinese_list_digest,
+    }
+
+
+def _read_index(keys_path, fingerprint):
+    """读取键索引；文件不存在、损坏或已过期时返回 None"""
+    if not os.path.exists(keys_path):
+        return None
+    try:
+        with open(keys_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except Exception as e:
+        logging.warning(f"词向量索引读取失败，将重建: {e}")
+        return None
+    if index.get('version') != WORD_VECTOR_STORE_VERSION:
+        return None
+    if fingerprint is not None and index.get('source') != fingerprint:
+        return None
+    return index
+
+
+def _open_matrix(matrix_path, n_keys):
+    matrix = np.load(matrix_path, mmap_mode='r')
+    if matrix.ndim != 2 or matrix.shape[0] != n_keys or matrix.dtype != np.float32:
+        raise ValueError(f"词向量矩阵与索引不一致: {matrix.shape} {matrix.dtype}，键数 {n_keys}")
+    return matrix
+
+
+def _open_store(matrix_path, keys_path, fingerprint):
+    """打开现有存储，返回 (键列表, 矩阵)；缺失、损坏或过期时返回 None"""
+    index = _read_index(keys_path, fingerprint)
+    if index is None:
+        return None
+    try:
+        return index['keys'], _open_matrix(matrix_path, len(index['keys']))
+    except Exception as e:
+        logging.warning(f"词向量矩阵打开失败，将重建: {e}")
+        return None
+
+
+def build_word_vector_store(words, word_vectors, matrix_path=None, keys_path=None, fingerprint=None):
+    """把 {字: 向量} 按 words 的顺序写成 float32 矩阵和键索引（原子替换），返回键列表"""
+    matrix_path = matrix_path or Config.WORD_VECTORS_NPY_PATH
+    keys_path = keys_path or Config.WORD_VECTORS_KEYS_PATH
+    fingerprint = fingerprint if fingerprint is not None else source_fingerprint()
+
+    keys = list(dict.fromkeys(words))
+    matrix = np.ascontiguousarray(np.array([word_vectors[k] for k in keys], dtype=np.float32))
+
+    # 先替换矩阵再替换索引：已经映射旧矩阵的进程不受影响（旧文件的 inode 仍然有效）
+    tmp_path = f'{matrix_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, matrix)
+    os.replace(tmp_path, matrix_path)
+
+    tmp_path = f'{keys_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': WORD_VECTOR_STORE_VERSION, 'source': fingerprint, 'keys': keys}, f, ensure_ascii=False)
+    os.replace(tmp_path, keys_path)
+    logging.info(f"词向量存储构建完成：{matrix.shape[0]} 个字，{matrix.shape[1]} 维")
+    return keys
+
+
+def _build_from_pickle(words, matrix_path, keys_path, fingerprint):
+    with open(WORD_VECTORS_PATH, 'rb') as f:
+        word_vectors = pickle.load(f)
+    return build_word_vector_store(words, word_vectors, matrix_path, keys_path, fingerprint)
+
+
+def load_word_vector_store(words, matrix_path=None, keys_path=None, force=False):
+    """
+    返回 (键列表, 只读的内存映射矩阵)。存储缺失或过期时从 word_vectors.pkl 重建
+    （多进程下只有一个进程执行重建）。
+    """
+    matrix_path = matrix_path or Config.WORD_VECTORS_NPY_PATH
+    keys_path = keys_path or Config.WORD_VECTORS_KEYS_PATH
+    fingerprint = source_fingerprint()
+
+    store = None if force else _open_store(matrix_path, keys_path, fingerprint)
+    if store is not None:
+        return store
+
+    if fingerprint is None:
+        raise RuntimeError(f"词向量存储不可用，且找不到 {WORD_VECTORS_PATH} 用于重建")
+
+    lock_file = open(f'{keys_path}.lock', 'w')
+    try:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # 拿到锁之后再检查一次，其他 worker 可能已经重建完成
+        store = None if force else _open_store(matrix_path, keys_path, fingerprint)
+        if store is None:
+            keys = _build_from_pickle(words, matrix_path, keys_path, fingerprint)
+            store = keys, _open_matrix(matrix_path, len(keys))
+        return store
+    finally:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='由 word_vectors.pkl 构建内存映射的词向量存储')
+    parser.add_argument('--force', action='store_true', help='忽略现有文件强制重建')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(CHINESE_LIST_PATH, 'r', encoding='utf-8') as f:
+        chinese_list = list(f.read()) + ['，', '。', '！', '？']
+    keys, matrix = load_word_vector_store(chinese_list, force=args.force)
+    print(f"{Config.WORD_VECTORS_NPY_PATH}: {matrix.shape[0]} x {matrix.shape[1]} float32")